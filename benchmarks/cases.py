@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Benchmark cases: the core function of each workflow/scripts aggregation step on
+synthetic inputs (see generators.py).
+
+Every case has a prepare step, run in the parent process and cached in the work
+directory, and a run step, executed by run_benchmarks.py in a fresh process, that
+returns the wall time of the timed call only (reading inputs the pipeline hands over
+in memory is not timed). Cases with samples=False only scale with features.
+
+    annotation_index     parse_gtf + index write of a GTF of <features> genes (cold cache)
+    parse_gtf_lookup     _aggregate_counts_by_strandedness.parse_gtf_lookup (warm cache)
+    aggregate_counts     _aggregate_counts_by_strandedness.main on ReadsPerGene files
+    counts_to_rpkm_tpm   _raw_counts_to_tpm.counts_to_rpkm_tpm on a genes x samples matrix
+    aggregate_files      _aggregate_transcript_level_counts.aggregate_files, <features> transcripts
+    aggregate_tin        _aggregate_tin.main on tin.xls files, <features> transcripts
+    fix_gtf              _fix_gtf.py on a GTF of <features> genes (subprocess)
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+import generators
+
+SCRIPTS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "workflow", "scripts"
+)
+TRANSCRIPTS_PER_GENE = 3
+
+Case = namedtuple("Case", ["prepare", "run", "samples"])
+
+
+def _scripts():
+    if SCRIPTS_DIR not in sys.path:
+        sys.path.insert(0, SCRIPTS_DIR)
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def _gtf(workdir, genes):
+    path = os.path.join(workdir, "gtf", f"genes_{genes}.gtf")
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        generators.write_gtf(path + ".tmp", genes, TRANSCRIPTS_PER_GENE)
+        os.rename(path + ".tmp", path)
+    return path
+
+
+def _warm_index(gtf, cache_dir):
+    _scripts()
+    from _annotation_index import load_annotation_index
+
+    load_annotation_index(gtf, cache_dir)
+
+
+# annotation_index / parse_gtf_lookup
+
+
+def prepare_gtf(workdir, samples, features, pool):
+    return {"gtf": _gtf(workdir, features)}
+
+
+def run_annotation_index(inputs, outdir):
+    _scripts()
+    from _annotation_index import load_annotation_index
+
+    return _timed(load_annotation_index, inputs["gtf"], os.path.join(outdir, "index"))
+
+
+def prepare_gtf_lookup(workdir, samples, features, pool):
+    inputs = prepare_gtf(workdir, samples, features, pool)
+    inputs["cache"] = os.path.join(workdir, "gtf", "annotation_index")
+    _warm_index(inputs["gtf"], inputs["cache"])
+    return inputs
+
+
+def run_parse_gtf_lookup(inputs, outdir):
+    _scripts()
+    from _aggregate_counts_by_strandedness import parse_gtf_lookup
+
+    return _timed(parse_gtf_lookup, inputs["gtf"], inputs["cache"])
+
+
+# aggregate_counts
+
+
+def prepare_aggregate_counts(workdir, samples, features, pool):
+    inputs = prepare_gtf_lookup(workdir, samples, features, pool)
+    sample_dir = os.path.join(workdir, f"star_{features}")
+    inputs["counts"] = generators.sample_files(
+        sample_dir,
+        samples,
+        ".ReadsPerGene.out.tab",
+        lambda path, seed: generators.write_reads_per_gene(path, features, seed),
+        pool,
+    )
+    inputs["strand"] = generators.sample_files(
+        os.path.join(workdir, "rseqc"),
+        samples,
+        ".strandedness.txt",
+        lambda path, seed: generators.write_infer_experiment(path),
+        pool,
+    )
+    inputs["manifest"] = generators.write_manifest(
+        os.path.join(workdir, f"samples_{samples}.tsv"), samples
+    )
+    inputs["regions"] = generators.write_regions(
+        os.path.join(workdir, "ref.fa.regions")
+    )
+    return inputs
+
+
+def run_aggregate_counts(inputs, outdir):
+    _scripts()
+    from _aggregate_counts_by_strandedness import main
+
+    return _timed(
+        main,
+        inputs["counts"],
+        inputs["strand"],
+        os.path.join(outdir, "counts_matrix.tsv"),
+        os.path.join(outdir, "sample_strandedness.tsv"),
+        inputs["gtf"],
+        inputs["regions"],
+        True,
+        inputs["manifest"],
+        "strandedness",
+        0.8,
+        annotation_cache=inputs["cache"],
+        strandedness_method="rseqc",
+        binary=False,
+    )
+
+
+# counts_to_rpkm_tpm
+
+
+def prepare_rpkm_tpm(workdir, samples, features, pool):
+    return {"samples": samples, "features": features}
+
+
+def run_counts_to_rpkm_tpm(inputs, outdir):
+    _scripts()
+    import pandas as pd
+    from _raw_counts_to_tpm import counts_to_rpkm_tpm
+
+    rng = np.random.default_rng(0)
+    names = generators.sample_names(inputs["samples"])
+    counts = rng.poisson(
+        rng.lognormal(1.0, 2.0, size=(inputs["features"], 1)),
+        size=(inputs["features"], len(names)),
+    ).astype(np.int64)
+    df = pd.DataFrame(counts, columns=names)
+    df.insert(0, "gene_length_kb", rng.uniform(0.2, 10, size=inputs["features"]))
+    df.insert(0, "gene_chr", "chr1")
+    return _timed(counts_to_rpkm_tpm, df, "gene_length_kb", names)
+
+
+# aggregate_files
+
+
+def _transcript_files(workdir, samples, features, pool, suffix, write):
+    table = generators.transcript_table(features, TRANSCRIPTS_PER_GENE)
+    return generators.sample_files(
+        os.path.join(workdir, f"transcripts_{features}"),
+        samples,
+        suffix,
+        lambda path, seed: write(path, table, seed),
+        pool,
+    )
+
+
+def prepare_aggregate_files(workdir, samples, features, pool):
+    genes = -(-features // TRANSCRIPTS_PER_GENE)
+    inputs = prepare_gtf_lookup(workdir, samples, genes, pool)
+    inputs["files"] = _transcript_files(
+        workdir,
+        samples,
+        features,
+        pool,
+        ".rseqc_fpkm_tpm.tsv",
+        lambda path, table, seed: generators.write_fpkm(path, table, seed, tpm=True),
+    )
+    return inputs
+
+
+def run_aggregate_files(inputs, outdir):
+    _scripts()
+    from _aggregate_transcript_level_counts import aggregate_files
+
+    return _timed(
+        aggregate_files,
+        inputs["files"],
+        inputs["gtf"],
+        os.path.join(outdir, "fpkm.tsv"),
+        os.path.join(outdir, "tpm.tsv"),
+        os.path.join(outdir, "fragcount.tsv"),
+        annotation_cache=inputs["cache"],
+        binary=False,
+    )
+
+
+# aggregate_tin
+
+
+def prepare_aggregate_tin(workdir, samples, features, pool):
+    files = _transcript_files(
+        workdir, samples, features, pool, ".tin.xls", generators.write_tin
+    )
+    return {"files": files}
+
+
+def run_aggregate_tin(inputs, outdir):
+    _scripts()
+    from _aggregate_tin import main
+
+    return _timed(
+        main,
+        inputs["files"],
+        os.path.join(outdir, "aggregate_tin.tsv"),
+        os.path.join(outdir, "aggregate_tin.summary_mqc.tsv"),
+        binary=False,
+    )
+
+
+# fix_gtf
+
+
+def run_fix_gtf(inputs, outdir):
+    # _fix_gtf.py is a script without functions; gene_id_2_gene_name.tsv lands in cwd
+    return _timed(
+        subprocess.run,
+        [
+            sys.executable,
+            os.path.join(SCRIPTS_DIR, "_fix_gtf.py"),
+            "--ingtf",
+            inputs["gtf"],
+            "--outgtf",
+            os.path.join(outdir, "ref.fixed.gtf"),
+        ],
+        cwd=outdir,
+        check=True,
+    )
+
+
+CASES = {
+    "annotation_index": Case(prepare_gtf, run_annotation_index, False),
+    "parse_gtf_lookup": Case(prepare_gtf_lookup, run_parse_gtf_lookup, False),
+    "aggregate_counts": Case(prepare_aggregate_counts, run_aggregate_counts, True),
+    "counts_to_rpkm_tpm": Case(prepare_rpkm_tpm, run_counts_to_rpkm_tpm, True),
+    "aggregate_files": Case(prepare_aggregate_files, run_aggregate_files, True),
+    "aggregate_tin": Case(prepare_aggregate_tin, run_aggregate_tin, True),
+    "fix_gtf": Case(prepare_gtf, run_fix_gtf, False),
+}
+
+
+def clean(outdir):
+    shutil.rmtree(outdir, ignore_errors=True)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Synthetic inputs for the workflow/scripts benchmarks, in the formats the pipeline
+produces:
+
+    GTF                 gene/transcript/exon lines (write_gtf), a fraction of genes
+                        without gene_name so _fix_gtf.py has work to do
+    ReadsPerGene        STAR ReadsPerGene.out.tab (write_reads_per_gene)
+    infer_experiment    RSeQC infer_experiment.py output (write_infer_experiment)
+    fpkm.xls            RSeQC FPKM_count.py table, optionally with the TPM column of
+                        rseqc_fpkm_tpm.tsv (write_fpkm)
+    tin.xls             RSeQC tin.py table (write_tin)
+    manifest            samples.tsv (write_manifest) and the species regions file
+
+Every generator is seeded, so the same arguments always write the same file.
+Per-sample files are written for a pool of distinct samples only; the remaining
+samples are symlinks to the pool (see sample_files), which keeps 5,000-sample grids
+cheap to set up while every sample is still opened and parsed by the script.
+"""
+
+import os
+
+import numpy as np
+
+CHROMS = ["chr1", "chr2", "chr3", "chr4", "chr5"]
+GENE_TYPES = ["protein_coding", "lncRNA", "miRNA", "pseudogene"]
+STAR_SUMMARY_ROWS = ["N_unmapped", "N_multimapping", "N_noFeature", "N_ambiguous"]
+
+
+def gene_ids(genes):
+    return [f"ENSG{g:011d}" for g in range(genes)]
+
+
+def transcript_ids(genes, transcripts_per_gene):
+    return [
+        f"ENST{g:011d}.{t}" for g in range(genes) for t in range(transcripts_per_gene)
+    ]
+
+
+def write_gtf(
+    path,
+    genes,
+    transcripts_per_gene=3,
+    exons_per_transcript=5,
+    missing_gene_name=0.1,
+    seed=0,
+):
+    """
+    Write a GTF of `genes` genes laid out along CHROMS. Transcripts of a gene share a
+    pool of exon positions and use a random subset of them, so transcripts overlap
+    the way alternative isoforms do.
+    """
+    rng = np.random.default_rng(seed)
+    exon_len = rng.integers(50, 400, size=(genes, exons_per_transcript + 2))
+    intron_len = rng.integers(100, 5000, size=(genes, exons_per_transcript + 2))
+    named = rng.random(genes) >= missing_gene_name
+    strands = rng.choice(["+", "-"], size=genes)
+    types = rng.choice(GENE_TYPES, size=genes)
+    per_chrom = -(-genes // len(CHROMS))
+
+    with open(path, "w") as f:
+        f.write("##description: synthetic HAROLD benchmark annotation\n")
+        pos = 1
+        for g, gene_id in enumerate(gene_ids(genes)):
+            chrom = CHROMS[g // per_chrom]
+            if g % per_chrom == 0:
+                pos = 1
+            # exon pool of the gene
+            starts, ends = [], []
+            for k in range(exons_per_transcript + 2):
+                pos += int(intron_len[g, k])
+                starts.append(pos)
+                pos += int(exon_len[g, k])
+                ends.append(pos - 1)
+            gene_attr = f'gene_id "{gene_id}"; gene_type "{types[g]}";'
+            if named[g]:
+                gene_attr += f' gene_name "GENE{g}";'
+            common = f"{chrom}\tHAROLD\t%s\t%d\t%d\t.\t{strands[g]}\t.\t"
+            f.write(common % ("gene", starts[0], ends[-1]) + gene_attr + "\n")
+            for t in range(transcripts_per_gene):
+                picks = np.sort(
+                    rng.choice(len(starts), size=exons_per_transcript, replace=False)
+                )
+                tx_attr = gene_attr + f' transcript_id "ENST{g:011d}.{t}";'
+                f.write(
+                    common % ("transcript", starts[picks[0]], ends[picks[-1]])
+                    + tx_attr
+                    + "\n"
+                )
+                for k in picks:
+                    f.write(common % ("exon", starts[k], ends[k]) + tx_attr + "\n")
+    return path
+
+
+def write_regions(path, species=("hg38",)):
+    """ref.fa.regions file: species<TAB>space separated chromosomes."""
+    with open(path, "w") as f:
+        f.write(f"{species[0]}\t{' '.join(CHROMS)}\n")
+    return path
+
+
+def _counts(rng, n):
+    # over-dispersed counts with many zeros, as in real libraries
+    return rng.poisson(rng.lognormal(1.0, 2.0, size=n)).astype(np.int64)
+
+
+def write_reads_per_gene(path, genes, seed=0):
+    """STAR ReadsPerGene.out.tab: 4 summary rows, then gene, unstranded, forward, reverse."""
+    rng = np.random.default_rng(seed)
+    forward = _counts(rng, genes)
+    reverse = _counts(rng, genes) * 20
+    with open(path, "w") as f:
+        for name in STAR_SUMMARY_ROWS:
+            n = int(rng.integers(1000, 100000))
+            f.write(f"{name}\t{n}\t{n}\t{n}\n")
+        f.writelines(
+            f"{g}\t{a + b}\t{a}\t{b}\n"
+            for g, a, b in zip(gene_ids(genes), forward.tolist(), reverse.tolist())
+        )
+    return path
+
+
+def write_infer_experiment(path, paired=True, reverse_fraction=0.95):
+    """RSeQC infer_experiment.py output for a reverse-stranded library."""
+    failed = 0.01
+    other = round(1 - failed - reverse_fraction, 4)
+    if paired:
+        keys = ("This is PairEnd Data", "1++,1--,2+-,2-+", "1+-,1-+,2++,2--")
+    else:
+        keys = ("This is SingleEnd Data", "++,--", "+-,-+")
+    with open(path, "w") as f:
+        f.write(f"\n\n{keys[0]}\n")
+        f.write(f"Fraction of reads failed to determine: {failed:.4f}\n")
+        f.write(f'Fraction of reads explained by "{keys[1]}": {other:.4f}\n')
+        f.write(f'Fraction of reads explained by "{keys[2]}": {reverse_fraction:.4f}\n')
+    return path
+
+
+def transcript_table(transcripts, transcripts_per_gene=3, seed=0):
+    """Columns shared by the fpkm.xls and tin.xls of every sample (same transcripts)."""
+    genes = -(-transcripts // transcripts_per_gene)
+    rng = np.random.default_rng(seed)
+    ids = transcript_ids(genes, transcripts_per_gene)[:transcripts]
+    starts = np.cumsum(rng.integers(1000, 20000, size=transcripts))
+    sizes = rng.integers(300, 8000, size=transcripts)
+    return {
+        "chrom": [CHROMS[k * len(CHROMS) // transcripts] for k in range(transcripts)],
+        "start": starts,
+        "end": starts + rng.integers(1000, 50000, size=transcripts),
+        "accession": ids,
+        "size": sizes,
+        "strand": rng.choice(["+", "-"], size=transcripts).tolist(),
+    }
+
+
+def write_fpkm(path, table, seed=0, tpm=False):
+    """
+    RSeQC FPKM_count.py .fpkm.xls, or rseqc_fpkm_tpm.tsv (header without "#", TPM
+    column added, floats as %.6f) with tpm=True.
+    """
+    rng = np.random.default_rng(seed)
+    frags = _counts(rng, len(table["accession"])).astype(np.float64)
+    fpm = frags * 1e6 / max(frags.sum(), 1)
+    fpkm = fpm * 1000 / table["size"]
+    columns = ["chrom", "st", "end", "accession", "mRNA_size", "gene_strand"]
+    columns += ["Frag_count", "FPM", "FPKM"] + (["TPM"] if tpm else [])
+    extra = [fpkm * 1e6 / max(fpkm.sum(), 1)] if tpm else []
+    with open(path, "w") as f:
+        f.write(("" if tpm else "#") + "\t".join(columns) + "\n")
+        for row in zip(
+            table["chrom"],
+            table["start"].tolist(),
+            table["end"].tolist(),
+            table["accession"],
+            table["size"].tolist(),
+            table["strand"],
+            *[c.tolist() for c in [frags, fpm, fpkm] + extra],
+        ):
+            if tpm:
+                f.write("\t".join(map(str, row[:6])))
+                f.write("\t" + "\t".join(f"{v:.6f}" for v in row[6:]) + "\n")
+            else:
+                f.write("\t".join(map(str, row)) + "\n")
+    return path
+
+
+def write_tin(path, table, seed=0, zero_fraction=0.3):
+    """RSeQC tin.py .tin.xls: geneID, chrom, tx_start, tx_end, TIN (0.0 below --minCov)."""
+    rng = np.random.default_rng(seed)
+    n = len(table["accession"])
+    tin = np.where(rng.random(n) < zero_fraction, 0.0, rng.uniform(5, 95, size=n))
+    with open(path, "w") as f:
+        f.write("geneID\tchrom\ttx_start\ttx_end\tTIN\n")
+        f.writelines(
+            f"{a}\t{c}\t{s}\t{e}\t{v}\n"
+            for a, c, s, e, v in zip(
+                table["accession"],
+                table["chrom"],
+                table["start"].tolist(),
+                table["end"].tolist(),
+                np.round(tin, 6).tolist(),
+            )
+        )
+    return path
+
+
+def sample_names(samples):
+    return [f"S{k:05d}" for k in range(samples)]
+
+
+def write_manifest(path, samples, groups=4):
+    """samples.tsv with sampleName, groupName and FASTQ paths."""
+    with open(path, "w") as f:
+        f.write("sampleName\tgroupName\tpath_to_R1_fastq\tpath_to_R2_fastq\n")
+        for k, name in enumerate(sample_names(samples)):
+            f.write(
+                f"{name}\tG{k % groups}\t/data/{name}_R1.fastq.gz\t/data/{name}_R2.fastq.gz\n"
+            )
+    return path
+
+
+def sample_files(outdir, samples, suffix, write, pool=16):
+    """
+    Per-sample files <outdir>/<sample><suffix>: write(path, seed) is called for the
+    first `pool` samples, later samples link to one of them. Existing files are kept.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    paths = []
+    for k, name in enumerate(sample_names(samples)):
+        path = os.path.join(outdir, name + suffix)
+        if not os.path.exists(path):
+            if k < pool:
+                write(path, k)
+            else:
+                os.symlink(os.path.basename(paths[k % pool]), path)
+        paths.append(path)
+    return paths
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Time the workflow/scripts benchmark cases (cases.py) over a grid of sample and
+feature counts and report wall time and peak RSS per case and grid point.
+
+Each measurement runs in a freshly spawned Python process, so peak RSS (ru_maxrss
+of the process and of any subprocess it ran) belongs to that case alone. Inputs are
+generated once per grid point and kept in --workdir for later runs.
+
+The table (TSV) carries the commit it was measured on; pass a table written on
+another commit with --compare to add its numbers and the ratios next to them.
+
+Usage:
+    python benchmarks/run_benchmarks.py --grid quick --output bench_output.tsv
+    python benchmarks/run_benchmarks.py --cases aggregate_tin --samples 10,1000 \\
+        --features 60000 --compare bench_baseline.tsv
+"""
+
+import argparse
+import csv
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+import cases
+
+GRIDS = {
+    "quick": {"samples": [10, 100], "features": [60000]},
+    "full": {"samples": [10, 100, 1000, 5000], "features": [60000, 150000, 300000]},
+}
+COLUMNS = ["commit", "case", "samples", "features", "seconds", "peak_rss_mb"]
+KEY = ["case", "samples", "features"]
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "NA"
+
+
+def _measure(name, inputs, outdir, queue):
+    seconds = cases.CASES[name].run(inputs, outdir)
+    # ru_maxrss is in KiB on Linux
+    rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    queue.put((seconds, rss / 1024))
+
+
+def measure(name, inputs, outdir):
+    """Run one case in a new process; returns (seconds, peak RSS in MiB)."""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    os.makedirs(outdir, exist_ok=True)
+    process = context.Process(target=_measure, args=(name, inputs, outdir, queue))
+    process.start()
+    process.join()
+    cases.clean(outdir)
+    if process.exitcode != 0:
+        raise RuntimeError(f"{name} failed with exit code {process.exitcode}")
+    return queue.get()
+
+
+def grid_points(case, samples, features):
+    for f in features:
+        for s in samples if case.samples else ["-"]:
+            yield s, f
+
+
+def read_table(path):
+    with open(path) as f:
+        return {
+            tuple(row[k] for k in KEY): row for row in csv.DictReader(f, delimiter="\t")
+        }
+
+
+def _ratio(new, old):
+    try:
+        return f"{float(new) / float(old):.2f}"
+    except (ValueError, ZeroDivisionError):
+        return "NA"
+
+
+def compare(rows, baseline):
+    """Add the baseline commit's seconds/RSS and new/baseline ratios to every row."""
+    out = []
+    for row in rows:
+        base = baseline.get(tuple(str(row[k]) for k in KEY), {})
+        out.append(
+            {
+                **row,
+                "base_commit": base.get("commit", "NA"),
+                "base_seconds": base.get("seconds", "NA"),
+                "seconds_ratio": _ratio(row["seconds"], base.get("seconds")),
+                "base_peak_rss_mb": base.get("peak_rss_mb", "NA"),
+                "rss_ratio": _ratio(row["peak_rss_mb"], base.get("peak_rss_mb")),
+            }
+        )
+    return out
+
+
+def print_table(rows, columns, out=sys.stdout):
+    widths = {c: max([len(c)] + [len(str(r[c])) for r in rows]) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns), file=out)
+    for r in rows:
+        print("  ".join(str(r[c]).ljust(widths[c]) for c in columns), file=out)
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time workflow/scripts core functions on synthetic inputs and report wall time and peak RSS."
+    )
+    parser.add_argument(
+        "--grid",
+        choices=sorted(GRIDS),
+        default="quick",
+        help="Sample/feature grid (default: quick; full is 10-5,000 samples x 60k-300k features)",
+    )
+    parser.add_argument(
+        "--samples", type=_int_list, help="Sample counts, overrides --grid"
+    )
+    parser.add_argument(
+        "--features", type=_int_list, help="Feature counts, overrides --grid"
+    )
+    parser.add_argument(
+        "--cases",
+        default=",".join(cases.CASES),
+        help=f"Comma-separated cases (default: all): {', '.join(cases.CASES)}",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=1,
+        help="Runs per grid point; the fastest time and largest RSS are reported (default: 1)",
+    )
+    parser.add_argument(
+        "--pool",
+        type=int,
+        default=16,
+        help="Distinct per-sample input files; further samples link to them (default: 16)",
+    )
+    parser.add_argument(
+        "--workdir",
+        default=os.path.join(tempfile.gettempdir(), "harold_benchmarks"),
+        help="Where generated inputs are kept between runs (default: $TMPDIR/harold_benchmarks)",
+    )
+    parser.add_argument("--output", help="Write the table as TSV")
+    parser.add_argument(
+        "--compare",
+        help="TSV from an earlier run (e.g. another commit) to compare with",
+    )
+    args = parser.parse_args()
+
+    names = [c for c in args.cases.split(",") if c]
+    unknown = [c for c in names if c not in cases.CASES]
+    if unknown:
+        parser.error(f"unknown case(s) {unknown}; choose from {list(cases.CASES)}")
+    samples = args.samples or GRIDS[args.grid]["samples"]
+    features = args.features or GRIDS[args.grid]["features"]
+
+    head = commit()
+    rows = []
+    for name in names:
+        case = cases.CASES[name]
+        for s, f in grid_points(case, samples, features):
+            inputs = case.prepare(args.workdir, 1 if s == "-" else s, f, args.pool)
+            outdir = os.path.join(args.workdir, "out", name)
+            runs = [measure(name, inputs, outdir) for _ in range(args.repeats)]
+            row = {
+                "commit": head,
+                "case": name,
+                "samples": s,
+                "features": f,
+                "seconds": f"{min(r[0] for r in runs):.3f}",
+                "peak_rss_mb": f"{max(r[1] for r in runs):.1f}",
+            }
+            print(
+                f"✅ {name} samples={s} features={f}: {row['seconds']} s, {row['peak_rss_mb']} MiB",
+                file=sys.stderr,
+            )
+            rows.append(row)
+
+    columns = COLUMNS
+    if args.compare:
+        rows = compare(rows, read_table(args.compare))
+        columns = list(rows[0]) if rows else COLUMNS
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns, delimiter="\t")
+            writer.writeheader()
+            writer.writerows(rows)
+    print_table(rows, columns)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Stand-in for sacct to test slurm-status.py without a cluster.
+
+Job states come from FAKE_SACCT_STATES, a TSV of jobid<TAB>state[<TAB>exitcode]
+(exitcode defaults to 0:0); jobs not listed there are not reported, like jobs
+sacct does not know. Only `-j id1,id2,...` is interpreted, output is what
+`sacct -n -P -X --format=jobid,state,exitcode` prints. Every call is appended to
+FAKE_SACCT_LOG (if set), so the number of sacct queries can be counted.
+
+    export SACCT=config/rivanna/fake-sacct.py FAKE_SACCT_STATES=states.tsv
+    config/rivanna/slurm-status.py 1001
+"""
+
+import os
+import sys
+
+
+def main(argv):
+    jobids = []
+    for i, arg in enumerate(argv):
+        if arg == "-j" and i + 1 < len(argv):
+            jobids = argv[i + 1].split(",")
+        elif arg.startswith("--jobs="):
+            jobids = arg.split("=", 1)[1].split(",")
+
+    log = os.environ.get("FAKE_SACCT_LOG")
+    if log:
+        with open(log, "a") as f:
+            f.write(" ".join(argv) + "\n")
+
+    states = {}
+    path = os.environ.get("FAKE_SACCT_STATES")
+    if path and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) >= 2:
+                    states[fields[0]] = (
+                        fields[1],
+                        fields[2] if len(fields) > 2 else "0:0",
+                    )
+
+    for jobid in jobids:
+        if jobid in states:
+            print(f"{jobid}|{states[jobid][0]}|{states[jobid][1]}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,17 +1,37 @@
 #!/usr/bin/env python3
 """
 SLURM job status script with successful log archiving.
+
+Status lookups are answered from a cache shared by all concurrent invocations
+(SLURM_STATUS_CACHE, default .snakemake/slurm-status.json). Every job that is
+asked about is tracked there; when the cache is older than SLURM_STATUS_TTL
+seconds (default 30), the invocation holding the lock refreshes it with ONE
+sacct call for all tracked, unfinished jobs, and the others wait for the lock
+and read the fresh result. Finished jobs are dropped from the cache once their
+final state has been reported; a job first seen between two refreshes is
+reported as running until the next one.
+
+SACCT selects the sacct executable (e.g. config/rivanna/fake-sacct.py to test
+without a cluster).
 """
+
 import re
 import subprocess as sp
 import shlex
 import sys
 import time
+import json
+import fcntl
 import logging
+import os
 from pathlib import Path
 
 logger = logging.getLogger("__name__")
 
+SACCT = os.environ.get("SACCT", "sacct")
+CACHE_FILE = Path(os.environ.get("SLURM_STATUS_CACHE", ".snakemake/slurm-status.json"))
+CACHE_TTL = float(os.environ.get("SLURM_STATUS_TTL", "30"))
+
 STATUS_MAP = {
     "BOOT_FAIL": "failed",
     "CANCELLED": "failed",
@@ -28,6 +48,7 @@ STATUS_MAP = {
     "TIMEOUT": "failed",
 }
 
+
 def parse_jobid(jobid):
     """Extract jobid from job string"""
     if not isinstance(jobid, str):
@@ -40,6 +61,7 @@ def parse_jobid(jobid):
             return int(match.groups()[0])
         return jobid
 
+
 def archive_successful_log(jobid):
     """Move successful job logs to successful_jobs directory"""
     try:
@@ -57,36 +79,100 @@ def archive_successful_log(jobid):
     except Exception as e:
         logger.error(f"Error archiving log for job {jobid}: {e}")
 
-def get_status(jobid):
-    """Get status for jobid."""
-    jobid = parse_jobid(jobid)
-    
-    try:
-        sacct_cmd = shlex.split(
-            f"sacct -j {jobid} -n -P -X --format=state,exitcode"
-        )
-        output = sp.check_output(sacct_cmd).decode()
-    except sp.CalledProcessError as e:
-        logger.error(f"sacct error: {e}")
-        return "failed"
-
-    state = ""
+
+def to_status(state, exitcode):
+    """Map a sacct state/exitcode pair to success, running or failed."""
+    if state == "COMPLETED" and exitcode == "0:0":
+        return "success"
+    return STATUS_MAP.get(state, "running")
+
+
+def query_sacct(jobids):
+    """
+    One sacct call for all jobids; returns {jobid: (state, exitcode)}. Jobs
+    sacct does not know (yet) are missing from the result.
+    """
+    sacct_cmd = shlex.split(SACCT) + [
+        "-j",
+        ",".join(str(j) for j in jobids),
+        "-n",
+        "-P",
+        "-X",
+        "--format=jobid,state,exitcode",
+    ]
+    output = sp.check_output(sacct_cmd).decode()
+
+    states = {}
     for line in output.split("\n"):
         if not line.strip():
             continue
-        state, exitcode = line.strip().split("|")[:2]
-        if state == "COMPLETED" and exitcode == "0:0":
-            archive_successful_log(jobid)  # Archive successful job log
-            return "success"
-        if state in STATUS_MAP:
-            return STATUS_MAP[state]
-        return "running"
+        jobid, state, exitcode = line.strip().split("|")[:3]
+        states[str(parse_jobid(jobid))] = (state, exitcode)
+    return states
+
+
+def load_cache(f):
+    f.seek(0)
+    try:
+        cache = json.loads(f.read() or "{}")
+    except ValueError:
+        cache = {}
+    cache.setdefault("queried", 0)
+    cache.setdefault("jobs", {})
+    return cache
+
+
+def save_cache(f, cache):
+    f.seek(0)
+    f.truncate()
+    json.dump(cache, f)
+    f.flush()
+
+
+def refresh(cache):
+    """Re-query every tracked job whose state is not final with one sacct call."""
+    pending = [j for j, entry in cache["jobs"].items() if entry["status"] == "running"]
+    states = query_sacct(pending) if pending else {}
+    for j in pending:
+        # a job sacct does not report counts as failed, as with the per-job query
+        state, exitcode = states.get(j, ("UNKNOWN", ""))
+        cache["jobs"][j] = {
+            "status": "failed" if j not in states else to_status(state, exitcode),
+            "state": state,
+        }
+    cache["queried"] = time.time()
+
+
+def get_status(jobid):
+    """Get status for jobid."""
+    jobid = str(parse_jobid(jobid))
+
+    CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with open(CACHE_FILE, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        cache = load_cache(f)
+        # track the job; until the next refresh an unseen job counts as running
+        entry = cache["jobs"].setdefault(jobid, {"status": "running", "state": ""})
+        if time.time() - cache["queried"] > CACHE_TTL:
+            try:
+                refresh(cache)
+            except sp.CalledProcessError as e:
+                logger.error(f"sacct error: {e}")
+                return "failed"
+            entry = cache["jobs"][jobid]
+        if entry["status"] != "running":
+            # final state: Snakemake does not ask about this job again
+            cache["jobs"].pop(jobid)
+        save_cache(f, cache)
+
+    if entry["status"] == "success":
+        archive_successful_log(jobid)  # Archive successful job log
+    return entry["status"]
 
-    return "failed"
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         print(get_status(sys.argv[1]))
     else:
         print("No jobid provided", file=sys.stderr)
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
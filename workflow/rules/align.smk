@@ -1,72 +1,247 @@
-rule star_align_two_pass:
-    input:
-        sa = join(STAR_INDEX_DIR, "SA"),
-        fixed_gtf=join(REF_DIR, "ref.fixed.gtf"),
-        R1 = rules.cutadapt.output.of1,
-        R2 = rules.cutadapt.output.of2,
-    output:
-        bam = temp(join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.out.bam")),
-        counts = join(RESULTSDIR, "{sample}", "STAR", "{sample}.ReadsPerGene.out.tab"),
-        splice_junctions = join(RESULTSDIR, "{sample}", "STAR", "{sample}.SJ.out.tab"),
-        transcript_sam = join(RESULTSDIR, "{sample}", "STAR", "Aligned.toTranscriptome.out.bam") if config.get("star_save_transcript_sam", False) else join(RESULTSDIR, "{sample}", "STAR", "{sample}.skip_transcript.out"),
-    params:
-        sample = "{sample}",
-        star_index = STAR_INDEX_DIR,
-        tmpdir=f"{TEMPDIR}/{str(uuid.uuid4())}",
-        flanksize = config.get("star_flanksize", 15),
-        alignTranscriptsPerReadNmax = config.get("star_alignTranscriptsPerReadNmax", 30000),
-        out_prefix = join(RESULTSDIR, "{sample}", "STAR", "{sample}."),
-        peorse = get_peorse,
-        quantMode = "TranscriptomeSAM GeneCounts" if config.get("star_save_transcript_sam", False) else "GeneCounts",
-    threads:  _get_threads("star_align_two_pass", profile_config)
-    container: config['containers']['star']
-    shell:
-        r"""
-        set -exo pipefail
-        if [[ "{params.peorse}" == "PE" ]]; then
-            reads="{input.R1} {input.R2}"
-        else
-            reads="{input.R1}"
-        fi
-        STAR \
-            --genomeDir {params.star_index} \
-            --readFilesIn ${{reads}} \
-            --readFilesCommand zcat \
-            --runThreadN {threads} \
-            --sjdbGTFfile {input.fixed_gtf} \
-            --twopassMode Basic \
-            --outFileNamePrefix {params.out_prefix} \
-            --outTmpDir {params.tmpdir} \
-            --outSAMtype BAM Unsorted \
-            --quantMode {params.quantMode} \
-            --outFilterMultimapNmax 20 \
-            --outSJfilterOverhangMin 15 15 15 15 \
-            --alignSJoverhangMin 15 \
-            --alignSJDBoverhangMin 15 \
-            --outFilterScoreMin 1 \
-            --outFilterMatchNmin 1 \
-            --outFilterMismatchNmax 2 \
-            --outFilterMismatchNoverLmax 0.3 \
-            --alignIntronMin 20 \
-            --alignIntronMax 1000000 \
-            --alignMatesGapMax 1000000 \
-            --chimSegmentMin 15 \
-            --chimScoreMin 15 \
-            --chimJunctionOverhangMin {params.flanksize} \
-            --chimScoreJunctionNonGTAG 0 \
-            --chimMultimapNmax 10 \
-            --chimOutType Junctions WithinBAM SoftClip \
-            --alignTranscriptsPerReadNmax {params.alignTranscriptsPerReadNmax} \
-            --alignEndsProtrude 10 ConcordantPair \
-            --outFilterIntronMotifs None \
-            --outSAMstrandField intronMotif
-        outdir=$(dirname {output.bam})
-        ls -alrth $outdir
-        if [ ! -f "{output.transcript_sam}" ]; then
-            touch "{output.transcript_sam}"
-        fi
+# STAR options shared by the per-sample and batched alignment rules
+STAR_FILTER_OPTIONS = " ".join([
+    "--outFilterMultimapNmax 20",
+    "--outSJfilterOverhangMin 15 15 15 15",
+    "--alignSJoverhangMin 15",
+    "--alignSJDBoverhangMin 15",
+    "--outFilterScoreMin 1",
+    "--outFilterMatchNmin 1",
+    "--outFilterMismatchNmax 2",
+    "--outFilterMismatchNoverLmax 0.3",
+    "--alignIntronMin 20",
+    "--alignIntronMax 1000000",
+    "--alignMatesGapMax 1000000",
+    f"--alignTranscriptsPerReadNmax {config.get('star_alignTranscriptsPerReadNmax', 30000)}",
+    "--alignEndsProtrude 10 ConcordantPair",
+    "--outFilterIntronMotifs None",
+])
+STAR_CHIMERIC_OPTIONS = " ".join([
+    "--chimSegmentMin 15",
+    "--chimScoreMin 15",
+    f"--chimJunctionOverhangMin {config.get('star_flanksize', 15)}",
+    "--chimScoreJunctionNonGTAG 0",
+    "--chimMultimapNmax 10",
+    "--chimOutType Junctions WithinBAM SoftClip",
+])
+STAR_QUANT_MODE = "TranscriptomeSAM GeneCounts" if config.get("star_save_transcript_sam", False) else "GeneCounts"
 
-        """
+def _star_transcript_sam(sample):
+    if config.get("star_save_transcript_sam", False):
+        return join(RESULTSDIR, sample, "STAR", "Aligned.toTranscriptome.out.bam")
+    return join(RESULTSDIR, sample, "STAR", f"{sample}.skip_transcript.out")
+
+if not STAR_BATCHES:
+
+    rule star_align_two_pass:
+        input:
+            sa = STAR_INDEX_SA,
+            fixed_gtf=REF_FIXED_GTF,
+            R1 = TRIM_RULE.output.of1,
+            R2 = TRIM_RULE.output.of2,
+        output:
+            bam = pipe(join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.out.bam")) if STREAMING else temp(join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.out.bam")),
+            counts = join(RESULTSDIR, "{sample}", "STAR", "{sample}.ReadsPerGene.out.tab"),
+            splice_junctions = join(RESULTSDIR, "{sample}", "STAR", "{sample}.SJ.out.tab"),
+            transcript_sam = join(RESULTSDIR, "{sample}", "STAR", "Aligned.toTranscriptome.out.bam") if config.get("star_save_transcript_sam", False) else join(RESULTSDIR, "{sample}", "STAR", "{sample}.skip_transcript.out"),
+        benchmark:
+            join(BENCHMARKS_DIR, "star_align_two_pass", "{sample}.tsv")
+        params:
+            sample = "{sample}",
+            star_index = STAR_INDEX_DIR,
+            tmpdir=f"{TEMPDIR}/{str(uuid.uuid4())}",
+            filter_options = STAR_FILTER_OPTIONS,
+            chimeric_options = STAR_CHIMERIC_OPTIONS,
+            out_prefix = join(RESULTSDIR, "{sample}", "STAR", "{sample}."),
+            peorse = get_peorse,
+            quantMode = STAR_QUANT_MODE,
+            # streaming: uncompressed BAM on stdout into the sort_star pipe, no Aligned.out.bam on disk
+            stream_options = "--outStd BAM_Unsorted --outBAMcompression 0" if STREAMING else "",
+            streaming = STREAMING,
+        threads:  _get_threads("star_align_two_pass", profile_config)
+        container: config['containers']['star']
+        shell:
+            r"""
+            set -exo pipefail
+            if [[ "{params.peorse}" == "PE" ]]; then
+                reads="{input.R1} {input.R2}"
+            else
+                reads="{input.R1}"
+            fi
+            if [[ "{params.streaming}" == "True" ]]; then
+                exec 3>{output.bam}
+            else
+                exec 3>&1
+            fi
+            STAR \
+                --genomeDir {params.star_index} \
+                --readFilesIn ${{reads}} \
+                --readFilesCommand zcat \
+                --runThreadN {threads} \
+                --sjdbGTFfile {input.fixed_gtf} \
+                --twopassMode Basic \
+                --outFileNamePrefix {params.out_prefix} \
+                --outTmpDir {params.tmpdir} \
+                --outSAMtype BAM Unsorted \
+                --quantMode {params.quantMode} \
+                {params.filter_options} \
+                {params.chimeric_options} \
+                --outSAMstrandField intronMotif \
+                {params.stream_options} >&3
+            exec 3>&-
+            outdir=$(dirname {output.bam})
+            ls -alrth $outdir
+            if [ ! -f "{output.transcript_sam}" ]; then
+                touch "{output.transcript_sam}"
+            fi
+
+            """
+
+# Batch mode (star_batch_size > 1): one job per batch of samples. STAR's per-sample
+# "--twopassMode Basic" cannot use a shared-memory genome, so the two passes are run
+# explicitly, multi-sample style:
+#   pass 1  the first sample inserts the GTF junctions (--sjdbInsertSave All); the others
+#           align against that saved genome loaded once into shared memory. Only SJ.out.tab is kept.
+#   pass 2  each sample's own pass-1 junctions are inserted into that saved genome, as with
+#           --twopassMode Basic, so per-sample outputs do not depend on the batch.
+# With star_batch_cohort_junctions: true, pass 2 instead inserts GTF + the novel junctions
+# (SJ.out.tab column 6 == 0) of the whole batch with at least star_batch_sj_min_unique
+# uniquely mapped reads in total (multi-sample two-pass) and also runs on one shared-memory
+# genome; a sample's outputs then depend on the samples in its batch. Shared-memory genomes
+# are removed and scratch is deleted on exit, including failures and SLURM cancellation.
+for batch_number, batch in enumerate(STAR_BATCHES, start=1):
+
+    rule:
+        name: f"star_align_batch_{batch_number}"
+        input:
+            sa = STAR_INDEX_SA,
+            fixed_gtf=REF_FIXED_GTF,
+            R1 = expand(TRIM_RULE.output.of1, sample=batch),
+            R2 = expand(TRIM_RULE.output.of2, sample=batch),
+        output:
+            bams = [temp(join(RESULTSDIR, sample, "STAR", f"{sample}.Aligned.out.bam")) for sample in batch],
+            counts = expand(join(RESULTSDIR, "{sample}", "STAR", "{sample}.ReadsPerGene.out.tab"), sample=batch),
+            splice_junctions = expand(join(RESULTSDIR, "{sample}", "STAR", "{sample}.SJ.out.tab"), sample=batch),
+            transcript_sams = [_star_transcript_sam(sample) for sample in batch],
+        benchmark:
+            join(BENCHMARKS_DIR, "star_align_batch", f"batch_{batch_number}.tsv")
+        params:
+            samples = " ".join(batch),
+            r1s = " ".join(expand(TRIM_RULE.output.of1, sample=batch)),
+            r2s = " ".join(expand(TRIM_RULE.output.of2, sample=sample)[0] if SAMPLE_REGISTRY[sample].peorse == "PE" else "-" for sample in batch),
+            out_prefixes = " ".join(join(RESULTSDIR, sample, "STAR", f"{sample}.") for sample in batch),
+            star_index = STAR_INDEX_DIR,
+            tmpdir=f"{TEMPDIR}/{str(uuid.uuid4())}",
+            filter_options = STAR_FILTER_OPTIONS,
+            chimeric_options = STAR_CHIMERIC_OPTIONS,
+            quantMode = STAR_QUANT_MODE,
+            genome_load = config.get("star_batch_genome_load", "LoadAndKeep"),
+            cohort_junctions = _is_true(config.get("star_batch_cohort_junctions", False)),
+            sj_min_unique = config.get("star_batch_sj_min_unique", 1),
+        threads: _get_threads("star_align_two_pass", profile_config)
+        resources:
+            mem_mb = _get_resource("star_align_two_pass", "mem_mb", profile_config),
+            runtime = min(_get_resource("star_align_two_pass", "runtime", profile_config) * len(batch), 10080),
+        container: config['containers']['star']
+        shell:
+            r"""
+            set -exo pipefail
+            samples=({params.samples})
+            r1s=({params.r1s})
+            r2s=({params.r2s})
+            prefixes=({params.out_prefixes})
+            work={params.tmpdir}
+            mkdir -p $work/pass1 $work/pass2
+            genome1=$work/pass1/${{samples[0]}}._STARgenome
+            genome2=$work/pass2/${{samples[0]}}._STARgenome
+
+            release() {{
+                # drop a saved genome from shared memory; no-op if it was never loaded
+                if [[ "{params.genome_load}" != "NoSharedMemory" && -d "$1" ]]; then
+                    STAR --genomeLoad Remove --genomeDir "$1" --outFileNamePrefix $work/remove. || true
+                fi
+            }}
+            cleanup() {{
+                release $genome1
+                if [[ "{params.cohort_junctions}" == "True" ]]; then
+                    release $genome2
+                fi
+                rm -rf $work
+            }}
+            trap cleanup EXIT
+            trap 'exit 143' TERM INT
+
+            reads() {{
+                if [[ "${{r2s[$1]}}" == "-" ]]; then
+                    echo "${{r1s[$1]}}"
+                else
+                    echo "${{r1s[$1]}} ${{r2s[$1]}}"
+                fi
+            }}
+
+            # pass 1: junction discovery
+            for i in "${{!samples[@]}}"; do
+                if [[ $i -eq 0 ]]; then
+                    genome="--genomeDir {params.star_index} --sjdbGTFfile {input.fixed_gtf} --sjdbInsertSave All"
+                else
+                    genome="--genomeDir $genome1 --genomeLoad {params.genome_load}"
+                fi
+                STAR $genome \
+                    --readFilesIn $(reads $i) \
+                    --readFilesCommand zcat \
+                    --runThreadN {threads} \
+                    --outFileNamePrefix $work/pass1/${{samples[$i]}}. \
+                    --outTmpDir $work/tmp.pass1.$i \
+                    --outSAMtype None \
+                    {params.filter_options}
+            done
+            release $genome1
+
+            if [[ "{params.cohort_junctions}" == "True" ]]; then
+                # novel junctions of the batch, uniquely mapped reads summed over samples
+                awk -v min={params.sj_min_unique} 'BEGIN {{OFS = "\t"}} $6 == 0 {{key = $1 OFS $2 OFS $3 OFS $4; n[key] += $7}} END {{for (key in n) if (n[key] >= min) print key}}' \
+                    $work/pass1/*.SJ.out.tab | sort -k1,1 -k2,2n -k3,3n > $work/batch.SJ.out.tab
+                wc -l $work/batch.SJ.out.tab
+            fi
+
+            # pass 2: final alignment; runs in scratch where STAR writes an inserted genome next to its outputs
+            for i in "${{!samples[@]}}"; do
+                if [[ "{params.cohort_junctions}" != "True" ]]; then
+                    # the sample's own pass-1 junctions on top of the GTF-inserted genome
+                    genome="--genomeDir $genome1 --sjdbFileChrStartEnd $work/pass1/${{samples[$i]}}.SJ.out.tab"
+                    prefix=$work/pass2/${{samples[$i]}}.
+                elif [[ $i -eq 0 ]]; then
+                    genome="--genomeDir {params.star_index} --sjdbGTFfile {input.fixed_gtf} --sjdbFileChrStartEnd $work/batch.SJ.out.tab --sjdbInsertSave All"
+                    prefix=$work/pass2/${{samples[$i]}}.
+                else
+                    genome="--genomeDir $genome2 --genomeLoad {params.genome_load}"
+                    prefix=${{prefixes[$i]}}
+                fi
+                STAR $genome \
+                    --readFilesIn $(reads $i) \
+                    --readFilesCommand zcat \
+                    --runThreadN {threads} \
+                    --outFileNamePrefix $prefix \
+                    --outTmpDir $work/tmp.pass2.$i \
+                    --outSAMtype BAM Unsorted \
+                    --quantMode {params.quantMode} \
+                    {params.filter_options} \
+                    {params.chimeric_options} \
+                    --outSAMstrandField intronMotif
+                if [[ "$prefix" != "${{prefixes[$i]}}" ]]; then
+                    for f in $prefix*; do
+                        if [[ "$f" != "${{prefix}}_STARgenome" ]]; then
+                            mv "$f" "${{prefixes[$i]}}${{f#$prefix}}"
+                        fi
+                    done
+                fi
+            done
+
+            for f in {output.transcript_sams}; do
+                if [ ! -f "$f" ]; then
+                    touch "$f"
+                fi
+            done
+            """
 
 rule sort_star:
     input:
@@ -77,14 +252,37 @@ rule sort_star:
         flagstat = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam.flagstat"),
         stats = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam.stats"),
         idxstats = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam.idxstats")
+    benchmark:
+        join(BENCHMARKS_DIR, "sort_star", "{sample}.tsv")
+    params:
+        tmpdir=f"{TEMPDIR}/{str(uuid.uuid4())}",
+        streaming = STREAMING,
     threads: _get_threads("sort_star", profile_config)
     container: config['containers']['samtools']
     shell:
         r"""
         set -exo pipefail
-        samtools sort -@ {threads} -o {output.bam} {input.bam}
-        samtools index -@ {threads} {output.bam}
-        samtools flagstat -@ {threads} {output.bam} > {output.bam}.flagstat
-        samtools stats -@ {threads} {output.bam} > {output.bam}.stats
-        samtools idxstats -@ {threads} {output.bam} > {output.bam}.idxstats
+        if [[ "{params.streaming}" == "True" ]]; then
+            # one pass: the sorted stream is tee'd into flagstat and stats while it is
+            # written and indexed; idxstats then only reads the index
+            mkdir -p {params.tmpdir}
+            trap 'rm -rf {params.tmpdir}' EXIT
+            mkfifo {params.tmpdir}/flagstat.fifo {params.tmpdir}/stats.fifo
+            samtools flagstat -@ {threads} {params.tmpdir}/flagstat.fifo > {output.flagstat} &
+            flagstat_pid=$!
+            samtools stats {params.tmpdir}/stats.fifo > {output.stats} &
+            stats_pid=$!
+            samtools sort -@ {threads} -l 0 -T {output.bam}.tmp -o - {input.bam} \
+                | tee {params.tmpdir}/flagstat.fifo {params.tmpdir}/stats.fifo \
+                | samtools view -@ {threads} -b --write-index -o {output.bam}##idx##{output.bai} -
+            wait $flagstat_pid
+            wait $stats_pid
+            samtools idxstats -@ {threads} {output.bam} > {output.idxstats}
+        else
+            samtools sort -@ {threads} -o {output.bam} {input.bam}
+            samtools index -@ {threads} {output.bam}
+            samtools flagstat -@ {threads} {output.bam} > {output.bam}.flagstat
+            samtools stats -@ {threads} {output.bam} > {output.bam}.stats
+            samtools idxstats -@ {threads} {output.bam} > {output.bam}.idxstats
+        fi
         """
@@ -3,15 +3,30 @@ rule create_index:
         # FASTAS_REGIONS_GTFS
         list(map(lambda x: ancient(x), FASTAS_REGIONS_GTFS)),
     output:
-        genepred_w_geneid = join(REF_DIR, "ref.genes.genepred_w_geneid"),
-        sa = join(STAR_INDEX_DIR, "SA"),
-        fixed_gtf=join(REF_DIR, "ref.fixed.gtf"),
+        genepred_w_geneid = REF_GENEPRED_W_GENEID,
+        sa = STAR_INDEX_SA,
+        fixed_gtf = REF_FIXED_GTF,
+        genepred = REF_GENEPRED,
+        bed12 = REF_BED12,
+        bed = REF_BED,
+    benchmark:
+        join(BENCHMARKS_DIR, "create_index", "create_index.tsv")
     params:
         reffa=REF_FA,
         refgtf=REF_GTF,
         refdir=REF_DIR,
+        stardir=STAR_INDEX_DIR,
+        fixed_gtf=join(REF_DIR, "ref.fixed.gtf"),
+        genepred_w_geneid=join(REF_DIR, "ref.genes.genepred_w_geneid"),
+        genepred=join(REF_DIR, "ref.genes.genepred"),
+        bed12=join(REF_DIR, "ref.genes.bed12"),
+        bed=join(REF_DIR, "ref.genes.bed"),
+        tmpdir=f"{TEMPDIR}/{str(uuid.uuid4())}",
+        store=bool(REFERENCE_STORE),
         script1=join(SCRIPTS_DIR, "_fix_gtf.py"),
         script2=join(SCRIPTS_DIR, "_add_geneid_to_genepred.py"),
+        script3=join(SCRIPTS_DIR, "_annotation_index.py"),
+        annotation_cache=ANNOTATION_INDEX_DIR,
     container: config['containers']['star_ucsc_cufflinks']
     # threads: getthreads("create_index")
     # threads: 1
@@ -19,19 +34,51 @@ rule create_index:
         """
 set -exo pipefail
 cd {params.refdir}
-samtools faidx {params.reffa} && \\
-    cut -f1-2 {params.reffa}.fai > {params.reffa}.sizes
+# ref/ may be a reference_store entry shared with other projects: one build per entry at a
+# time, and an entry that another project has already finished is not built again
+exec 9>{params.refdir}/.create_index.lock
+flock 9
+if [ "{params.store}" == "True" ] && [ -f .create_index.done ]; then
+    echo "{params.refdir} is already built, not building it again"
+else
+    samtools faidx {params.reffa} && \\
+        cut -f1-2 {params.reffa}.fai > {params.reffa}.sizes
+
+    python -E {params.script1} --ingtf {params.refgtf} --outgtf {params.fixed_gtf}
+    python -E {params.script3} --gtf {params.fixed_gtf} --cache_dir {params.annotation_cache}
+    gtfToGenePred -ignoreGroupsWithoutExons {params.fixed_gtf} {params.genepred} && \\
+        python -E {params.script2} {params.fixed_gtf} {params.genepred} > {params.genepred_w_geneid}
+    genePredToBed {params.genepred} {params.bed12}
+
+    # exon BED used by infer_strandedness and bam_qc
+    mkdir -p {params.tmpdir}
+    gffread {params.fixed_gtf} -T -o {params.tmpdir}/temp.gtf
+    awk '$3 == "exon" {{
+        gsub(/[";]/, "", $10);
+        print $1"\\t"($4-1)"\\t"$5"\\t"$10"\\t0\\t"$7
+    }}' {params.tmpdir}/temp.gtf > {params.bed}
+    rm -rf {params.tmpdir}
+
+    mkdir -p {params.stardir} && \\
+    STAR \\
+        --runThreadN {threads} \\
+        --runMode genomeGenerate \\
+        --genomeDir {params.stardir} \\
+        --genomeFastaFiles {params.reffa}
 
-python -E {params.script1} --ingtf {params.refgtf} --outgtf {output.fixed_gtf}
-gtfToGenePred -ignoreGroupsWithoutExons {output.fixed_gtf} ref.genes.genepred && \\
-    python -E {params.script2} {output.fixed_gtf} ref.genes.genepred > {output.genepred_w_geneid}
+    touch .create_index.done
+fi
+exec 9>&-
 
-stardir=$(dirname {output.sa})
-mkdir -p $stardir && \\
-STAR \\
-    --runThreadN {threads} \\
-    --runMode genomeGenerate \\
-    --genomeDir $stardir \\
-    --genomeFastaFiles {params.reffa}
+# with reference_store the outputs are project-local links into the store entry
+if [ "{params.store}" == "True" ]; then
+    mkdir -p $(dirname {output.sa})
+    ln -sfn {params.fixed_gtf} {output.fixed_gtf}
+    ln -sfn {params.genepred_w_geneid} {output.genepred_w_geneid}
+    ln -sfn {params.genepred} {output.genepred}
+    ln -sfn {params.bed12} {output.bed12}
+    ln -sfn {params.bed} {output.bed}
+    ln -sfn {params.stardir}/SA {output.sa}
+fi
 
 """
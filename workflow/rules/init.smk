@@ -19,33 +19,156 @@ def _convert_to_int(variable):
 
 ###################################################################################
 
+def _bulk_copy(infile, outfile):
+    """Append infile to outfile with in-kernel copies (sendfile), 16 MiB buffers as fallback."""
+    size = os.fstat(infile.fileno()).st_size
+    offset = 0
+    try:
+        while offset < size:
+            sent = os.sendfile(outfile.fileno(), infile.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    except OSError:
+        if offset:
+            raise
+        shutil.copyfileobj(infile, outfile, 1 << 24)
+
 def append_files_in_list(flist, ofile):
     if not os.path.exists(ofile):
-        print("FILE %s does not exist! Creating it!"%(ofile),flush=True)
-        with open(ofile, "w") as outfile:
-            for fname in flist:
-                with open(fname) as infile:
-                    for line in infile:
-                        outfile.write(line)
+        # ofile may live in a shared reference store: build it once, under a lock, atomically
+        with open(join(os.path.dirname(ofile), f".{os.path.basename(ofile)}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(ofile):
+                print("FILE %s does not exist! Creating it!"%(ofile),flush=True)
+                tmp = f"{ofile}.{os.getpid()}.tmp"
+                with open(tmp, "wb", buffering=0) as outfile:
+                    for fname in flist:
+                        with open(fname, "rb") as infile:
+                            _bulk_copy(infile, outfile)
+                os.replace(tmp, ofile)
     return True
 
 ###################################################################################
 
+def _link_reference_store(store, sources, ref_dir):
+    """
+    Point ref_dir at <store>/<key>, where key hashes the names and contents of the
+    selected FASTA/regions/GTF files, so projects with the same references share one
+    ref/ (ref.fa, ref.fixed.gtf, STAR index, ...). Content hashes are cached in the
+    store by path/size/mtime. A ref_dir that already holds a local build is kept.
+    """
+    os.makedirs(store, exist_ok=True)
+    digest = hashlib.sha256()
+    for source in sources:
+        digest.update(f"{os.path.basename(source)}\0{file_content_hash(source, store)}\n".encode())
+    entry = join(store, digest.hexdigest()[:20])
+    os.makedirs(entry, exist_ok=True)
+    if not os.path.exists(join(entry, "sources.txt")):
+        with open(join(entry, "sources.txt"), "w") as f:
+            f.write("\n".join(os.path.realpath(source) for source in sources) + "\n")
+
+    if os.path.isdir(ref_dir) and not os.path.islink(ref_dir):
+        if os.listdir(ref_dir):
+            print(f"⚠️ WARNING: {ref_dir} holds a local reference build; not linking it to {entry}")
+            return ref_dir
+        os.rmdir(ref_dir)
+    if not os.path.islink(ref_dir) or os.readlink(ref_dir) != entry:
+        tmp = f"{ref_dir}.{os.getpid()}.tmp"
+        os.symlink(entry, tmp)
+        os.replace(tmp, ref_dir)
+        print(f"{ref_dir} -> {entry}")
+
+    # another project may be running create_index for this entry. Do not wait here: every
+    # cluster job parses the workflow again, and create_index takes the lock itself
+    if not os.path.exists(join(entry, ".create_index.done")):
+        with open(join(entry, ".create_index.lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print(f"Another project is building {entry}; create_index will wait for it", flush=True)
+    return entry
+
+###################################################################################
+
+def _file_fingerprints(paths):
+    """path -> [size, mtime_ns] for each path (None if it does not exist)."""
+    fingerprints = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            fingerprints[path] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            fingerprints[path] = None
+    return fingerprints
+
+def _fingerprints_hash(fingerprints):
+    return hashlib.sha256(json.dumps(fingerprints, sort_keys=True).encode()).hexdigest()
+
+def _validation_is_current(manifest_file, check, paths):
+    """
+    True if `check` already passed for exactly these files (same paths, sizes and
+    mtimes) as recorded by _record_validation. Only stat() calls, no file reads.
+    """
+    try:
+        with open(manifest_file) as f:
+            entry = json.load(f).get(check)
+    except (OSError, ValueError):
+        return False
+    return entry is not None and entry["hash"] == _fingerprints_hash(_file_fingerprints(paths))
+
+def _record_validation(manifest_file, check, paths):
+    """
+    Record that `check` passed for paths in the validation manifest. Concurrent
+    parses (e.g. cluster jobs) take turns, so no update is lost.
+    """
+    fingerprints = _file_fingerprints(paths)
+    try:
+        with open(f"{manifest_file}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(manifest_file) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                manifest = {}
+            manifest[check] = {"hash": _fingerprints_hash(fingerprints), "files": fingerprints}
+            tmp = f"{manifest_file}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(manifest, f, indent=1)
+            os.replace(tmp, manifest_file)
+    except OSError as e:
+        print(f"⚠️ WARNING: could not update {manifest_file}: {e}")
+
+###################################################################################
+
+class SampleRecord:
+    """One samplesheet row; SAMPLE_REGISTRY maps sampleName -> SampleRecord."""
+    __slots__ = ("name", "group", "r1", "r2", "peorse")
+
+    def __init__(self, name, group, r1, r2, peorse):
+        self.name = name
+        self.group = group
+        self.r1 = r1
+        self.r2 = r2
+        self.peorse = peorse
+
+###################################################################################
+
 def get_peorse(wildcards):
-    peorse = SAMPLESDF.loc[SAMPLESDF['sampleName'] == wildcards.sample, 'PEorSE'].values[0]
+    peorse = SAMPLE_REGISTRY[wildcards.sample].peorse
     return peorse
 
 ###################################################################################
 
 def get_fastqs(wildcards):
     d = dict()
-    peorse = SAMPLESDF.loc[SAMPLESDF['sampleName'] == wildcards.sample, 'PEorSE'].values[0]
-    # print(f"peorse: {peorse}")
-    if peorse == "PE":
-        d["R1"] = SAMPLESDF.loc[SAMPLESDF['sampleName'] == wildcards.sample, 'path_to_R1_fastq'].values[0]
-        d["R2"] = SAMPLESDF.loc[SAMPLESDF['sampleName'] == wildcards.sample, 'path_to_R2_fastq'].values[0]
+    record = SAMPLE_REGISTRY[wildcards.sample]
+    # print(f"peorse: {record.peorse}")
+    if record.peorse == "PE":
+        d["R1"] = record.r1
+        d["R2"] = record.r2
     else:
-        d["R1"] = SAMPLESDF.loc[SAMPLESDF['sampleName'] == wildcards.sample, 'path_to_R1_fastq'].values[0]
+        d["R1"] = record.r1
         d["R2"] = DUMMYFILE
 
     # print(f"sample: {wildcards.sample}")
@@ -68,6 +191,19 @@ def _get_threads(rule_name, profile_config):
         return profile_config["set-resources"][rule_name]["threads"]
     return profile_config["default-resources"]["threads"]
 
+def _get_resource(rule_name, key, profile_config):
+    """
+    Return resource `key` (mem_mb, runtime, ...) for a rule from profile_config.
+    Falls back to default-resources.
+    """
+    if (
+        "set-resources" in profile_config
+        and rule_name in profile_config["set-resources"]
+        and key in profile_config["set-resources"][rule_name]
+    ):
+        return profile_config["set-resources"][rule_name][key]
+    return profile_config["default-resources"][key]
+
 ## Load cluster.json
 # with open(config["cluster"]) as json_file:
 #     CLUSTER = yaml.safe_load(json_file)
@@ -126,11 +262,9 @@ RESOURCES_DIR = config["resourcesdir"]
 FASTAS_GTFS_DIR = config["fastas_gtfs_dir"]
 
 REF_DIR = join(WORKDIR, "ref")
-if not os.path.exists(REF_DIR):
-    os.mkdir(REF_DIR)
 STAR_INDEX_DIR = join(REF_DIR, "STAR_no_GTF")
-if not os.path.exists(STAR_INDEX_DIR):
-    os.mkdir(STAR_INDEX_DIR)
+# shared, content-addressed store that ref/ is linked into (empty: build ref/ in WORKDIR)
+REFERENCE_STORE = str(config.get("reference_store", "") or "").strip().rstrip(r"\/")
 
 # strip trailing slashes if any
 for varname in [
@@ -139,6 +273,11 @@ for varname in [
 ]:
     globals()[varname] = globals()[varname].rstrip(r"\/")
 
+# helper modules shared with workflow/scripts
+sys.path.insert(0, SCRIPTS_DIR)
+from _annotation_index import file_content_hash, load_annotation_index
+from _matrix_io import HAVE_PYARROW, companion_path
+
 HOST = config["host"].strip()  # hg38 or mm39
 ADDITIVES = config["additives"].strip()  # ERCC and/or BAC16Insert
 ADDITIVES = ADDITIVES.replace(" ", "")
@@ -189,6 +328,22 @@ GTFS = [join(FASTAS_GTFS_DIR, f + ".gtf") for f in HOST_ADDITIVES_VIRUSES]
 FASTAS_REGIONS_GTFS = FASTAS.copy()
 FASTAS_REGIONS_GTFS.extend(REGIONS)
 FASTAS_REGIONS_GTFS.extend(GTFS)
+
+if REFERENCE_STORE:
+    _link_reference_store(REFERENCE_STORE, FASTAS_REGIONS_GTFS, REF_DIR)
+if not os.path.exists(REF_DIR):
+    os.mkdir(REF_DIR)
+if not os.path.exists(STAR_INDEX_DIR):
+    os.mkdir(STAR_INDEX_DIR)
+# outputs of create_index; with reference_store they are project-local links into the store
+# entry, so Snakemake never deletes or rebuilds files that other projects may be using
+REF_LINKS_DIR = join(WORKDIR, "ref_links") if REFERENCE_STORE else REF_DIR
+REF_FIXED_GTF = join(REF_LINKS_DIR, "ref.fixed.gtf")
+REF_GENEPRED_W_GENEID = join(REF_LINKS_DIR, "ref.genes.genepred_w_geneid")
+REF_GENEPRED = join(REF_LINKS_DIR, "ref.genes.genepred")
+REF_BED12 = join(REF_LINKS_DIR, "ref.genes.bed12")
+REF_BED = join(REF_LINKS_DIR, "ref.genes.bed")
+STAR_INDEX_SA = join(REF_LINKS_DIR, "STAR_no_GTF", "SA")
 EGS = join(FASTAS_GTFS_DIR, "effectiveGenomeSizes.tsv")
 
 print("FASTAS_REGIONS_GTFS: ", FASTAS_REGIONS_GTFS)
@@ -199,55 +354,65 @@ REF_REGIONS_HOST = join(REF_DIR, "ref.fa.regions.host")
 REF_REGIONS_VIRUSES = join(REF_DIR, "ref.fa.regions.viruses")
 REF_REGIONS_HOST_VIRUSES = join(REF_DIR, "ref.fa.regions.host_viruses")
 REF_GTF = join(REF_DIR, "ref.gtf")
+# parsed, content-hashed GTF tables shared by init.smk and workflow/scripts (see _annotation_index.py)
+ANNOTATION_INDEX_DIR = join(REF_DIR, "annotation_index")
+# fingerprints (path/size/mtime) of inputs that already passed the checks below, so that
+# re-parsing the workflow (e.g. in every cluster job) skips the validation scans; kept in
+# WORKDIR, not in ref/, which may be a reference_store entry shared by other projects
+VALIDATION_MANIFEST = join(WORKDIR, "validation_manifest.json")
 append_files_in_list(FASTAS, REF_FA)
 append_files_in_list(REGIONS, REF_REGIONS)
 
 ###################################################################################################
 # check if sequence IDs are unique for unique genome names
 
-print("Validating ref.regions file for unique genome names and sequence IDs...")
-input_file = REF_REGIONS
-
-seqid_to_genomes = defaultdict(set)
-seen_genomes = set()
-duplicate_genomes = set()
-
-with open(input_file) as f:
-    for line_number, line in enumerate(f, 1):
-        line = line.strip()
-        if not line:
-            continue
-        parts = line.split()
-        genome = parts[0]
-        seq_ids = parts[1:]
-
-        # Check for repeated genome names
-        if genome in seen_genomes:
-            duplicate_genomes.add(genome)
-        seen_genomes.add(genome)
-
-        # Track which genomes each sequence ID appears under
-        for seq in seq_ids:
-            seqid_to_genomes[seq].add(genome)
-
-# Detect conflicts in sequence IDs
-conflicts = {seq: genomes for seq, genomes in seqid_to_genomes.items() if len(genomes) > 1}
-
-# Report issues
-if duplicate_genomes:
-    print("\n❌ The following genome names are repeated:")
-    for g in sorted(duplicate_genomes):
-        print(f"  {g}")
-
-if conflicts:
-    print("\n❌ The following sequence IDs are assigned to multiple genomes:")
-    for seq, genomes in sorted(conflicts.items()):
-        print(f"  {seq}: {', '.join(sorted(genomes))}")
-
-if not duplicate_genomes and not conflicts:
-    print("\n✅ All genome names are unique and sequence IDs are uniquely assigned.")
+if _validation_is_current(VALIDATION_MANIFEST, "regions", REGIONS + [REF_REGIONS]):
+    print("✅ ref.fa.regions unchanged since last validation.")
 else:
-    sys.exit(1)
+    print("Validating ref.regions file for unique genome names and sequence IDs...")
+    input_file = REF_REGIONS
+
+    seqid_to_genomes = defaultdict(set)
+    seen_genomes = set()
+    duplicate_genomes = set()
+
+    with open(input_file) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            parts = line.split()
+            genome = parts[0]
+            seq_ids = parts[1:]
+
+            # Check for repeated genome names
+            if genome in seen_genomes:
+                duplicate_genomes.add(genome)
+            seen_genomes.add(genome)
+
+            # Track which genomes each sequence ID appears under
+            for seq in seq_ids:
+                seqid_to_genomes[seq].add(genome)
+
+    # Detect conflicts in sequence IDs
+    conflicts = {seq: genomes for seq, genomes in seqid_to_genomes.items() if len(genomes) > 1}
+
+    # Report issues
+    if duplicate_genomes:
+        print("\n❌ The following genome names are repeated:")
+        for g in sorted(duplicate_genomes):
+            print(f"  {g}")
+
+    if conflicts:
+        print("\n❌ The following sequence IDs are assigned to multiple genomes:")
+        for seq, genomes in sorted(conflicts.items()):
+            print(f"  {seq}: {', '.join(sorted(genomes))}")
+
+    if not duplicate_genomes and not conflicts:
+        print("\n✅ All genome names are unique and sequence IDs are uniquely assigned.")
+    else:
+        sys.exit(1)
+    _record_validation(VALIDATION_MANIFEST, "regions", REGIONS + [REF_REGIONS])
 
 ###################################################################################################
 
@@ -256,52 +421,40 @@ append_files_in_list(REGIONS_HOST, REF_REGIONS_HOST)
 append_files_in_list(REGIONS_HOST + REGIONS_VIRUSES, REF_REGIONS_HOST_VIRUSES)
 append_files_in_list(REGIONS_VIRUSES, REF_REGIONS_VIRUSES)
 
-if not os.path.exists(REF_GTF):
+if not os.path.exists(REF_GTF) and not _validation_is_current(VALIDATION_MANIFEST, "gtfs", GTFS):
 
     ###################################################################################################
     # check if gene_id and gene_name are unique across GTF files
 
     print("Validating GTF files for unique gene_id and gene_name...")
-    # Extract gene_id and gene_name from attribute string
-    def parse_attributes(attr_string):
-        gene_id = gene_name = None
-        matches = re.findall(r'(\S+)\s+"([^"]+)"', attr_string)
-        for key, val in matches:
-            if key == "gene_id":
-                gene_id = val
-            elif key == "gene_name":
-                gene_name = val
-        return gene_id, gene_name
-
+    # gene tables come from the cached annotation index of each source GTF
     # Dicts to track where each ID was found
     gene_id_to_file = {}
     gene_name_to_file = {}
+    gtf_collisions = False
 
     # Read GTF files from command line arguments
     gtf_files = GTFS
 
     for gtf_file in gtf_files:
-        with open(gtf_file) as f:
-            for line in f:
-                if line.startswith("#"):
-                    continue
-                cols = line.strip().split("\t")
-                if len(cols) < 9 or cols[2] != "gene":
-                    continue
-                attr_string = cols[8]
-                gene_id, gene_name = parse_attributes(attr_string)
-
-                if gene_id:
-                    if gene_id in gene_id_to_file and gene_id_to_file[gene_id] != gtf_file:
-                        print(f"❌ gene_id '{gene_id}' found in both '{gene_id_to_file[gene_id]}' and '{gtf_file}'")
-                    gene_id_to_file[gene_id] = gtf_file
-
-                if gene_name:
-                    if gene_name in gene_name_to_file and gene_name_to_file[gene_name] != gtf_file:
-                        print(f"❌ gene_name '{gene_name}' found in both '{gene_name_to_file[gene_name]}' and '{gtf_file}'")
-                    gene_name_to_file[gene_name] = gtf_file
+        genes = load_annotation_index(gtf_file, ANNOTATION_INDEX_DIR).table("genes")
+        for gene_id, gene_name in zip(genes["gene_id"], genes["gene_name"]):
+            if gene_id:
+                if gene_id in gene_id_to_file and gene_id_to_file[gene_id] != gtf_file:
+                    print(f"❌ gene_id '{gene_id}' found in both '{gene_id_to_file[gene_id]}' and '{gtf_file}'")
+                    gtf_collisions = True
+                gene_id_to_file[gene_id] = gtf_file
+
+            if gene_name:
+                if gene_name in gene_name_to_file and gene_name_to_file[gene_name] != gtf_file:
+                    print(f"❌ gene_name '{gene_name}' found in both '{gene_name_to_file[gene_name]}' and '{gtf_file}'")
+                    gtf_collisions = True
+                gene_name_to_file[gene_name] = gtf_file
 
     print("✅ Done checking gene_id and gene_name uniqueness across GTF files.")
+    # only a clean result is cached, so collisions are reported again on every parse
+    if not gtf_collisions:
+        _record_validation(VALIDATION_MANIFEST, "gtfs", GTFS)
 
 ###################################################################################################
 
@@ -336,11 +489,19 @@ if (SAMPLESDF['groupName'].str.strip() == "").any():
     raise ValueError("Some sampleNames have empty groupName!")
 
 # Step 4: Check if files in R1 and R2 paths exist and are readable
+@lru_cache(maxsize=None)
 def check_file(path):
     return path != "" and os.path.isfile(path) and os.access(path, os.R_OK)
 
-SAMPLESDF['R1_exists'] = SAMPLESDF['path_to_R1_fastq'].apply(check_file)
-SAMPLESDF['R2_exists'] = SAMPLESDF['path_to_R2_fastq'].apply(check_file)
+def check_files(paths, workers=32):
+    """check_file over many paths; the stat calls overlap, which matters on network filesystems."""
+    unique = list(dict.fromkeys(paths))
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(unique)))) as pool:
+        found = dict(zip(unique, pool.map(check_file, unique)))
+    return [found[path] for path in paths]
+
+SAMPLESDF['R1_exists'] = check_files(SAMPLESDF['path_to_R1_fastq'].tolist())
+SAMPLESDF['R2_exists'] = check_files(SAMPLESDF['path_to_R2_fastq'].tolist())
 
 if not SAMPLESDF['R1_exists'].all():
     raise FileNotFoundError("Some R1 files are missing or not readable.")
@@ -351,26 +512,38 @@ if not SAMPLESDF['R1_exists'].all():
 SAMPLESDF['PEorSE'] = SAMPLESDF['path_to_R2_fastq'].apply(lambda x: x.strip() != "")
 SAMPLESDF['PEorSE'] = SAMPLESDF['PEorSE'].apply(lambda x: "PE" if x else "SE")
 
-# Step 6: Create SAMPLENAME2GROUPNAME
-SAMPLENAME2GROUPNAME = dict(zip(SAMPLESDF['sampleName'], SAMPLESDF['groupName']))
+# Step 6: Build the sample registry used by the input functions (one dict lookup per job)
+SAMPLE_REGISTRY = {
+    name: SampleRecord(name, group, r1, r2, peorse)
+    for name, group, r1, r2, peorse in zip(
+        SAMPLESDF['sampleName'], SAMPLESDF['groupName'], SAMPLESDF['path_to_R1_fastq'],
+        SAMPLESDF['path_to_R2_fastq'], SAMPLESDF['PEorSE'],
+    )
+}
 
-# Step 7: Create GROUPNAME2SAMPLENAME
+# Step 7: Create SAMPLENAME2GROUPNAME
+SAMPLENAME2GROUPNAME = {name: record.group for name, record in SAMPLE_REGISTRY.items()}
+
+# Step 8: Create GROUPNAME2SAMPLENAME
 from collections import defaultdict
 GROUPNAME2SAMPLENAME = defaultdict(list)
-for sample, group in zip(SAMPLESDF['sampleName'], SAMPLESDF['groupName']):
-    GROUPNAME2SAMPLENAME[group].append(sample)
+for sample, record in SAMPLE_REGISTRY.items():
+    GROUPNAME2SAMPLENAME[record.group].append(sample)
 
-# Step 8: Create SAMPLENAMEISPE
-SAMPLENAMEISPE = dict(zip(SAMPLESDF['sampleName'], SAMPLESDF['PEorSE']))
+# Step 9: Create SAMPLENAMEISPE
+SAMPLENAMEISPE = {name: record.peorse for name, record in SAMPLE_REGISTRY.items()}
 
 # Optional: print or return results
-print("SAMPLENAME2GROUPNAME:", SAMPLENAME2GROUPNAME)
-print("GROUPNAME2SAMPLENAME:", dict(GROUPNAME2SAMPLENAME))
-print("SAMPLENAMEISPE:", SAMPLENAMEISPE)
-
-
-print("SAMPLESDF:\n", SAMPLESDF)
-print("SAMPLES:\n", SAMPLES)
+# the full sample tables are only printed when the samplesheet changed
+if _validation_is_current(VALIDATION_MANIFEST, "samples", [MANIFEST_FILE]):
+    print(f"✅ {MANIFEST_FILE}: {len(SAMPLES)} samples, unchanged since last validation.")
+else:
+    print("SAMPLENAME2GROUPNAME:", SAMPLENAME2GROUPNAME)
+    print("GROUPNAME2SAMPLENAME:", dict(GROUPNAME2SAMPLENAME))
+    print("SAMPLENAMEISPE:", SAMPLENAMEISPE)
+    print("SAMPLESDF:\n", SAMPLESDF)
+    print("SAMPLES:\n", SAMPLES)
+    _record_validation(VALIDATION_MANIFEST, "samples", [MANIFEST_FILE])
 
 DUMMYFILE = join(RESOURCES_DIR, "dummy")
 RESULTSDIR = join(WORKDIR, "results")
@@ -395,6 +568,11 @@ DIFFEX_HOST = _normalize_species_label(config.get('host'))
 INFER_STRANDEDNESS = str(config.get("infer_strandedness", "true")).lower()
 INFER_FRACTION_THRESHOLD = config.get("infer_strandedness_threshold", 0.8)
 STRANDEDNESS_COLUMN = config.get("strandedness_column", "strandedness")
+INFER_STRANDEDNESS_METHOD = str(config.get("infer_strandedness_method", "star")).lower()
+if INFER_STRANDEDNESS_METHOD not in {"star", "rseqc"}:
+    raise ValueError(f"Invalid infer_strandedness_method '{INFER_STRANDEDNESS_METHOD}' ... Valid values are: star, rseqc.")
+# RSeQC infer_experiment.py is needed for rseqc inference, otherwise it is an optional cross-check
+RUN_RSEQC_INFER_EXPERIMENT = INFER_STRANDEDNESS_METHOD == "rseqc" or _is_true(config.get("rseqc_infer_experiment", False))
 if INFER_STRANDEDNESS == "false":
     # samplesdf then needs to have a column called "strandedness"
     if STRANDEDNESS_COLUMN not in SAMPLESDF.columns:
@@ -404,3 +582,97 @@ if INFER_STRANDEDNESS == "false":
     invalid_values = set(SAMPLESDF[STRANDEDNESS_COLUMN].unique()) - valid_values
     if invalid_values:
         raise ValueError(f"Invalid values in column '{STRANDEDNESS_COLUMN}': {', '.join(invalid_values)} ... Valid values are: {', '.join(valid_values)}.")
+
+# single-pass replacement for RSeQC read_distribution/infer_experiment/junction_annotation
+BAM_QC_ENGINE = str(config.get("bam_qc_engine", "rseqc")).lower()
+if BAM_QC_ENGINE not in {"rseqc", "harold"}:
+    raise ValueError(f"Invalid bam_qc_engine '{BAM_QC_ENGINE}' ... Valid values are: rseqc, harold.")
+
+# native replacement for RSeQC FPKM_count.py + _rseqc_fpkm_add_tpm.py in rseqc_fpkm
+TRANSCRIPT_QUANT_ENGINE = str(config.get("transcript_quant_engine", "rseqc")).lower()
+if TRANSCRIPT_QUANT_ENGINE not in {"rseqc", "harold"}:
+    raise ValueError(f"Invalid transcript_quant_engine '{TRANSCRIPT_QUANT_ENGINE}' ... Valid values are: rseqc, harold.")
+
+# single-pass replacement for bam_to_bigwig (deepTools bamCoverage on every species BAM)
+BIGWIG_ENGINE = str(config.get("bigwig_engine", "deeptools")).lower()
+if BIGWIG_ENGINE not in {"deeptools", "harold"}:
+    raise ValueError(f"Invalid bigwig_engine '{BIGWIG_ENGINE}' ... Valid values are: deeptools, harold.")
+if BIGWIG_ENGINE == "harold" and str(config.get("deeptools_normalize", "RPKM")) not in {"CPM", "RPKM", "None"}:
+    raise ValueError(f"deeptools_normalize '{config.get('deeptools_normalize')}' is not supported by bigwig_engine harold ... Valid values are: CPM, RPKM, None.")
+BIGWIG_STRANDED = _is_true(config.get("bigwig_stranded", False))
+if BIGWIG_STRANDED and BIGWIG_ENGINE != "harold":
+    raise ValueError("bigwig_stranded needs bigwig_engine: harold.")
+
+# gene length definition for the gene-level RPKM/TPM (see GENE_LENGTH_COLUMNS in _annotation_index.py)
+GENE_LENGTH = str(config.get("gene_length", "longest")).lower()
+if GENE_LENGTH not in {"longest", "union", "mean"}:
+    raise ValueError(f"Invalid gene_length '{GENE_LENGTH}' ... Valid values are: longest, union, mean.")
+
+# kraken2 contamination screen: full classifies every read, screen a sampled subset of reads
+# (pairs kept together) against the memory-mapped database
+KRAKEN2_MODE = str(config.get("kraken2_mode", "full")).lower()
+if KRAKEN2_MODE not in {"full", "screen"}:
+    raise ValueError(f"Invalid kraken2_mode '{KRAKEN2_MODE}' ... Valid values are: full, screen.")
+KRAKEN2_RULE = "kraken2_screen" if KRAKEN2_MODE == "screen" else "kraken2"
+KRAKEN2_SCREEN_READS = int(config.get("kraken2_screen_reads", 1000000))
+KRAKEN2_SCREEN_SAMPLING = str(config.get("kraken2_screen_sampling", "reservoir")).lower()
+if KRAKEN2_SCREEN_SAMPLING not in {"reservoir", "head"}:
+    raise ValueError(f"Invalid kraken2_screen_sampling '{KRAKEN2_SCREEN_SAMPLING}' ... Valid values are: reservoir, head.")
+
+# per-sample TIN mean/median table for MultiQC, written next to aggregate_tin.tsv
+TIN_SUMMARY = _is_true(config.get("tin_summary", True))
+
+# typed .parquet companions next to the results/counts matrices (see _matrix_io.py); the
+# matrices are written by local rules, so pyarrow must be importable here for the
+# companions to be declared as outputs
+BINARY_MATRICES = _is_true(config.get("binary_matrices", True))
+if BINARY_MATRICES and not HAVE_PYARROW:
+    print("⚠️ WARNING: binary_matrices is set but pyarrow is not installed; only the TSV matrices will be written")
+    BINARY_MATRICES = False
+PARQUET_ARG = "--parquet" if BINARY_MATRICES else "--no-parquet"
+
+def _matrix_outputs(*tsvs):
+    """The .parquet companions of tsvs, when binary_matrices is on."""
+    return [companion_path(tsv) for tsv in tsvs] if BINARY_MATRICES else []
+
+# per-sample shards reused by the cohort aggregation rules (see _sample_shards.py)
+SHARD_ARG = "--shard_cache " + join(RESULTSDIR, "counts", ".shards") if _is_true(config.get("incremental_aggregation", True)) else ""
+
+# opt-in batched STAR: align star_batch_size samples per job against one shared-memory genome
+STAR_BATCH_SIZE = int(config.get("star_batch_size", 0) or 0)
+STAR_BATCHES = [SAMPLES[i:i + STAR_BATCH_SIZE] for i in range(0, len(SAMPLES), STAR_BATCH_SIZE)] if STAR_BATCH_SIZE > 1 else []
+
+# opt-in cutadapt scatter/gather: split each sample into cutadapt_chunks byte-balanced chunks,
+# trim them as separate jobs and concatenate the gzip outputs (0 or 1 = one cutadapt job per sample)
+CUTADAPT_CHUNKS = int(config.get("cutadapt_chunks", 0) or 0)
+if CUTADAPT_CHUNKS < 0:
+    raise ValueError(f"Invalid cutadapt_chunks '{CUTADAPT_CHUNKS}' ... Valid values are: 0 or a positive number of chunks.")
+
+# opt-in streaming: STAR -> sort_star through a pipe, uncompressed cutadapt -> fastq-filter intermediates
+STREAMING = _is_true(config.get("streaming", False))
+
+# per-rule Snakemake benchmarks, collected into the resource history on completion
+# (_resource_history.py); resource_sizing: history sizes the cluster profile from it
+BENCHMARKS_DIR = join(WORKDIR, "logs", "benchmarks")
+RESOURCE_HISTORY = config.get("resource_history") or join(WORKDIR, "stats", "resource_history.tsv")
+RESOURCE_SIZING = str(config.get("resource_sizing", "static")).lower()
+if RESOURCE_SIZING not in {"static", "history"}:
+    raise ValueError(f"Invalid resource_sizing '{RESOURCE_SIZING}' ... Valid values are: static, history.")
+
+def _collect_resource_history():
+    """Append this run's benchmark records to RESOURCE_HISTORY; never fails the run."""
+    import subprocess
+
+    if not os.path.isdir(BENCHMARKS_DIR):
+        return
+    try:
+        subprocess.run(
+            [sys.executable, join(SCRIPTS_DIR, "_resource_history.py"), "collect",
+             "--benchmarks", BENCHMARKS_DIR, "--history", RESOURCE_HISTORY],
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"⚠️ WARNING: resource history not updated: {e}")
+
+# RSeQC tin.py/geneBody_coverage.py on ref.genes.bed12 shards (0 = 4 shards per thread, 1 = unsharded)
+RSEQC_SHARDS = int(config.get("rseqc_shards", 0) or 0)
@@ -9,8 +9,10 @@ rule cutadapt:
     input:
         unpack(get_fastqs),
     output:
-        of1=join(WORKDIR, "results", "{sample}", "trim", "{sample}.R1.trim.fastq.gz"),
-        of2=join(WORKDIR, "results", "{sample}", "trim", "{sample}.R2.trim.fastq.gz"),
+        of1=temp(join(WORKDIR, "results", "{sample}", "trim", "{sample}.R1.trim.fastq.gz")) if STREAMING else join(WORKDIR, "results", "{sample}", "trim", "{sample}.R1.trim.fastq.gz"),
+        of2=temp(join(WORKDIR, "results", "{sample}", "trim", "{sample}.R2.trim.fastq.gz")) if STREAMING else join(WORKDIR, "results", "{sample}", "trim", "{sample}.R2.trim.fastq.gz"),
+    benchmark:
+        join(BENCHMARKS_DIR, "cutadapt", "{sample}.tsv")
     params:
         sample="{sample}",
         workdir=WORKDIR,
@@ -23,6 +25,7 @@ rule cutadapt:
         cutadapt_q=config["cutadapt_q"],
         adapters=join(RESOURCES_DIR, "adapters.fa"),
         tmpdir=temp(f"{TEMPDIR}/{str(uuid.uuid4())}"),
+        streaming=STREAMING,
     container: config['containers']['cutadapt']
     # threads: getthreads("cutadapt")
     # threads: 4
@@ -40,6 +43,25 @@ rule cutadapt:
         of1bn=$(basename {output.of1})
         of2bn=$(basename {output.of2})
 
+        if [ "{params.streaming}" == "True" ];then
+            # streaming: cutadapt writes uncompressed reads instead of gzipped intermediates.
+            # Single-end reads go to fastq-filter through a FIFO; paired-end reads are written
+            # to plain files on scratch, because fastq-filter reads R1 and R2 in lockstep and
+            # cutadapt -j writes large chunks per file, which could block two FIFOs forever
+            of1bn=${{of1bn%.gz}}
+            of2bn=${{of2bn%.gz}}
+            if [ "{params.peorse}" != "PE" ];then
+                mkfifo {params.tmpdir}/${{of1bn}}
+                fastq-filter \\
+                    -q {params.cutadapt_q} \\
+                    -o {output.of1} \\
+                    {params.tmpdir}/${{of1bn}} &
+                filter_pid=$!
+                # do not leave fastq-filter blocked on a FIFO if cutadapt fails
+                trap 'kill $filter_pid 2>/dev/null || true' EXIT
+            fi
+        fi
+
         if [ "{params.peorse}" == "PE" ];then
             ## Paired-end
             cutadapt --pair-filter=any \\
@@ -59,6 +81,7 @@ rule cutadapt:
                 -q {params.cutadapt_q} \\
                 -o {output.of1} -o {output.of2} \\
                 {params.tmpdir}/${{of1bn}} {params.tmpdir}/${{of2bn}}
+            rm -f {params.tmpdir}/${{of1bn}} {params.tmpdir}/${{of2bn}}
 
         else
             ## Single-end
@@ -76,10 +99,86 @@ rule cutadapt:
             touch {output.of2}
 
         # filter for average read quality
-            fastq-filter \\
-                -q {params.cutadapt_q} \\
-                -o {output.of1} \\
-                {params.tmpdir}/${{of1bn}}
+            if [ "{params.streaming}" == "True" ];then
+                wait $filter_pid
+            else
+                fastq-filter \\
+                    -q {params.cutadapt_q} \\
+                    -o {output.of1} \\
+                    {params.tmpdir}/${{of1bn}}
+            fi
 
         fi
         """
+
+
+if CUTADAPT_CHUNKS > 1:
+    # scatter/gather: split_fastq -> cutadapt_chunk (one job per chunk) -> cutadapt_gather,
+    # which writes the same trimmed FASTQs as cutadapt
+    ruleorder: cutadapt_gather > cutadapt
+
+    rule split_fastq:
+        input:
+            unpack(get_fastqs),
+        output:
+            R1=temp(expand(join(WORKDIR, "results", "{{sample}}", "trim", "chunks", "{{sample}}.R1.chunk{chunk}.fastq.gz"), chunk=range(CUTADAPT_CHUNKS))),
+            R2=temp(expand(join(WORKDIR, "results", "{{sample}}", "trim", "chunks", "{{sample}}.R2.chunk{chunk}.fastq.gz"), chunk=range(CUTADAPT_CHUNKS))),
+        benchmark:
+            join(BENCHMARKS_DIR, "split_fastq", "{sample}.tsv")
+        params:
+            peorse=get_peorse,
+            script=join(SCRIPTS_DIR, "_split_fastq.py"),
+        container: config['containers']['cutadapt']
+        threads: _get_threads("split_fastq", profile_config)
+        shell:
+            """
+            set -exo pipefail
+            if [ "{params.peorse}" == "PE" ];then
+                python {params.script} \\
+                    --r1 {input.R1} --r2 {input.R2} \\
+                    --out_r1 {output.R1} \\
+                    --out_r2 {output.R2}
+            else
+                python {params.script} \\
+                    --r1 {input.R1} \\
+                    --out_r1 {output.R1}
+                touch {output.R2}
+            fi
+            """
+
+    use rule cutadapt as cutadapt_chunk with:
+        input:
+            R1=join(WORKDIR, "results", "{sample}", "trim", "chunks", "{sample}.R1.chunk{chunk}.fastq.gz"),
+            R2=join(WORKDIR, "results", "{sample}", "trim", "chunks", "{sample}.R2.chunk{chunk}.fastq.gz"),
+        output:
+            of1=temp(join(WORKDIR, "results", "{sample}", "trim", "chunks", "{sample}.R1.chunk{chunk}.trim.fastq.gz")),
+            of2=temp(join(WORKDIR, "results", "{sample}", "trim", "chunks", "{sample}.R2.chunk{chunk}.trim.fastq.gz")),
+        benchmark:
+            join(BENCHMARKS_DIR, "cutadapt_chunk", "{sample}.chunk{chunk}.tsv")
+        threads: _get_threads("cutadapt_chunk", profile_config)
+
+    rule cutadapt_gather:
+        input:
+            R1=expand(join(WORKDIR, "results", "{{sample}}", "trim", "chunks", "{{sample}}.R1.chunk{chunk}.trim.fastq.gz"), chunk=range(CUTADAPT_CHUNKS)),
+            R2=expand(join(WORKDIR, "results", "{{sample}}", "trim", "chunks", "{{sample}}.R2.chunk{chunk}.trim.fastq.gz"), chunk=range(CUTADAPT_CHUNKS)),
+        output:
+            of1=temp(join(WORKDIR, "results", "{sample}", "trim", "{sample}.R1.trim.fastq.gz")) if STREAMING else join(WORKDIR, "results", "{sample}", "trim", "{sample}.R1.trim.fastq.gz"),
+            of2=temp(join(WORKDIR, "results", "{sample}", "trim", "{sample}.R2.trim.fastq.gz")) if STREAMING else join(WORKDIR, "results", "{sample}", "trim", "{sample}.R2.trim.fastq.gz"),
+        benchmark:
+            join(BENCHMARKS_DIR, "cutadapt_gather", "{sample}.tsv")
+        params:
+            peorse=get_peorse,
+        shell:
+            """
+            set -exo pipefail
+            # a concatenation of gzip members is a valid gzip file: no recompression
+            cat {input.R1} > {output.of1}
+            if [ "{params.peorse}" == "PE" ];then
+                cat {input.R2} > {output.of2}
+            else
+                touch {output.of2}
+            fi
+            """
+
+# rule whose trimmed FASTQs the alignment rules read (rules.<name>.output binds the producer)
+TRIM_RULE = rules.cutadapt_gather if CUTADAPT_CHUNKS > 1 else rules.cutadapt
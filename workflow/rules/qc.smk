@@ -1,32 +1,89 @@
 
 
+# kraken2_mode: screen -- sample n records of one-line-per-read(-pair) input (the 4 FASTQ lines of
+# R1, then of R2, tab-separated) and write them back to FASTQ files r1/r2. reservoir keeps a
+# uniform sample of the whole input (fixed seed), head the first n records.
+KRAKEN2_SUBSAMPLE_AWK = r"""
+BEGIN { srand(1) }
+mode == "head" && NR > n { exit }
+NR <= n { keep[NR] = $0; next }
+{ j = int(rand() * NR) + 1; if (j <= n) keep[j] = $0 }
+END {
+    m = NR < n ? NR : n
+    for (i = 1; i <= m; i++) {
+        k = split(keep[i], f, "\t")
+        print f[1] "\n" f[2] "\n" f[3] "\n" f[4] > r1
+        if (k == 8) print f[5] "\n" f[6] "\n" f[7] "\n" f[8] > r2
+    }
+    print "kraken2 screen: " m " of " (mode == "head" && NR > n ? ">" n : NR) " reads sampled (" mode ")" > "/dev/stderr"
+}
+"""
+
+def _kraken2_params():
+    params = config['kraken2_params']
+    if KRAKEN2_MODE == "screen":
+        # the sampled reads are written uncompressed; the database is memory-mapped
+        params = " ".join(p for p in params.split() if p not in {"--gzip-compressed", "--bzip2-compressed"})
+        params += " --memory-mapping"
+    return params
+
 rule kraken2:
+    # screen mode runs as kraken2_screen, so the profile can give it its own (much smaller) resources
+    name: KRAKEN2_RULE
     input:
         unpack(get_fastqs),
     output:
         kraken2_report = join(RESULTSDIR, "{sample}", "kraken2", "{sample}.kraken2.report.txt"),
+    benchmark:
+        join(BENCHMARKS_DIR, "kraken2", "{sample}.tsv")
     params:
         sample = "{sample}",
         outdir = join(RESULTSDIR, "{sample}", "kraken2"),
         kraken2_db = config['kraken2_db'],
-        kraken2_params = config['kraken2_params'],
+        kraken2_params = _kraken2_params(),
         peorse=get_peorse,
-    threads: _get_threads("kraken2", profile_config)
+        mode = KRAKEN2_MODE,
+        screen_reads = KRAKEN2_SCREEN_READS,
+        screen_sampling = KRAKEN2_SCREEN_SAMPLING,
+        subsample_awk = lambda wildcards: KRAKEN2_SUBSAMPLE_AWK,
+        tmpdir = f"{TEMPDIR}/{str(uuid.uuid4())}",
+    threads: _get_threads(KRAKEN2_RULE, profile_config)
     container: config['containers']['kraken2']
     shell:
         r"""
         set -exo pipefail
         mkdir -p {params.outdir}
 
+        R1="{input.R1}"
+        R2="{input.R2}"
+        if [ "{params.mode}" == "screen" ]; then
+            mkdir -p {params.tmpdir}
+            trap 'rm -rf {params.tmpdir}' EXIT
+            # head mode stops reading early, so the FASTQ readers may end with SIGPIPE (141)
+            if [ "{params.peorse}" == "PE" ]; then
+                paste <(zcat -f {input.R1} | paste - - - -) <(zcat -f {input.R2} | paste - - - -) \
+                | awk -v n={params.screen_reads} -v mode={params.screen_sampling} \
+                    -v r1={params.tmpdir}/R1.fastq -v r2={params.tmpdir}/R2.fastq \
+                    '{params.subsample_awk}' || [ $? -eq 141 ]
+                R2="{params.tmpdir}/R2.fastq"
+            else
+                zcat -f {input.R1} | paste - - - - \
+                | awk -v n={params.screen_reads} -v mode={params.screen_sampling} \
+                    -v r1={params.tmpdir}/R1.fastq -v r2=/dev/null \
+                    '{params.subsample_awk}' || [ $? -eq 141 ]
+            fi
+            R1="{params.tmpdir}/R1.fastq"
+        fi
+
         if [ "{params.peorse}" == "PE" ]; then
             kraken2 --db {params.kraken2_db} \
-                --paired {input.R1} {input.R2} \
+                --paired $R1 $R2 \
                 {params.kraken2_params} \
                 --report {output.kraken2_report} \
                 --threads {threads}
         else
             kraken2 --db {params.kraken2_db} \
-                {input.R1} \
+                $R1 \
                 {params.kraken2_params} \
                 --report {output.kraken2_report} \
                 --threads {threads}
@@ -39,6 +96,8 @@ rule qualimap:
     output:
         html = join(RESULTSDIR, "{sample}", "qualimap", "qualimapReport.html"),
         pdf = join(RESULTSDIR, "{sample}", "qualimap", "report.pdf"),
+    benchmark:
+        join(BENCHMARKS_DIR, "qualimap", "{sample}.tsv")
     params:
         sample = "{sample}",
         outdir = join(RESULTSDIR, "{sample}", "qualimap"),
@@ -55,40 +114,55 @@ rule qualimap:
             -nt {threads}
         """
 
-localrules: gtf2genepred
-rule gtf2genepred:
-    input:
-        gtf = join(REF_DIR, "ref.fixed.gtf"),
-    output:
-        genepred = join(REF_DIR, "ref.genes.genepred"),
-    container: config['containers']['gtfToGenePred']
-    shell:
-        r"""
-        set -exo pipefail
-        gtfToGenePred -ignoreGroupsWithoutExons {input.gtf} {output.genepred}
-        """
+if BAM_QC_ENGINE == "harold":
+    # one pass over the sorted BAM instead of rseqc_read_distribution, infer_strandedness
+    # and rseqc_junction_annotation (on each species BAM); same output files and formats
+    ruleorder: bam_qc > rseqc_read_distribution
+    ruleorder: bam_qc > infer_strandedness
+    ruleorder: bam_qc > rseqc_junction_annotation
 
-localrules: genepred2bed12
-rule genepred2bed12:
-    input:
-        genepred = join(REF_DIR, "ref.genes.genepred"),
-    output:
-        bed12 = join(REF_DIR, "ref.genes.bed12"),
-    params:
-        tmpdir=f"{TEMPDIR}/{str(uuid.uuid4())}",
-    container: config['containers']['genePredToBed']
-    shell:
-        r"""
-        set -exo pipefail
-        genePredToBed {input.genepred} {output.bed12}
-        """
+    rule bam_qc:
+        input:
+            bam = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam"),
+            bai = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam.bai"),
+            bed12 = REF_BED12,
+            bed = REF_BED,
+        output:
+            read_distribution = join(RESULTSDIR, "{sample}", "rseqc", "{sample}.read_distribution.txt"),
+            strandedness = join(RESULTSDIR, "{sample}", "rseqc", "{sample}.strandedness.txt"),
+            junctions = expand(join(RESULTSDIR, "{{sample}}", "rseqc", "{{sample}}.{regionname}.junction.bed"), regionname=HOST_VIRUSES),
+        benchmark:
+            join(BENCHMARKS_DIR, "bam_qc", "{sample}.tsv")
+        params:
+            script = join(SCRIPTS_DIR, "_bam_qc.py"),
+            regions = REF_REGIONS_HOST_VIRUSES,
+            junction_prefix = join(RESULTSDIR, "{sample}", "rseqc", "{sample}"),
+        container:
+            config['containers']['rseqc'],
+        threads: _get_threads("bam_qc", profile_config)
+        shell:
+            r"""
+            set -exo pipefail
+            mkdir -p $(dirname {output.read_distribution})
+            python {params.script} \
+                --bam {input.bam} \
+                --bed12 {input.bed12} \
+                --strand_bed {input.bed} \
+                --read_distribution {output.read_distribution} \
+                --strandedness {output.strandedness} \
+                --regions {params.regions} \
+                --junction_prefix {params.junction_prefix} \
+                --threads {threads}
+            """
 
 rule rseqc_read_distribution:
     input:
         bam = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam"),
-        bed12 = join(REF_DIR, "ref.genes.bed12"),
+        bed12 = REF_BED12,
     output:
         read_distribution = join(RESULTSDIR, "{sample}", "rseqc", "{sample}.read_distribution.txt"),
+    benchmark:
+        join(BENCHMARKS_DIR, "rseqc_read_distribution", "{sample}.tsv")
     params:
         sample = "{sample}",
     container:
@@ -110,12 +184,17 @@ rule rseqc_read_distribution:
 rule rseqc_tin:
     input:
         bam = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam"),
-        bed12 = join(REF_DIR, "ref.genes.bed12"),
+        bed12 = REF_BED12,
     output:
         tin = join(RESULTSDIR, "{sample}", "rseqc", "{sample}.Aligned.sortedByCoord.out.summary.txt"),
         xls = join(RESULTSDIR, "{sample}", "rseqc", "{sample}.Aligned.sortedByCoord.out.tin.xls"),
+    benchmark:
+        join(BENCHMARKS_DIR, "rseqc_tin", "{sample}.tsv")
     params:
         sample = "{sample}",
+        shards = RSEQC_SHARDS,
+        script = join(SCRIPTS_DIR, "_rseqc_shards.py"),
+        tmpdir = f"{TEMPDIR}/{str(uuid.uuid4())}",
     container:
         config['containers']['rseqc'],
     threads: _get_threads("rseqc_tin", profile_config)
@@ -124,37 +203,69 @@ rule rseqc_tin:
         set -exo pipefail
         outdir=$(dirname {output.tin})
         mkdir -p $outdir
-        cd $outdir
-        tin.py \
-            -i {input.bam} \
-            -r {input.bed12}
+        shards={params.shards}
+        [ "$shards" -gt 0 ] || shards=$(( {threads} * 4 ))
+        if [ "$shards" -le 1 ];then
+            cd $outdir
+            tin.py \
+                -i {input.bam} \
+                -r {input.bed12}
+        else
+            # TIN is per transcript: run tin.py on ref.genes.bed12 shards, {threads} at a time,
+            # recording which transcripts passed its read filter, then concatenate the shard
+            # tables in order and recompute summary.txt from those transcripts
+            python {params.script} split \
+                --bed12 {input.bed12} \
+                --outdir {params.tmpdir} \
+                --shards $shards
+            ls {params.tmpdir}/shard_*.bed12 | xargs -P {threads} -I {{}} bash -c \
+                'd=${{0%.bed12}} && mkdir -p $d && cd $d && python {params.script} run-tin --flags $d/tin.flags -i {input.bam} -r $0' {{}}
+            python {params.script} merge-tin \
+                --xls {output.xls} \
+                --summary {output.tin} \
+                --bam {input.bam} \
+                {params.tmpdir}/shard_*/*.tin.xls
+            rm -rf {params.tmpdir}
+        fi
         ls -larth $outdir
         """
 
+localrules: aggregate_tin
 rule aggregate_tin:
     input:
         expand(join(RESULTSDIR, "{sample}", "rseqc", "{sample}.Aligned.sortedByCoord.out.tin.xls"), sample=SAMPLES),
     output:
         agg_tin = join(RESULTSDIR, "counts", "aggregate_tin.tsv"),
+        summary = join(RESULTSDIR, "counts", "aggregate_tin.summary_mqc.tsv") if TIN_SUMMARY else [],
+        parquet = _matrix_outputs(join(RESULTSDIR, "counts", "aggregate_tin.tsv")),
+    benchmark:
+        join(BENCHMARKS_DIR, "aggregate_tin", "aggregate_tin.tsv")
     params:
         script = join(SCRIPTS_DIR, "_aggregate_tin.py"),
-    container: config['containers']['star_ucsc_cufflinks']
+        summary_arg = "--summary " + join(RESULTSDIR, "counts", "aggregate_tin.summary_mqc.tsv") if TIN_SUMMARY else "",
+        parquet_arg = PARQUET_ARG,
+    # runs next to the other matrix aggregations, where PARQUET_ARG was checked for pyarrow
     shell:
         r"""
         set -exo pipefail
         mkdir -p $(dirname {output.agg_tin})
         cd $(dirname {output.agg_tin})
-        python {params.script} {input} > {output.agg_tin}
+        python {params.script} --output {output.agg_tin} {params.summary_arg} {params.parquet_arg} {input}
         """
 
 rule rseqc_geneBody_coverage:
     input:
         bam = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam"),
-        bed12 = join(REF_DIR, "ref.genes.bed12"),
+        bed12 = REF_BED12,
     output:
         geneBody_coverage = join(RESULTSDIR, "{sample}", "rseqc", "{sample}.geneBodyCoverage.txt"),
+    benchmark:
+        join(BENCHMARKS_DIR, "rseqc_geneBody_coverage", "{sample}.tsv")
     params:
         sample = "{sample}",
+        shards = RSEQC_SHARDS,
+        script = join(SCRIPTS_DIR, "_rseqc_shards.py"),
+        tmpdir = f"{TEMPDIR}/{str(uuid.uuid4())}",
     container:
         config['containers']['rseqc'],
     threads: _get_threads("rseqc_geneBody_coverage", profile_config)
@@ -163,11 +274,29 @@ rule rseqc_geneBody_coverage:
         set -exo pipefail
         outdir=$(dirname {output.geneBody_coverage})
         mkdir -p $outdir
-        cd $outdir
-        geneBody_coverage.py \
-            -i {input.bam} \
-            -r {input.bed12} \
-            -o ${{outdir}}/{params.sample}
+        shards={params.shards}
+        [ "$shards" -gt 0 ] || shards=$(( {threads} * 4 ))
+        if [ "$shards" -le 1 ];then
+            cd $outdir
+            geneBody_coverage.py \
+                -i {input.bam} \
+                -r {input.bed12} \
+                -o ${{outdir}}/{params.sample}
+        else
+            # coverage is summed per percentile over transcripts: run geneBody_coverage.py on
+            # ref.genes.bed12 shards (geneIDs deduplicated), {threads} at a time, and add them up
+            python {params.script} split \
+                --bed12 {input.bed12} \
+                --outdir {params.tmpdir} \
+                --shards $shards \
+                --unique_ids
+            ls {params.tmpdir}/shard_*.bed12 | xargs -P {threads} -I {{}} bash -c \
+                'd=${{0%.bed12}} && mkdir -p $d && cd $d && geneBody_coverage.py -i {input.bam} -r $0 -o $d/{params.sample}' {{}}
+            python {params.script} merge-genebody \
+                --output {output.geneBody_coverage} \
+                {params.tmpdir}/shard_*/{params.sample}.geneBodyCoverage.txt
+            rm -rf {params.tmpdir}
+        fi
         ls -larth $outdir
         """
 
@@ -176,6 +305,8 @@ rule rseqc_read_gc:
         bam = join(RESULTSDIR, "{sample}", "STAR", "{sample}.{regionname}.bam"),
     output:
         read_gc = join(RESULTSDIR, "{sample}", "rseqc", "{sample}.{regionname}.GC.xls"),
+    benchmark:
+        join(BENCHMARKS_DIR, "rseqc_read_gc", "{sample}.{regionname}.tsv")
     params:
         sample = "{sample}",
         regionname = "{regionname}",
@@ -199,9 +330,11 @@ rule rseqc_read_gc:
 rule rseqc_junction_annotation:
     input:
         bam = join(RESULTSDIR, "{sample}", "STAR", "{sample}.{regionname}.bam"),
-        bed12 = join(REF_DIR, "ref.genes.bed12"),
+        bed12 = REF_BED12,
     output:
         junctions = join(RESULTSDIR, "{sample}", "rseqc", "{sample}.{regionname}.junction.bed"),
+    benchmark:
+        join(BENCHMARKS_DIR, "rseqc_junction_annotation", "{sample}.{regionname}.tsv")
     params:
         sample = "{sample}",
         regionname = "{regionname}",
@@ -233,6 +366,8 @@ rule junctions_to_bigbed:
         junctions = join(RESULTSDIR, "{sample}", "rseqc", "{sample}.{regionname}.junction.bed"),
     output:
         bb = join(RESULTSDIR, "{sample}", "rseqc", "{sample}.{regionname}.junction.bb"),
+    benchmark:
+        join(BENCHMARKS_DIR, "junctions_to_bigbed", "{sample}.{regionname}.tsv")
     params:
         sample = "{sample}",
         regionname = "{regionname}",
@@ -268,12 +403,15 @@ rule multiqc:
     input:
         expand(join(RESULTSDIR, "{sample}", "qualimap", "qualimapReport.html")                              ,sample=SAMPLES),
         expand(join(RESULTSDIR, "{sample}", "rseqc", "{sample}.read_distribution.txt")                      ,sample=SAMPLES),
-        expand(join(RESULTSDIR, "{sample}", "rseqc", "{sample}.strandedness.txt")                           ,sample=SAMPLES),
+        expand(join(RESULTSDIR, "{sample}", "rseqc", "{sample}.strandedness.txt")                           ,sample=SAMPLES) if RUN_RSEQC_INFER_EXPERIMENT else [],
         expand(join(RESULTSDIR, "{sample}", "rseqc", "{sample}.geneBodyCoverage.txt")                       ,sample=SAMPLES),  # times out with 8 hours as well .. commenting out for now
         expand(join(RESULTSDIR, "{sample}", "rseqc", "{sample}.Aligned.sortedByCoord.out.summary.txt")      ,sample=SAMPLES),
         expand(join(RESULTSDIR, "{sample}", "kraken2", "{sample}.kraken2.report.txt")                       ,sample=SAMPLES),
+        join(RESULTSDIR, "counts", "aggregate_tin.summary_mqc.tsv") if TIN_SUMMARY else [],
     output:
         multiqc = join(RESULTSDIR, "multiqc_report.html"),
+    benchmark:
+        join(BENCHMARKS_DIR, "multiqc", "multiqc.tsv")
     container:
         config['containers']['multiqc'],
     threads: 1
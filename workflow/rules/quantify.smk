@@ -1,32 +1,12 @@
 
-localrules: gtf_to_bed
-rule gtf_to_bed:
-    input:
-        gtf = join(REF_DIR, "ref.fixed.gtf"),
-    output:
-        bed = join(REF_DIR, "ref.genes.bed"),
-    params:
-        tmpdir=f"{TEMPDIR}/{str(uuid.uuid4())}",
-    container:
-        config['containers']['gffread']
-    shell:
-        r"""
-        set -exo pipefail
-        mkdir -p {params.tmpdir}
-        outdir=$(dirname {output.bed})
-        gffread {input.gtf} -T -o {params.tmpdir}/temp.gtf
-        awk '$3 == "exon" {{
-            gsub(/[";]/, "", $10);
-            print $1"\t"($4-1)"\t"$5"\t"$10"\t0\t"$7
-        }}' {params.tmpdir}/temp.gtf > {output.bed}
-        """
-
 rule infer_strandedness:
     input:
         bam = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam"),
-        bed = join(REF_DIR, "ref.genes.bed"),
+        bed = REF_BED,
     output:
         strandedness = join(RESULTSDIR, "{sample}", "rseqc", "{sample}.strandedness.txt"),
+    benchmark:
+        join(BENCHMARKS_DIR, "infer_strandedness", "{sample}.tsv")
     params:
         sample = "{sample}",
         tmpdir=f"{TEMPDIR}/{str(uuid.uuid4())}",
@@ -49,36 +29,49 @@ localrules: aggregate_stranded_counts
 rule aggregate_stranded_counts:
     input:
         counts_files = expand(join(RESULTSDIR, "{sample}", "STAR", "{sample}.ReadsPerGene.out.tab"), sample=SAMPLES),
-        strandedness_files = expand(join(RESULTSDIR, "{sample}", "rseqc", "{sample}.strandedness.txt"), sample=SAMPLES),
-        gtf = join(REF_DIR, "ref.fixed.gtf")
+        strandedness_files = expand(join(RESULTSDIR, "{sample}", "rseqc", "{sample}.strandedness.txt"), sample=SAMPLES) if INFER_STRANDEDNESS_METHOD == "rseqc" else [],
+        gtf = REF_FIXED_GTF
     output:
         counts = join(RESULTSDIR,"counts","counts_matrix.tsv"),
         counts_rpkm = join(RESULTSDIR,"counts","counts_matrix.rpkm.tsv"),
         counts_tpm = join(RESULTSDIR,"counts","counts_matrix.tpm.tsv"),
-        strand = join(RESULTSDIR,"counts","sample_strandedness.tsv")
+        strand = join(RESULTSDIR,"counts","sample_strandedness.tsv"),
+        parquet = _matrix_outputs(
+            join(RESULTSDIR,"counts","counts_matrix.tsv"),
+            join(RESULTSDIR,"counts","counts_matrix.rpkm.tsv"),
+            join(RESULTSDIR,"counts","counts_matrix.tpm.tsv"),
+        ),
+    benchmark:
+        join(BENCHMARKS_DIR, "aggregate_stranded_counts", "aggregate_stranded_counts.tsv")
     params:
         regions = REF_REGIONS,
         infer_strandedness = INFER_STRANDEDNESS,
         infer_strandedness_fraction = INFER_FRACTION_THRESHOLD,
+        strandedness_method = INFER_STRANDEDNESS_METHOD,
         manifest_file = MANIFEST_FILE,
         strandinfo_column = STRANDEDNESS_COLUMN,
+        annotation_cache = ANNOTATION_INDEX_DIR,
         script1 = join(SCRIPTS_DIR,"_aggregate_counts_by_strandedness.py"),
         script2 = join(SCRIPTS_DIR,"_raw_counts_to_tpm.py")
+    threads: _get_threads("aggregate_stranded_counts", profile_config)
     run:
         os.makedirs(os.path.dirname(output.counts), exist_ok=True)
         counts_list = ",".join(input.counts_files)
-        strandedness_list = ",".join(input.strandedness_files)
         strand_arg = "--infer_strandedness" if params.infer_strandedness == "true" else "--no-infer_strandedness"
-        shell(f"python {params.script1} --counts {counts_list} --strandinfo {strandedness_list} --output_counts {output.counts} --output_strand {output.strand} --gtf {input.gtf} --regions {params.regions} {strand_arg} --manifest_file {params.manifest_file} --strandinfo_column {params.strandinfo_column} --infer_strandedness_fraction {params.infer_strandedness_fraction}")
-        shell(f"python {params.script2} --input {output.counts} --samples {params.manifest_file} --rpkm_output {output.counts_rpkm} --tpm_output {output.counts_tpm}")
+        if params.strandedness_method == "rseqc":
+            strand_arg += " --strandinfo " + ",".join(input.strandedness_files)
+        shell(f"python {params.script1} --counts {counts_list} --strandedness_method {params.strandedness_method} --output_counts {output.counts} --output_strand {output.strand} --gtf {input.gtf} --regions {params.regions} {strand_arg} --manifest_file {params.manifest_file} --strandinfo_column {params.strandinfo_column} --infer_strandedness_fraction {params.infer_strandedness_fraction} --annotation_cache {params.annotation_cache} --gene_lengths {GENE_LENGTH} --jobs {threads} {PARQUET_ARG} {SHARD_ARG}")
+        shell(f"python {params.script2} --input {output.counts} --samples {params.manifest_file} --rpkm_output {output.counts_rpkm} --tpm_output {output.counts_tpm} --gene_length {GENE_LENGTH} {PARQUET_ARG}")
 
 rule rseqc_fpkm:
     input:
         bam = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam"),
         strand = join(RESULTSDIR,"counts","sample_strandedness.tsv"),
-        bed12 = join(REF_DIR, "ref.genes.bed12"),
+        bed12 = REF_BED12,
     output:
         fpkm = join(RESULTSDIR, "{sample}", "counts", "{sample}.rseqc_fpkm_tpm.tsv"),
+    benchmark:
+        join(BENCHMARKS_DIR, "rseqc_fpkm", "{sample}.tsv")
     params:
         sample = "{sample}",
         tmpdir=f"{TEMPDIR}/{str(uuid.uuid4())}",
@@ -126,29 +119,80 @@ rule rseqc_fpkm:
         """
 
 
+if TRANSCRIPT_QUANT_ENGINE == "harold":
+    # one pass over the sorted BAM instead of FPKM_count.py, _get_strand.py and
+    # _rseqc_fpkm_add_tpm.py; same rseqc_fpkm_tpm.tsv
+    ruleorder: transcript_quant > rseqc_fpkm
+
+    rule transcript_quant:
+        input:
+            bam = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam"),
+            bai = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam.bai"),
+            strand = join(RESULTSDIR,"counts","sample_strandedness.tsv"),
+            bed12 = REF_BED12,
+        output:
+            fpkm = join(RESULTSDIR, "{sample}", "counts", "{sample}.rseqc_fpkm_tpm.tsv"),
+        benchmark:
+            join(BENCHMARKS_DIR, "transcript_quant", "{sample}.tsv")
+        params:
+            sample = "{sample}",
+            peorse = get_peorse,
+            script = join(SCRIPTS_DIR, "_transcript_quant.py"),
+            annotation_cache = ANNOTATION_INDEX_DIR,
+        container:
+            config['containers']['rseqc']
+        threads: _get_threads("transcript_quant", profile_config)
+        shell:
+            r"""
+            set -exo pipefail
+            mkdir -p $(dirname {output.fpkm})
+            python {params.script} \
+                --bam {input.bam} \
+                --bed12 {input.bed12} \
+                --output {output.fpkm} \
+                --annotation_cache {params.annotation_cache} \
+                --strandedness {input.strand} \
+                --sample {params.sample} \
+                --peorse {params.peorse} \
+                --mapq 30 \
+                --threads {threads}
+            """
+
+
 localrules: aggregate_transcript_level_counts
 rule aggregate_transcript_level_counts:
     input:
         counts_files = expand(join(RESULTSDIR, "{sample}", "counts", "{sample}.rseqc_fpkm_tpm.tsv"), sample=SAMPLES),
-        gtf = join(REF_DIR, "ref.fixed.gtf")
+        gtf = REF_FIXED_GTF
     output:
         counts = join(RESULTSDIR,"counts","counts_matrix.transcript_level.tsv"),
         counts_fpkm = join(RESULTSDIR,"counts","counts_matrix.transcript_level.rpkm.tsv"),
         counts_tpm = join(RESULTSDIR,"counts","counts_matrix.transcript_level.tpm.tsv"),
+        parquet = _matrix_outputs(
+            join(RESULTSDIR,"counts","counts_matrix.transcript_level.tsv"),
+            join(RESULTSDIR,"counts","counts_matrix.transcript_level.rpkm.tsv"),
+            join(RESULTSDIR,"counts","counts_matrix.transcript_level.tpm.tsv"),
+        ),
+    benchmark:
+        join(BENCHMARKS_DIR, "aggregate_transcript_level_counts", "aggregate_transcript_level_counts.tsv")
     params:
         manifest_file = MANIFEST_FILE,
+        annotation_cache = ANNOTATION_INDEX_DIR,
+        missing_policy = config.get("transcript_missing_policy", "drop"),
         script1 = join(SCRIPTS_DIR,"_aggregate_transcript_level_counts.py")
     run:
         os.makedirs(os.path.dirname(output.counts), exist_ok=True)
-        shell(f"python {params.script1} --input {input.counts_files} --gtf {input.gtf} --fragcount_output {output.counts} --fpkm_output {output.counts_fpkm} --tpm_output {output.counts_tpm}")
+        shell(f"python {params.script1} --input {input.counts_files} --gtf {input.gtf} --annotation_cache {params.annotation_cache} --fragcount_output {output.counts} --fpkm_output {output.counts_fpkm} --tpm_output {output.counts_tpm} --missing {params.missing_policy} {PARQUET_ARG} {SHARD_ARG}")
 
 
 rule normalized_counts:
     input:
         counts = join(RESULTSDIR,"counts","counts_matrix.tsv"),
-        gtf = join(REF_DIR, "ref.fixed.gtf")
+        gtf = REF_FIXED_GTF
     output:
         html = join(RESULTSDIR,"counts","normalized_counts","normalize.html")
+    benchmark:
+        join(BENCHMARKS_DIR, "normalized_counts", "normalized_counts.tsv")
     params:
         manifest_file = MANIFEST_FILE,
         user_ercc = str(config.get('diffex_normalized_counts', {}).get('use_ercc', 'false')).lower(),
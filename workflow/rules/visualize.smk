@@ -4,10 +4,13 @@ rule split_bam:
         bam = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam"),
     output:
         bams = expand(join(RESULTSDIR, "{{sample}}", "STAR", "{{sample}}.{regionname}.bam"), regionname=HOST_VIRUSES),
+    benchmark:
+        join(BENCHMARKS_DIR, "split_bam", "{sample}.tsv")
     params:
         sample = "{sample}",
         outdir = join(RESULTSDIR, "{sample}", "STAR"),
         regions = REF_REGIONS_HOST_VIRUSES,
+        tmpdir=f"{TEMPDIR}/{str(uuid.uuid4())}",
     threads:
         _get_threads("split_bam", profile_config)
     container:
@@ -15,23 +18,103 @@ rule split_bam:
     shell:
         r"""
         set -exo pipefail
+        # Single pass over the sorted BAM: every record is routed to the species BAM(s) of
+        # its reference sequence (whole-chromosome regions, so this selects the same
+        # records as "samtools view bam <regions>"). Each species stream is tee'd into
+        # flagstat and stats while "samtools view --write-index" writes the BAM and index.
+        mkdir -p {params.tmpdir}
+        trap 'rm -rf {params.tmpdir}' EXIT
+        pids=""
         while read regionname regions; do
             outbam={params.outdir}/{params.sample}.${{regionname}}.bam
+            mkfifo {params.tmpdir}/${{regionname}}.flagstat.fifo {params.tmpdir}/${{regionname}}.stats.fifo
+            samtools flagstat {params.tmpdir}/${{regionname}}.flagstat.fifo > ${{outbam}}.flagstat &
+            pids="$pids $!"
+            samtools stats {params.tmpdir}/${{regionname}}.stats.fifo > ${{outbam}}.stats &
+            pids="$pids $!"
+            for chrom in ${{regions}}; do
+                printf "%s\t%s\n" "${{chrom}}" "${{regionname}}"
+            done >> {params.tmpdir}/chrom2species.tsv
+        done < {params.regions}
+
+        samtools view -@ {threads} -h {input.bam} \
+            | awk -v map={params.tmpdir}/chrom2species.tsv -v tmpdir={params.tmpdir} \
+                -v prefix={params.outdir}/{params.sample}. -v threads={threads} '
+                BEGIN {{
+                    FS = "\t"
+                    while ((getline line < map) > 0) {{
+                        split(line, a, "\t")
+                        route[a[1]] = (a[1] in route) ? route[a[1]] " " a[2] : a[2]
+                        if (!(a[2] in out)) {{
+                            out[a[2]] = sprintf("samtools view -u - | tee %s/%s.flagstat.fifo %s/%s.stats.fifo | samtools view -@ %d -b --write-index -o %s%s.bam##idx##%s%s.bam.bai -",
+                                tmpdir, a[2], tmpdir, a[2], threads, prefix, a[2], prefix, a[2])
+                        }}
+                    }}
+                }}
+                /^@/ {{ for (s in out) print | out[s]; next }}
+                $3 in route {{
+                    n = split(route[$3], targets, " ")
+                    for (i = 1; i <= n; i++) print | out[targets[i]]
+                }}
+                END {{ for (s in out) close(out[s]) }}'
 
-            samtools view -@ {threads} -b {input.bam} ${{regions}} > ${{outbam}}
-            samtools index -@ {threads} ${{outbam}}
-            samtools flagstat -@ {threads} ${{outbam}} > ${{outbam}}.flagstat
-            samtools stats -@ {threads} ${{outbam}} > ${{outbam}}.stats
+        for pid in $pids; do
+            wait $pid
+        done
+        while read regionname regions; do
+            outbam={params.outdir}/{params.sample}.${{regionname}}.bam
+            samtools quickcheck ${{outbam}}
             samtools idxstats -@ {threads} ${{outbam}} > ${{outbam}}.idxstats
         done < {params.regions}
         """
 
 
+if BIGWIG_ENGINE == "harold":
+    # one pass over the sorted BAM instead of bamCoverage on each species BAM; same bigwigs
+    ruleorder: bam_coverage > bam_to_bigwig
+
+    rule bam_coverage:
+        input:
+            bam = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam"),
+            bai = join(RESULTSDIR, "{sample}", "STAR", "{sample}.Aligned.sortedByCoord.out.bam.bai"),
+            strand = join(RESULTSDIR, "counts", "sample_strandedness.tsv") if BIGWIG_STRANDED else [],
+        output:
+            bws = expand(join(RESULTSDIR, "{{sample}}", "bigwigs", "{{sample}}.{regionname}.bw"), regionname=HOST_VIRUSES),
+            stranded = expand(join(RESULTSDIR, "{{sample}}", "bigwigs", "{{sample}}.{regionname}.{strand}.bw"), regionname=HOST_VIRUSES, strand=["fwd", "rev"]) if BIGWIG_STRANDED else [],
+        benchmark:
+            join(BENCHMARKS_DIR, "bam_coverage", "{sample}.tsv")
+        params:
+            script = join(SCRIPTS_DIR, "_bam_coverage.py"),
+            regions = REF_REGIONS_HOST_VIRUSES,
+            prefix = join(RESULTSDIR, "{sample}", "bigwigs", "{sample}"),
+            normalize = config.get("deeptools_normalize", "RPKM"),
+            binSize = config.get("deeptools_binSize", 10),
+            strand_arg = lambda wildcards, input: f"--strandedness {input.strand} --sample {wildcards.sample} --peorse {get_peorse(wildcards)}" if BIGWIG_STRANDED else "",
+        threads:
+            _get_threads("bam_coverage", profile_config)
+        container:
+            config['containers']['rseqc']
+        shell:
+            r"""
+            set -exo pipefail
+            mkdir -p $(dirname {params.prefix})
+            python {params.script} \
+                --bam {input.bam} \
+                --regions {params.regions} \
+                --prefix {params.prefix} \
+                --bin_size {params.binSize} \
+                --normalize {params.normalize} \
+                --threads {threads} {params.strand_arg}
+            """
+
+
 rule bam_to_bigwig:
     input:
         bam = join(RESULTSDIR, "{sample}", "STAR", "{sample}.{regionname}.bam"),
     output:
         bw = join(RESULTSDIR, "{sample}", "bigwigs", "{sample}.{regionname}.bw"),
+    benchmark:
+        join(BENCHMARKS_DIR, "bam_to_bigwig", "{sample}.{regionname}.tsv")
     params:
         sample = "{sample}",
         regionname = "{regionname}",
@@ -3,8 +3,14 @@ import os
 import sys
 import pandas as pd
 import re
-from collections import defaultdict
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from _annotation_index import GENE_LENGTH_COLUMNS, load_annotation_index
+from _matrix_io import write_matrix
+from _sample_shards import ShardCache
 
 
 def infer_strandedness(file_path, fraction_threshold=0.8):
@@ -47,70 +53,56 @@ def infer_strandedness(file_path, fraction_threshold=0.8):
     return "unstranded", 0.0
 
 
-def parse_gtf_lookup(gtf_file):
-    lookup = {}
-    gene_transcripts = defaultdict(lambda: defaultdict(list))
+def infer_strandedness_from_counts(counts_df, fraction_threshold=0.8):
+    """
+    Infer strandedness from a STAR ReadsPerGene.out.tab table (columns 1-4:
+    gene, unstranded, forward, reverse) instead of RSeQC infer_experiment.py output.
+    Returns (strand, inference_fraction) with the same meaning as infer_strandedness:
+    inference_fraction is the reverse-strand share of the stranded gene counts.
+    """
+    genes = counts_df[~counts_df.iloc[:, 0].astype(str).str.startswith("N_")]
+    forward = genes.iloc[:, 2].sum()
+    reverse = genes.iloc[:, 3].sum()
+    if forward + reverse == 0:
+        return "unstranded", 0.0
 
-    with open(gtf_file) as f:
-        for line in f:
-            if line.startswith("#"):
-                continue
-            parts = line.strip().split("\t")
-            if len(parts) < 9:
-                continue
-            (
-                chrom,
-                source,
-                feature_type,
-                start,
-                end,
-                score,
-                strand,
-                frame,
-                attr_str,
-            ) = parts
-            attributes = {}
-            for attr in attr_str.strip().split(";"):
-                if attr.strip():
-                    key, val = attr.strip().split(" ", 1)
-                    attributes[key] = val.strip('"')
-            gene_id = attributes.get("gene_id")
-            transcript_id = attributes.get("transcript_id")
-            gene_name = attributes.get("gene_name", "NA")
-            gene_type = attributes.get("gene_type", "NA")
-
-            if feature_type == "exon" and gene_id and transcript_id:
-                start, end = int(start), int(end)
-                gene_transcripts[gene_id][transcript_id].append((start, end))
-
-            if feature_type == "gene" and gene_id:
-                lookup[gene_id] = {
-                    "gene_id": gene_id,
-                    "gene_name": gene_name,
-                    "gene_chr": chrom,
-                    "gene_start": int(start),
-                    "gene_end": int(end),
-                    "gene_strand": strand,
-                    "gene_type": gene_type,
-                }
+    frac = reverse / (forward + reverse)
+    if frac > fraction_threshold:
+        return "reverse", frac
+    elif frac < (1 - fraction_threshold):
+        return "forward", frac
+    else:
+        return "unstranded", frac
 
-    for gene_id, transcripts in gene_transcripts.items():
-        longest = 0
-        for exons in transcripts.values():
-            sorted_exons = sorted(exons)
-            merged = [sorted_exons[0]]
-            for current in sorted_exons[1:]:
-                last = merged[-1]
-                if current[0] <= last[1]:
-                    merged[-1] = (last[0], max(last[1], current[1]))
-                else:
-                    merged.append(current)
-            length = sum(e[1] - e[0] + 1 for e in merged)
-            longest = max(longest, length)
-        if gene_id in lookup:
-            lookup[gene_id]["gene_length_kb"] = round(longest / 1000.0, 3)
-        else:
-            lookup[gene_id] = {"gene_length_kb": round(longest / 1000.0, 3)}
+
+def parse_gtf_lookup(gtf_file, cache_dir=None):
+    index = load_annotation_index(gtf_file, cache_dir)
+    lookup = {}
+
+    genes = index.table("genes")
+    for gene_id, gene_name, gene_type, chrom, start, end, strand in zip(
+        genes["gene_id"],
+        genes["gene_name"],
+        genes["gene_type"],
+        genes["chrom"],
+        genes["start"].tolist(),
+        genes["end"].tolist(),
+        genes["strand"],
+    ):
+        lookup[gene_id] = {
+            "gene_id": gene_id,
+            "gene_name": gene_name or "NA",
+            "gene_chr": chrom,
+            "gene_start": start,
+            "gene_end": end,
+            "gene_strand": strand,
+            "gene_type": gene_type or "NA",
+        }
+
+    gene_ids, lengths = index.gene_lengths()
+    for definition, column in GENE_LENGTH_COLUMNS.items():
+        for gene_id, length in zip(gene_ids, lengths[definition].tolist()):
+            lookup.setdefault(gene_id, {})[column] = round(length / 1000.0, 3)
 
     return lookup
 
@@ -127,17 +119,121 @@ def parse_regions_file(regions_file):
     return chrom_to_species
 
 
-def read_counts_file(count_file, column, sample_name):
-    df = pd.read_csv(
-        count_file,
-        sep="\t",
-        header=None,
-        usecols=[0, column - 1],
-        names=["gene", sample_name],
-    )
+def read_counts_file(count_file, shards=None):
+    """
+    Read all four columns of a STAR ReadsPerGene.out.tab file, from its shard in
+    the ShardCache when the file is unchanged since it was last parsed.
+    """
+    if shards is not None:
+        cached = shards.load(count_file)
+        if cached is not None:
+            return pd.DataFrame(
+                {
+                    0: cached["gene"].astype(object),
+                    **{k: cached[f"c{k}"] for k in (1, 2, 3)},
+                }
+            )
+    counts_df = pd.read_csv(count_file, sep="\t", header=None)
+    if shards is not None:
+        shards.store(
+            count_file,
+            {
+                "gene": counts_df[0].to_numpy(dtype=str),
+                **{f"c{k}": counts_df[k].to_numpy() for k in (1, 2, 3)},
+            },
+        )
+    return counts_df
+
+
+def select_counts_column(counts_df, column, sample_name):
+    df = counts_df.iloc[:, [0, column - 1]]
+    df.columns = ["gene", sample_name]
     return df.set_index("gene")
 
 
+def load_sample(count_file, strand_file, infer_fraction, shards=None):
+    """
+    Read one sample and infer its strandedness. strand_file is the RSeQC
+    infer_experiment.py output, or None to infer from the STAR counts.
+    Returns (sample_name, raw_counts or None if files are missing, inferred, fraction).
+    """
+    sample_name = os.path.basename(count_file).split(".")[0]
+    if not os.path.exists(count_file) or (
+        strand_file is not None and not os.path.exists(strand_file)
+    ):
+        return sample_name, None, None, None
+
+    raw_counts = read_counts_file(count_file, shards)
+    if strand_file is None:
+        inferred, frac = infer_strandedness_from_counts(raw_counts, infer_fraction)
+    else:
+        inferred, frac = infer_strandedness(strand_file, infer_fraction)
+    return sample_name, raw_counts, inferred, frac
+
+
+def build_counts_matrix(all_counts):
+    """Column-bind per-sample count Series; STAR emits the same gene order for all samples."""
+    first = all_counts[0].index
+    if all(df.index.equals(first) for df in all_counts[1:]):
+        values = np.column_stack([df.iloc[:, 0].to_numpy() for df in all_counts])
+        columns = [df.columns[0] for df in all_counts]
+        return pd.DataFrame(values, index=first, columns=columns).astype(int)
+    return pd.concat(all_counts, axis=1).fillna(0).astype(int)
+
+
+def annotate_counts(
+    counts_df, lookup_dict, chrom_to_species, gene_lengths=("longest",)
+):
+    """
+    Prepend gene annotation columns to counts_df and relabel its index as
+    gene_id|gene_name. Annotation missing from the GTF is written as "NA".
+    gene_lengths are the length definitions written after gene_length_kb (longest,
+    always written).
+    """
+    length_columns = [GENE_LENGTH_COLUMNS["longest"]] + [
+        GENE_LENGTH_COLUMNS[d] for d in gene_lengths if d != "longest"
+    ]
+    lookup_df = pd.DataFrame.from_dict(lookup_dict, orient="index").reindex(
+        index=counts_df.index,
+        columns=[
+            "gene_id",
+            "gene_name",
+            "gene_chr",
+            "gene_start",
+            "gene_end",
+            "gene_strand",
+            *length_columns,
+            "gene_type",
+        ],
+    )
+    lookup_df["species"] = lookup_df["gene_chr"].map(chrom_to_species)
+    for col in ["gene_start", "gene_end"]:
+        lookup_df[col] = lookup_df[col].astype("Int64")
+
+    annot_df = lookup_df[
+        [
+            "species",
+            "gene_chr",
+            "gene_start",
+            "gene_end",
+            "gene_strand",
+            *length_columns,
+            "gene_type",
+        ]
+    ].astype(object)
+    annot_df = annot_df.where(annot_df.notna(), "NA")
+
+    final_df = pd.concat([annot_df, counts_df], axis=1)
+    gene_ids = lookup_df["gene_id"].fillna(
+        pd.Series(counts_df.index, index=counts_df.index)
+    )
+    gene_names = lookup_df["gene_name"].fillna("NA")
+    final_df.index = pd.Index(
+        (gene_ids + "|" + gene_names).tolist(), name=counts_df.index.name
+    )
+    return final_df
+
+
 def main(
     count_files,
     strandedness_files,
@@ -149,9 +245,15 @@ def main(
     manifest_file,
     strandinfo_column,
     infer_fraction,
+    annotation_cache=None,
+    strandedness_method="star",
+    jobs=1,
+    binary=True,
+    shard_cache=None,
+    gene_lengths=("longest",),
 ):
     chrom_to_species = parse_regions_file(regions_file)
-    lookup_dict = parse_gtf_lookup(gtf_file)
+    lookup_dict = parse_gtf_lookup(gtf_file, annotation_cache)
 
     # Load manifest if provided
     manifest = None
@@ -167,24 +269,40 @@ def main(
             )
             infer_flag = True
 
+    # sampleName -> strandedness, first occurrence wins as with the old row scan
+    manifest_strands = {}
+    if manifest is not None and strandinfo_column in manifest.columns:
+        first = manifest.drop_duplicates(subset=manifest.columns[0], keep="first")
+        manifest_strands = dict(zip(first.iloc[:, 0], first[strandinfo_column]))
+
+    if strandedness_method == "star":
+        strandedness_files = [None] * len(count_files)
+
+    shards = ShardCache(shard_cache, "star_counts") if shard_cache else None
+
+    # read and infer every sample concurrently, results come back in input order
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        samples = list(
+            pool.map(
+                lambda files: load_sample(files[0], files[1], infer_fraction, shards),
+                zip(count_files, strandedness_files),
+            )
+        )
+
     all_counts = []
     strand_info = []
 
-    for count_file, strand_file in zip(count_files, strandedness_files):
-        sample_name = os.path.basename(count_file).split(".")[0]
-
-        if not os.path.exists(count_file) or not os.path.exists(strand_file):
+    for sample_name, raw_counts, inferred, frac in samples:
+        if raw_counts is None:
             print(f"Skipping {sample_name}, missing files")
             continue
 
-        inferred, frac = infer_strandedness(strand_file, infer_fraction)
         used = inferred  # default
 
         if not infer_flag:  # manifest-driven
             if manifest is not None and strandinfo_column in manifest.columns:
-                row = manifest.loc[manifest.iloc[:, 0] == sample_name]
-                if not row.empty:
-                    value = str(row.iloc[0][strandinfo_column]).lower()
+                if sample_name in manifest_strands:
+                    value = str(manifest_strands[sample_name]).lower()
                     if value in ["forward", "reverse", "unstranded"]:
                         used = value
                     else:
@@ -207,51 +325,24 @@ def main(
         else:
             col = 2  # fallback
 
-        df = read_counts_file(count_file, col, sample_name)
-        all_counts.append(df)
+        all_counts.append(select_counts_column(raw_counts, col, sample_name))
 
-    counts_df = pd.concat(all_counts, axis=1).fillna(0).astype(int)
-    counts_df = counts_df[~counts_df.index.str.startswith("N_")]
-
-    # Annotate
-    annot_rows = []
-    for gene_id in counts_df.index:
-        info = lookup_dict.get(gene_id, {})
-        gene_chr = info.get("gene_chr", "NA")
-        species = chrom_to_species.get(gene_chr, "NA")
-        annot_rows.append(
-            [
-                species,
-                gene_chr,
-                info.get("gene_start", "NA"),
-                info.get("gene_end", "NA"),
-                info.get("gene_strand", "NA"),
-                info.get("gene_length_kb", "NA"),
-                info.get("gene_type", "NA"),
-            ]
-        )
+    if shards is not None:
+        shards.prune()
+        shards.report("ReadsPerGene")
 
-    annot_df = pd.DataFrame(
-        annot_rows,
-        columns=[
-            "species",
-            "gene_chr",
-            "gene_start",
-            "gene_end",
-            "gene_strand",
-            "gene_length_kb",
-            "gene_type",
-        ],
-        index=counts_df.index,
-    )
+    counts_df = build_counts_matrix(all_counts)
+    counts_df = counts_df[~counts_df.index.str.startswith("N_")]
 
-    final_df = pd.concat([annot_df, counts_df], axis=1)
-    final_df.index = final_df.index.map(
-        lambda gid: lookup_dict.get(gid, {}).get("gene_id", gid)
-        + "|"
-        + lookup_dict.get(gid, {}).get("gene_name", "NA")
+    final_df = annotate_counts(counts_df, lookup_dict, chrom_to_species, gene_lengths)
+    write_matrix(
+        final_df,
+        output_counts,
+        value_columns=counts_df.columns,
+        kind="counts",
+        index=True,
+        binary=binary,
     )
-    final_df.to_csv(output_counts, sep="\t")
 
     # strand file with 4 columns
     strand_df = pd.DataFrame(
@@ -270,8 +361,15 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--strandinfo",
-        required=True,
-        help="Comma-separated list of strandedness summary files",
+        required=False,
+        default="",
+        help="Comma-separated list of RSeQC infer_experiment.py outputs (required with --strandedness_method rseqc)",
+    )
+    parser.add_argument(
+        "--strandedness_method",
+        choices=["star", "rseqc"],
+        default="star",
+        help="Infer strandedness from STAR ReadsPerGene.out.tab forward/reverse columns (star) or from RSeQC infer_experiment.py output (rseqc). Default: star",
     )
     parser.add_argument(
         "--output_counts", required=True, help="Path to output annotated count matrix"
@@ -282,6 +380,12 @@ if __name__ == "__main__":
         help="Path to output sample-strandedness table",
     )
     parser.add_argument("--gtf", required=True, help="Gene annotation GTF file")
+    parser.add_argument(
+        "--annotation_cache",
+        required=False,
+        default=None,
+        help="Directory holding the parsed annotation index (default: <gtf dir>/annotation_index)",
+    )
     parser.add_argument(
         "--regions",
         required=True,
@@ -308,10 +412,45 @@ if __name__ == "__main__":
         help="Fraction threshold for inference (default=0.8)",
     )
 
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of count files to read in parallel (default=1)",
+    )
+    parser.add_argument(
+        "--parquet",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Also write a typed .parquet companion of the count matrix when pyarrow is available (default: True)",
+    )
+    parser.add_argument(
+        "--shard_cache",
+        default=None,
+        help="Directory of per-sample shards; only new or changed count files are parsed (default: off)",
+    )
+    parser.add_argument(
+        "--gene_lengths",
+        default="longest",
+        help="Comma-separated gene length definitions to write: longest (gene_length_kb, always written), union (gene_union_length_kb), mean (gene_mean_length_kb). Default: longest",
+    )
+
     args = parser.parse_args()
 
     count_files = args.counts.split(",")
-    strandedness_files = args.strandinfo.split(",")
+    strandedness_files = args.strandinfo.split(",") if args.strandinfo else []
+    if args.strandedness_method == "rseqc" and len(strandedness_files) != len(
+        count_files
+    ):
+        parser.error(
+            "--strandinfo must list one strandedness file per counts file with --strandedness_method rseqc"
+        )
+    gene_lengths = [d for d in args.gene_lengths.split(",") if d]
+    unknown = [d for d in gene_lengths if d not in GENE_LENGTH_COLUMNS]
+    if unknown:
+        parser.error(
+            f"--gene_lengths: unknown definition(s) {unknown}; choose from {list(GENE_LENGTH_COLUMNS)}"
+        )
     output_counts = args.output_counts
     output_strand = args.output_strand
 
@@ -326,6 +465,12 @@ if __name__ == "__main__":
         args.manifest_file,
         args.strandinfo_column,
         args.infer_strandedness_fraction,
+        args.annotation_cache,
+        args.strandedness_method,
+        args.jobs,
+        args.parquet,
+        args.shard_cache,
+        gene_lengths,
     )
     print(f"Output written to {output_counts} and {output_strand}")
     sys.exit(0)
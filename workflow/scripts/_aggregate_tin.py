@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 
+import argparse
+import numpy as np
 import pandas as pd
 from pathlib import Path
-import sys
+
+from _matrix_io import write_matrix
+
+KEY_COLUMNS = ["geneID", "chrom", "tx_start", "tx_end"]
 
 
 def get_sample_name(path: Path) -> str:
@@ -10,36 +15,118 @@ def get_sample_name(path: Path) -> str:
     return path.stem.replace(".Aligned.sortedByCoord.out.tin", "")
 
 
-def main(file_list, output="aggregate_tin.tsv"):
-    dfs = []
+def summarize_tin(matrix, samples):
+    """
+    Per-sample TIN summary over transcripts with TIN > 0, mirroring RSeQC's
+    summary.txt (transcripts without coverage report TIN 0).
+    """
+    rows = []
+    for j, sample in enumerate(samples):
+        tin = matrix[:, j]
+        tin = tin[~np.isnan(tin) & (tin > 0)].astype(np.float64)
+        if tin.size:
+            rows.append((sample, tin.size, tin.mean(), np.median(tin), tin.std(ddof=0)))
+        else:
+            rows.append((sample, 0, np.nan, np.nan, np.nan))
+    return pd.DataFrame(
+        rows,
+        columns=["Sample", "transcripts", "TIN_mean", "TIN_median", "TIN_stdev"],
+    )
+
+
+def write_summary(summary, output):
+    """Write the summary as MultiQC custom content (picked up from *_mqc.tsv files)."""
+    with open(output, "w") as f:
+        f.write("# id: 'harold_tin_summary'\n")
+        f.write("# section_name: 'TIN summary'\n")
+        f.write(
+            "# description: 'Per-sample transcript integrity (RSeQC tin.py), transcripts with TIN > 0'\n"
+        )
+        f.write("# plot_type: 'table'\n")
+        summary.to_csv(f, sep="\t", index=False, float_format="%.3f")
+
+
+def main(
+    file_list,
+    output="aggregate_tin.tsv",
+    summary_output=None,
+    dtype="float32",
+    binary=True,
+):
+    samples = [get_sample_name(Path(file)) for file in file_list]
+    n_samples = len(samples)
 
-    for file in file_list:
-        path = Path(file)
-        sample = get_sample_name(path)
+    keys = None  # MultiIndex over KEY_COLUMNS, in order of first appearance
+    matrix = None
 
+    # stream one sample at a time into a preallocated transcript x sample matrix
+    for j, file in enumerate(file_list):
         # Read as tab-delimited
-        df = pd.read_csv(path, sep="\t")
+        df = pd.read_csv(file, sep="\t", usecols=KEY_COLUMNS + ["TIN"])
+        sample_keys = pd.MultiIndex.from_frame(df[KEY_COLUMNS])
 
-        # Keep first 4 columns, rename TIN to sample name
-        df = df[["geneID", "chrom", "tx_start", "tx_end", "TIN"]].copy()
-        df = df.rename(columns={"TIN": sample})
+        if keys is None:
+            keys = sample_keys.unique()
+            matrix = np.full((len(keys), n_samples), np.nan, dtype=dtype)
 
-        dfs.append(df)
+        rows = keys.get_indexer(sample_keys)
+        if (rows < 0).any():
+            new_keys = sample_keys[rows < 0].unique()
+            keys = keys.append(new_keys)
+            matrix = np.vstack(
+                [matrix, np.full((len(new_keys), n_samples), np.nan, dtype=dtype)]
+            )
+            rows = keys.get_indexer(sample_keys)
 
-    # Merge all on the first four columns
-    merged = dfs[0]
-    for df in dfs[1:]:
-        merged = pd.merge(
-            merged, df, on=["geneID", "chrom", "tx_start", "tx_end"], how="outer"
-        )
+        matrix[rows, j] = df["TIN"].to_numpy(dtype=dtype)
+
+    if n_samples == 1:
+        # nothing to merge: the rows stay as they are in the file
+        key_df = df[KEY_COLUMNS].reset_index(drop=True)
+        matrix = df["TIN"].to_numpy(dtype=dtype).reshape(-1, 1)
+    else:
+        # same row order as the outer merge this replaces (lexicographic on the keys)
+        key_df = keys.to_frame(index=False)
+        order = key_df.sort_values(KEY_COLUMNS, kind="stable").index.to_numpy()
+        key_df = key_df.iloc[order].reset_index(drop=True)
+        matrix = matrix[order]
+
+    merged = pd.concat([key_df, pd.DataFrame(matrix, columns=samples)], axis=1)
 
     # Save to file
-    merged.to_csv(output, sep="\t", index=False)
+    write_matrix(merged, output, samples, kind="float", binary=binary)
+    if summary_output:
+        write_summary(summarize_tin(matrix, samples), summary_output)
     # print(f"✅ Wrote {output} with {len(merged)} rows and {len(merged.columns)-4} samples")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print(f"Usage: {sys.argv[0]} file1.tin.xls file2.tin.xls ...")
-        sys.exit(1)
-    main(sys.argv[1:])
+    parser = argparse.ArgumentParser(
+        description="Aggregate RSeQC tin.py *.tin.xls files into a transcript x sample TIN matrix."
+    )
+    parser.add_argument("files", nargs="+", help="Per-sample *.tin.xls files")
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="aggregate_tin.tsv",
+        help="Output TIN matrix (default: aggregate_tin.tsv)",
+    )
+    parser.add_argument(
+        "--summary",
+        default=None,
+        help="Optional per-sample TIN mean/median summary (MultiQC custom content)",
+    )
+    parser.add_argument(
+        "--dtype",
+        choices=["float32", "float64"],
+        default="float32",
+        help="Storage type of the TIN matrix (default: float32)",
+    )
+    parser.add_argument(
+        "--parquet",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Also write a typed .parquet companion when pyarrow is available (default: True)",
+    )
+    args = parser.parse_args()
+    main(args.files, args.output, args.summary, args.dtype, args.parquet)
@@ -1,87 +1,249 @@
+import numpy as np
 import pandas as pd
 import argparse
 import os
-import re
-
-def parse_gtf(gtf_path):
-    gtf_data = {}
-    with open(gtf_path, 'r') as gtf:
-        for line in gtf:
-            if line.startswith('#'):
-                continue
-            fields = line.strip().split('\t')
-            if len(fields) < 9 or fields[2] != 'transcript':
-                continue
-            attributes = fields[8]
-            gene_id_match = re.search('gene_id "(.*?)"', attributes)
-            transcript_id_match = re.search('transcript_id "(.*?)"', attributes)
-            gene_name_match = re.search('gene_name "(.*?)"', attributes)
-
-            if transcript_id_match:
-                transcript_id = transcript_id_match.group(1)
-                gene_id = gene_id_match.group(1) if gene_id_match else 'NA'
-                gene_name = gene_name_match.group(1) if gene_name_match else gene_id
-                gtf_data[transcript_id] = {'gene_id': gene_id, 'gene_name': gene_name}
-    return pd.DataFrame.from_dict(gtf_data, orient='index').reset_index().rename(columns={'index': 'transcript_id'})
 
-def merge_with_gtf(df, gtf_df):
-    df = df.rename(columns={'accession': 'transcript_id'})
-    merged = pd.merge(df, gtf_df, on='transcript_id', how='left')
-    merged['gene_name'] = merged['gene_name'].fillna(merged['gene_id'])
-    return merged
-
-def aggregate_files(input_files, gtf_path, output_fpkm, output_tpm, output_fragcount):
-    gtf_df = parse_gtf(gtf_path)
-
-    common_cols = ["chrom", "st", "end", "transcript_id", "mRNA_size", "gene_strand"]
-    fpkm_list, tpm_list, fragcount_list = [], [], []
-
-    for f in input_files:
-        sample_name = os.path.basename(f).replace(".rseqc_fpkm_tpm.tsv", "")
-        df = pd.read_csv(f, sep='\t')
+from _annotation_index import load_annotation_index
+from _matrix_io import write_matrix
+from _sample_shards import ShardCache
 
-        if 'FPKM' not in df.columns or 'TPM' not in df.columns or 'Frag_count' not in df.columns:
-            raise ValueError(f"File {f} missing one of the required columns: FPKM, TPM, or Frag_count.")
 
-        df = merge_with_gtf(df, gtf_df)
+def parse_gtf(gtf_path, cache_dir=None):
+    transcripts = load_annotation_index(gtf_path, cache_dir).table("transcripts")
+    gtf_df = pd.DataFrame(transcripts).replace({"gene_id": {"": "NA"}})
+    gtf_df["gene_name"] = gtf_df["gene_name"].mask(
+        gtf_df["gene_name"] == "", gtf_df["gene_id"]
+    )
+    # keep the last record when a transcript_id is repeated, as the text parser did
+    return gtf_df.drop_duplicates("transcript_id", keep="last").reset_index(drop=True)
 
-        fpkm_df = df[common_cols + ['gene_id', 'gene_name', 'FPKM']].copy()
-        tpm_df = df[common_cols + ['gene_id', 'gene_name', 'TPM']].copy()
-        fragcount_df = df[common_cols + ['gene_id', 'gene_name', 'Frag_count']].copy()
 
-        fpkm_df.rename(columns={'FPKM': sample_name}, inplace=True)
-        tpm_df.rename(columns={'TPM': sample_name}, inplace=True)
-        fragcount_df.rename(columns={'Frag_count': sample_name}, inplace=True)
-
-        fpkm_list.append(fpkm_df)
-        tpm_list.append(tpm_df)
-        fragcount_list.append(fragcount_df)
+def merge_with_gtf(df, gtf_df):
+    df = df.rename(columns={"accession": "transcript_id"})
+    merged = pd.merge(df, gtf_df, on="transcript_id", how="left")
+    merged["gene_name"] = merged["gene_name"].fillna(merged["gene_id"])
+    return merged
 
-    def merge_list(df_list):
-        merged = df_list[0]
-        for df_next in df_list[1:]:
-            merged = pd.merge(merged, df_next, on=common_cols + ['gene_id', 'gene_name'], how='inner')
-        return merged
 
-    fpkm_merged = merge_list(fpkm_list)
-    tpm_merged = merge_list(tpm_list)
-    fragcount_merged = merge_list(fragcount_list)
+VALUE_COLS = ["FPKM", "TPM", "Frag_count"]
+MISSING_POLICIES = ["drop", "zero", "na"]
+COMMON_COLS = ["chrom", "st", "end", "transcript_id", "mRNA_size", "gene_strand"]
+
+
+def read_sample(f, shards=None):
+    """
+    Read the key and value columns of one rseqc_fpkm_tpm.tsv, from its shard in the
+    ShardCache when the file is unchanged since it was last parsed.
+    """
+    if shards is not None:
+        cached = shards.load(f)
+        if cached is not None:
+            return pd.DataFrame(
+                {
+                    c: (a.astype(object) if a.dtype.kind == "U" else a)
+                    for c, a in cached.items()
+                }
+            )
+
+    df = pd.read_csv(f, sep="\t")
+
+    if (
+        "FPKM" not in df.columns
+        or "TPM" not in df.columns
+        or "Frag_count" not in df.columns
+    ):
+        raise ValueError(
+            f"File {f} missing one of the required columns: FPKM, TPM, or Frag_count."
+        )
+
+    df = df.rename(columns={"accession": "transcript_id"})[COMMON_COLS + VALUE_COLS]
+    if shards is not None and not df.isna().any().any():
+        shards.store(
+            f,
+            {
+                c: (
+                    df[c].to_numpy()
+                    if df[c].dtype.kind in "biuf"
+                    else df[c].to_numpy(dtype=str)
+                )
+                for c in df.columns
+            },
+        )
+    return df
+
+
+def aggregate_files(
+    input_files,
+    gtf_path,
+    output_fpkm,
+    output_tpm,
+    output_fragcount,
+    annotation_cache=None,
+    missing="drop",
+    binary=True,
+    shard_cache=None,
+):
+    """
+    Read every sample file once and place its FPKM, TPM and Frag_count columns into
+    (transcript x sample) arrays keyed by the transcript metadata columns, then join the
+    GTF annotation once. Transcripts absent from some samples are handled per `missing`:
+    drop (keep only transcripts seen in every sample), zero (fill with 0) or na (leave empty).
+    """
+    if missing not in MISSING_POLICIES:
+        raise ValueError(
+            f"Unknown missing-transcript policy '{missing}'. Valid values are: {', '.join(MISSING_POLICIES)}."
+        )
+    gtf_df = parse_gtf(gtf_path, annotation_cache)
+
+    sample_names = [
+        os.path.basename(f).replace(".rseqc_fpkm_tpm.tsv", "") for f in input_files
+    ]
+    n_samples = len(input_files)
+
+    keys = None  # MultiIndex over COMMON_COLS, in order of first appearance
+    values = {}
+    dtypes = {c: [] for c in VALUE_COLS}
+    present = None
+    shards = ShardCache(shard_cache, "rseqc_fpkm") if shard_cache else None
+
+    for j, f in enumerate(input_files):
+        df = read_sample(f, shards)
+        sample_keys = pd.MultiIndex.from_frame(df[COMMON_COLS])
+
+        if keys is None:
+            # preallocate from the first sample; later samples rarely add rows
+            keys = sample_keys.unique()
+            values = {c: np.full((len(keys), n_samples), np.nan) for c in VALUE_COLS}
+            present = np.zeros((len(keys), n_samples), dtype=bool)
+
+        rows = keys.get_indexer(sample_keys)
+        if (rows < 0).any():
+            new_keys = sample_keys[rows < 0].unique()
+            keys = keys.append(new_keys)
+            for c in VALUE_COLS:
+                values[c] = np.vstack(
+                    [values[c], np.full((len(new_keys), n_samples), np.nan)]
+                )
+            present = np.vstack(
+                [present, np.zeros((len(new_keys), n_samples), dtype=bool)]
+            )
+            rows = keys.get_indexer(sample_keys)
+
+        for c in VALUE_COLS:
+            values[c][rows, j] = df[c].to_numpy()
+            dtypes[c].append(df[c].dtype)
+        present[rows, j] = True
+
+    if shards is not None:
+        shards.prune()
+        shards.report("rseqc_fpkm_tpm")
+
+    keep = np.ones(len(keys), dtype=bool)
+    n_partial = int((~present.all(axis=1)).sum())
+    if missing == "drop":
+        keep = present.all(axis=1)
+        if n_partial:
+            print(
+                f"⚠️ WARNING: dropped {n_partial} transcripts missing from at least one sample (--missing drop)."
+            )
+    elif n_partial:
+        print(
+            f"{n_partial} transcripts are missing from at least one sample; filled with {'0' if missing == 'zero' else 'NA'} (--missing {missing})."
+        )
+
+    # annotation is joined once for all samples
+    annot_df = merge_with_gtf(keys[keep].to_frame(index=False), gtf_df)
+    annot_df = annot_df[COMMON_COLS + ["gene_id", "gene_name"]]
+
+    def assemble(value_col):
+        matrix = values[value_col][keep]
+        if missing == "zero":
+            matrix = np.nan_to_num(matrix, nan=0.0)
+        if not np.isnan(matrix).any():
+            matrix = matrix.astype(np.result_type(*dtypes[value_col]))
+        return pd.concat([annot_df, pd.DataFrame(matrix, columns=sample_names)], axis=1)
+
+    write_matrix(
+        assemble("FPKM"), output_fpkm, sample_names, kind="float", binary=binary
+    )
+    write_matrix(assemble("TPM"), output_tpm, sample_names, kind="float", binary=binary)
+    write_matrix(
+        assemble("Frag_count"),
+        output_fragcount,
+        sample_names,
+        kind="counts",
+        binary=binary,
+    )
 
-    fpkm_merged.to_csv(output_fpkm, sep='\t', index=False)
-    tpm_merged.to_csv(output_tpm, sep='\t', index=False)
-    fragcount_merged.to_csv(output_fragcount, sep='\t', index=False)
 
 def main():
-    parser = argparse.ArgumentParser(description='Aggregate rseqc_fpkm_tpm.tsv files with GTF gene annotations into combined FPKM, TPM, and Frag_count matrices.')
-    parser.add_argument('--input', nargs='+', required=True, help='List of input rseqc_fpkm_tpm.tsv files to aggregate.')
-    parser.add_argument('--gtf', required=True, help='Reference GTF file (e.g., ref.fixed.gtf).')
-    parser.add_argument('-o1', '--fpkm_output', default='counts_matrix.transcript_level.fpkm.tsv', help='Output file for aggregated FPKM matrix.')
-    parser.add_argument('-o2', '--tpm_output', default='counts_matrix.transcript_level.tpm.tsv', help='Output file for aggregated TPM matrix.')
-    parser.add_argument('-o3', '--fragcount_output', default='counts_matrix.transcript_level.fragcount.tsv', help='Output file for aggregated Frag_count matrix.')
+    parser = argparse.ArgumentParser(
+        description="Aggregate rseqc_fpkm_tpm.tsv files with GTF gene annotations into combined FPKM, TPM, and Frag_count matrices."
+    )
+    parser.add_argument(
+        "--input",
+        nargs="+",
+        required=True,
+        help="List of input rseqc_fpkm_tpm.tsv files to aggregate.",
+    )
+    parser.add_argument(
+        "--gtf", required=True, help="Reference GTF file (e.g., ref.fixed.gtf)."
+    )
+    parser.add_argument(
+        "--annotation_cache",
+        default=None,
+        help="Directory holding the parsed annotation index (default: <gtf dir>/annotation_index).",
+    )
+    parser.add_argument(
+        "-o1",
+        "--fpkm_output",
+        default="counts_matrix.transcript_level.fpkm.tsv",
+        help="Output file for aggregated FPKM matrix.",
+    )
+    parser.add_argument(
+        "-o2",
+        "--tpm_output",
+        default="counts_matrix.transcript_level.tpm.tsv",
+        help="Output file for aggregated TPM matrix.",
+    )
+    parser.add_argument(
+        "-o3",
+        "--fragcount_output",
+        default="counts_matrix.transcript_level.fragcount.tsv",
+        help="Output file for aggregated Frag_count matrix.",
+    )
+    parser.add_argument(
+        "--missing",
+        choices=MISSING_POLICIES,
+        default="drop",
+        help="Transcripts missing from some samples: drop them (default), fill with 0, or leave as NA.",
+    )
+    parser.add_argument(
+        "--shard_cache",
+        default=None,
+        help="Directory of per-sample shards; only new or changed input files are parsed (default: off).",
+    )
+    parser.add_argument(
+        "--parquet",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Also write typed .parquet companions of the matrices when pyarrow is available (default: True).",
+    )
 
     args = parser.parse_args()
 
-    aggregate_files(args.input, args.gtf, args.fpkm_output, args.tpm_output, args.fragcount_output)
+    aggregate_files(
+        args.input,
+        args.gtf,
+        args.fpkm_output,
+        args.tpm_output,
+        args.fragcount_output,
+        args.annotation_cache,
+        args.missing,
+        args.parquet,
+        args.shard_cache,
+    )
+
 
-if __name__ == '__main__':
+if __name__ == "__main__":
     main()
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+"""
+Parsed annotation index for GTF files.
+
+Every aggregation script used to re-parse ref.fixed.gtf as text. This module parses a
+GTF once into four column tables and stores them as uncompressed .npy files in a
+directory named after the SHA-256 of the GTF contents:
+
+    genes        gene_id, gene_name, gene_type, chrom, start, end, strand  (gene lines)
+    transcripts  transcript_id, gene_id, gene_name                        (transcript lines)
+    exon_groups  gene_id, transcript_id, offset                            (one row per transcript with exons)
+    exons        start, end                                                (sorted by exon group)
+
+Exons of group i are exons[offset[i]:offset[i + 1]]. Missing string attributes are
+stored as "" and callers apply their own defaults. Columns are memory-mapped on load,
+so reading the index for a full GENCODE annotation takes well under a second.
+
+AnnotationIndex.gene_lengths computes, with NumPy over the flat exon arrays, three
+gene lengths in bp (GENE_LENGTH_COLUMNS names their count matrix columns):
+
+    longest  longest transcript (its exons merged), the historical gene_length_kb
+    union    union of the exons of all transcripts of the gene
+    mean     mean transcript length
+
+BED12 gene models (ref.genes.bed12) are indexed the same way (load_bed12_index):
+
+    bed12        chrom, start, end, name, strand, length  (one row per BED line, in file order)
+    bed12_exons  transcript, start, end                   (all blocks, sorted by chrom and start)
+
+where length is the summed block length and transcript the row of the BED line.
+
+Usage:
+    python _annotation_index.py --gtf ref.fixed.gtf [--cache_dir DIR]
+    python _annotation_index.py --bed12 ref.genes.bed12 [--cache_dir DIR]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+INDEX_VERSION = 1
+CACHE_DIRNAME = "annotation_index"
+FINGERPRINTS_FILE = "fingerprints.json"
+
+TABLES = {
+    "genes": ["gene_id", "gene_name", "gene_type", "chrom", "start", "end", "strand"],
+    "transcripts": ["transcript_id", "gene_id", "gene_name"],
+    "exon_groups": ["gene_id", "transcript_id", "offset"],
+    "exons": ["start", "end"],
+}
+BED12_TABLES = {
+    "bed12": ["chrom", "start", "end", "name", "strand", "length"],
+    "bed12_exons": ["transcript", "start", "end"],
+}
+# gene length definition -> count matrix column (in kb)
+GENE_LENGTH_COLUMNS = {
+    "longest": "gene_length_kb",
+    "union": "gene_union_length_kb",
+    "mean": "gene_mean_length_kb",
+}
+
+
+def parse_attributes(attr_str):
+    """Parse GTF column 9 into a dict, e.g. 'gene_id "A"; gene_name "B";'."""
+    attributes = {}
+    for attr in attr_str.strip().split(";"):
+        attr = attr.strip()
+        if not attr:
+            continue
+        key, _, val = attr.partition(" ")
+        attributes[key] = val.strip().strip('"')
+    return attributes
+
+
+def default_cache_dir(gtf_path):
+    return os.path.join(os.path.dirname(os.path.abspath(gtf_path)), CACHE_DIRNAME)
+
+
+def _sha256(path, blocksize=1 << 23):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_content_hash(path, cache_dir):
+    """
+    Return the SHA-256 of path. The hash is remembered in cache_dir against the
+    file's size and mtime so that unchanged files are not re-read on every load.
+    """
+    real = os.path.realpath(path)
+    st = os.stat(real)
+    fp_file = os.path.join(cache_dir, FINGERPRINTS_FILE)
+    fingerprints = {}
+    if os.path.exists(fp_file):
+        try:
+            with open(fp_file) as f:
+                fingerprints = json.load(f)
+        except (OSError, ValueError):
+            fingerprints = {}
+    entry = fingerprints.get(real)
+    if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+        return entry["sha256"]
+
+    digest = _sha256(real)
+    fingerprints[real] = {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "sha256": digest,
+    }
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{fp_file}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(fingerprints, f, indent=1)
+        os.replace(tmp, fp_file)
+    except OSError as e:
+        print(
+            f"⚠️ WARNING: could not record file fingerprint in {cache_dir}: {e}",
+            file=sys.stderr,
+        )
+    return digest
+
+
+def _to_bytes_array(values):
+    arr = np.array([v.encode("utf-8") for v in values], dtype=bytes)
+    if arr.size == 0:
+        arr = np.array([], dtype="S1")
+    return arr
+
+
+def parse_gtf(gtf_path):
+    """Parse a GTF file into the column tables described in the module docstring."""
+    genes = {c: [] for c in TABLES["genes"]}
+    transcripts = {c: [] for c in TABLES["transcripts"]}
+    group_index = {}
+    group_gene, group_tx = [], []
+    exon_group, exon_start, exon_end = [], [], []
+
+    with open(gtf_path) as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) < 9:
+                continue
+            feature_type = parts[2]
+            if feature_type not in ("gene", "transcript", "exon"):
+                continue
+            attributes = parse_attributes(parts[8])
+            gene_id = attributes.get("gene_id", "")
+
+            if feature_type == "exon":
+                transcript_id = attributes.get("transcript_id", "")
+                if not gene_id or not transcript_id:
+                    continue
+                key = (gene_id, transcript_id)
+                group = group_index.get(key)
+                if group is None:
+                    group = group_index[key] = len(group_gene)
+                    group_gene.append(gene_id)
+                    group_tx.append(transcript_id)
+                exon_group.append(group)
+                exon_start.append(int(parts[3]))
+                exon_end.append(int(parts[4]))
+            elif feature_type == "gene":
+                if not gene_id:
+                    continue
+                genes["gene_id"].append(gene_id)
+                genes["gene_name"].append(attributes.get("gene_name", ""))
+                genes["gene_type"].append(attributes.get("gene_type", ""))
+                genes["chrom"].append(parts[0])
+                genes["start"].append(int(parts[3]))
+                genes["end"].append(int(parts[4]))
+                genes["strand"].append(parts[6])
+            else:
+                transcript_id = attributes.get("transcript_id", "")
+                if not transcript_id:
+                    continue
+                transcripts["transcript_id"].append(transcript_id)
+                transcripts["gene_id"].append(gene_id)
+                transcripts["gene_name"].append(attributes.get("gene_name", ""))
+
+    columns = {}
+    for table in ("genes", "transcripts"):
+        source = genes if table == "genes" else transcripts
+        for name, values in source.items():
+            if name in ("start", "end"):
+                columns[f"{table}.{name}"] = np.array(values, dtype=np.int64)
+            else:
+                columns[f"{table}.{name}"] = _to_bytes_array(values)
+
+    # exons grouped per (gene_id, transcript_id), in file order within a group
+    exon_group = np.array(exon_group, dtype=np.int64)
+    order = np.argsort(exon_group, kind="stable")
+    counts = np.bincount(exon_group, minlength=len(group_gene))
+    offset = np.zeros(len(group_gene) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offset[1:])
+    columns["exon_groups.gene_id"] = _to_bytes_array(group_gene)
+    columns["exon_groups.transcript_id"] = _to_bytes_array(group_tx)
+    columns["exon_groups.offset"] = offset
+    columns["exons.start"] = np.array(exon_start, dtype=np.int64)[order]
+    columns["exons.end"] = np.array(exon_end, dtype=np.int64)[order]
+    return columns
+
+
+def parse_bed12(bed12_path):
+    """Parse a BED12 file into the bed12/bed12_exons tables of the module docstring."""
+    rows = {c: [] for c in BED12_TABLES["bed12"]}
+    ex_tx, ex_start, ex_end = [], [], []
+    with open(bed12_path) as f:
+        for line in f:
+            if line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.split()
+            if len(fields) < 12:
+                continue
+            start = int(fields[1])
+            sizes = [int(x) for x in fields[10].rstrip(",").split(",")]
+            offsets = [int(x) for x in fields[11].rstrip(",").split(",")]
+            row = len(rows["chrom"])
+            for size, offset in zip(sizes, offsets):
+                ex_tx.append(row)
+                ex_start.append(start + offset)
+                ex_end.append(start + offset + size)
+            rows["chrom"].append(fields[0])
+            rows["start"].append(start)
+            rows["end"].append(int(fields[2]))
+            rows["name"].append(fields[3])
+            rows["strand"].append(fields[5])
+            rows["length"].append(sum(sizes))
+
+    columns = {}
+    for name, values in rows.items():
+        if name in ("start", "end", "length"):
+            columns[f"bed12.{name}"] = np.array(values, dtype=np.int64)
+        else:
+            columns[f"bed12.{name}"] = _to_bytes_array(values)
+    ex_tx = np.array(ex_tx, dtype=np.int64)
+    ex_start = np.array(ex_start, dtype=np.int64)
+    ex_chrom = columns["bed12.chrom"][ex_tx] if len(ex_tx) else ex_tx
+    order = np.lexsort((ex_start, ex_chrom))
+    columns["bed12_exons.transcript"] = ex_tx[order]
+    columns["bed12_exons.start"] = ex_start[order]
+    columns["bed12_exons.end"] = np.array(ex_end, dtype=np.int64)[order]
+    return columns
+
+
+def union_lengths(groups, starts, ends, ngroups):
+    """
+    Length of the union of the closed intervals [start, end] of every group, in one
+    pass: intervals are sorted by (group, start) and each adds the part beyond the
+    furthest end seen so far in its group.
+    """
+    if len(groups) == 0:
+        return np.zeros(ngroups, dtype=np.int64)
+    order = np.lexsort((starts, groups))
+    groups = groups[order]
+    # offset every group past the previous one so a single running max serves all
+    span = int(max(starts.max(), ends.max())) + 2
+    base = groups * span
+    starts = starts[order] - 1 + base
+    ends = ends[order] + base
+    reach = np.empty_like(ends)
+    reach[0] = starts[0]
+    np.maximum.accumulate(ends[:-1], out=reach[1:])
+    covered = np.maximum(ends - np.maximum(starts, reach), 0)
+    return np.bincount(groups, weights=covered, minlength=ngroups).astype(np.int64)
+
+
+class AnnotationIndex:
+    """Read access to a parsed GTF; columns are memory-mapped lazily from disk."""
+
+    def __init__(self, path=None, columns=None, meta=None):
+        self.path = path
+        self.meta = meta or {}
+        self._columns = dict(columns or {})
+        if path is not None and not self.meta:
+            with open(os.path.join(path, "meta.json")) as f:
+                self.meta = json.load(f)
+
+    def column(self, table, name):
+        key = f"{table}.{name}"
+        if key not in self._columns:
+            self._columns[key] = np.load(
+                os.path.join(self.path, f"{key}.npy"), mmap_mode="r"
+            )
+        return self._columns[key]
+
+    def strings(self, table, name):
+        """Return a string column decoded to a list of str."""
+        arr = self.column(table, name)
+        if arr.size == 0:
+            return []
+        return np.char.decode(arr, "utf-8").tolist()
+
+    def table(self, table):
+        """Return a table as a dict of column name -> list of str or int64 array."""
+        out = {}
+        for name in TABLES.get(table) or BED12_TABLES[table]:
+            arr = self.column(table, name)
+            out[name] = self.strings(table, name) if arr.dtype.kind == "S" else arr
+        return out
+
+    def gene_lengths(self):
+        """
+        Gene lengths in bp of every gene with exons: (gene_ids, {"longest": array,
+        "union": array, "mean": array}); see the module docstring.
+        """
+        offset = self.column("exon_groups", "offset")
+        starts = np.asarray(self.column("exons", "start"))
+        ends = np.asarray(self.column("exons", "end"))
+        ngroups = len(offset) - 1
+        exon_group = np.repeat(np.arange(ngroups), np.diff(offset))
+        transcript = union_lengths(exon_group, starts, ends, ngroups)
+
+        names, gene = np.unique(
+            self.column("exon_groups", "gene_id"), return_inverse=True
+        )
+        longest = np.zeros(len(names), dtype=np.int64)
+        np.maximum.at(longest, gene, transcript)
+        lengths = {
+            "longest": longest,
+            "union": union_lengths(gene[exon_group], starts, ends, len(names)),
+            "mean": np.bincount(gene, weights=transcript, minlength=len(names))
+            / np.bincount(gene, minlength=len(names)),
+        }
+        return np.char.decode(names, "utf-8").tolist(), lengths
+
+    def transcript_to_gene(self):
+        return dict(
+            zip(
+                self.strings("transcripts", "transcript_id"),
+                self.strings("transcripts", "gene_id"),
+            )
+        )
+
+
+def _write_index(columns, meta, cache_dir, digest):
+    final = os.path.join(cache_dir, digest)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=f".{digest}.", dir=cache_dir)
+    try:
+        for key, arr in columns.items():
+            np.save(os.path.join(tmp, f"{key}.npy"), arr)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=1)
+        os.rename(tmp, final)
+    except OSError:
+        # another job finished the same index first
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.exists(os.path.join(final, "meta.json")):
+            raise
+    return final
+
+
+def _load_index(path, cache_dir, parse, tables):
+    cache_dir = cache_dir or default_cache_dir(path)
+    digest = file_content_hash(path, cache_dir)
+    index_dir = os.path.join(cache_dir, digest)
+    meta_file = os.path.join(index_dir, "meta.json")
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta.get("version") == INDEX_VERSION:
+            return AnnotationIndex(index_dir, meta=meta)
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+    print(f"Building annotation index for {path} ...", file=sys.stderr)
+    columns = parse(path)
+    meta = {
+        "version": INDEX_VERSION,
+        "sha256": digest,
+        "source": os.path.realpath(path),
+        "rows": {t: int(len(columns[f"{t}.{c[0]}"])) for t, c in tables.items()},
+    }
+    try:
+        index_dir = _write_index(columns, meta, cache_dir, digest)
+    except OSError as e:
+        print(
+            f"⚠️ WARNING: could not write annotation index to {cache_dir}: {e}",
+            file=sys.stderr,
+        )
+        return AnnotationIndex(columns=columns, meta=meta)
+    return AnnotationIndex(index_dir, meta=meta)
+
+
+def load_annotation_index(gtf_path, cache_dir=None):
+    """
+    Return the AnnotationIndex for gtf_path, building and caching it on first use.
+    cache_dir defaults to <gtf directory>/annotation_index.
+    """
+    return _load_index(gtf_path, cache_dir, parse_gtf, TABLES)
+
+
+def load_bed12_index(bed12_path, cache_dir=None):
+    """
+    Return the AnnotationIndex (bed12 and bed12_exons tables) for a BED12 file,
+    building and caching it on first use, keyed by content like the GTF index.
+    """
+    return _load_index(bed12_path, cache_dir, parse_bed12, BED12_TABLES)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build (or validate) the cached annotation index for a GTF file."
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--gtf", help="GTF file, e.g. ref.fixed.gtf")
+    source.add_argument("--bed12", help="BED12 gene model, e.g. ref.genes.bed12")
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help=f"Index cache directory (default: <annotation dir>/{CACHE_DIRNAME})",
+    )
+    args = parser.parse_args()
+
+    if args.gtf:
+        index = load_annotation_index(args.gtf, args.cache_dir)
+    else:
+        index = load_bed12_index(args.bed12, args.cache_dir)
+    print(
+        f"✅ Annotation index for {args.gtf or args.bed12}: {index.path} {index.meta['rows']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Single-pass binned coverage: every species bigwig of a sample from one walk over
+the coordinate-sorted, indexed BAM.
+
+deepTools bamCoverage is run once per split species BAM and re-reads each of them.
+Here every contig is read once (contigs are spread over a process pool), the aligned
+blocks of each read are collected into arrays and binned with NumPy the way
+bamCoverage counts them without read extension: a read adds 1 to every bin touched by
+one of its blocks (pysam get_blocks, so N/D gaps are not covered), secondary,
+supplementary and duplicate alignments included. Bins are then scaled per species:
+
+    CPM   1e6 / mapped reads of the species
+    RPKM  1e6 / mapped reads of the species * 1000 / bin size
+    None  raw counts
+
+where "mapped reads of the species" is the idxstats mapped count summed over its
+chromosomes, i.e. the number bamCoverage takes from the split BAM. Runs of equal
+bins are merged into one bigwig interval and values are rounded to 6 significant
+digits as in bamCoverage's bedGraph. Each bigwig header lists the chromosomes of its
+species only.
+
+With --strandedness (sample_strandedness.tsv) <prefix>.<species>.fwd.bw and .rev.bw
+are written as well, reads assigned to the transcript strand with the same RSeQC
+strand rules as _get_strand.py; an unstranded sample gets all-zero strand tracks.
+"""
+
+import argparse
+import csv
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyBigWig
+import pysam
+
+NORMALIZATIONS = ("CPM", "RPKM", "None")
+# blocks collected before they are binned
+BLOCK_BUFFER = 1 << 20
+
+_worker = {}
+
+
+def strand_rule(strandedness, sample, peorse):
+    """RSeQC strand rule of sample from sample_strandedness.tsv, as _get_strand.py."""
+    with open(strandedness) as f:
+        rows = [r for r in csv.DictReader(f, delimiter="\t") if r["sample"] == sample]
+    if not rows:
+        sys.exit(f"❌ Sample '{sample}' not found in {strandedness}.")
+    used_strand = rows[0]["used_strand"].strip().lower()
+    if used_strand == "unstranded":
+        return None
+    if used_strand == "reverse":
+        return "1++,1--,2+-,2-+" if peorse == "PE" else "++,--"
+    if used_strand == "forward":
+        return "1+-,1-+,2++,2--" if peorse == "PE" else "+-,-+"
+    sys.exit(f"❌ Unknown used_strand '{used_strand}' for sample '{sample}'.")
+
+
+def strand_table(rule):
+    """
+    RSeQC rule ("1++,1--,2+-,2-+" or "++,--") -> 4 entries indexed by
+    2 * read2 + reverse, holding the track of the read (0 = fwd, 1 = rev); read2 means
+    a paired read with the second-mate flag.
+    """
+    table = [0, 1, 0, 1]
+    for key in rule.split(","):
+        mate, read_strand, gene_strand = (
+            (key[0], key[1], key[2]) if len(key) == 3 else (None, key[0], key[1])
+        )
+        track = 0 if gene_strand == "+" else 1
+        reverse = 1 if read_strand == "-" else 0
+        for read2 in (0, 1) if mate is None else (int(mate) - 1,):
+            table[2 * read2 + reverse] = track
+    return table
+
+
+def _init_worker(bam, bin_size, table):
+    _worker.update(bam=bam, bin_size=bin_size, table=table)
+
+
+def _bin_blocks(cov, starts, ends, first, bin_size):
+    """Add blocks to per-bin read counts (cov is a difference array of nbins + 1)."""
+    nbins = len(cov) - 1
+    starts = np.frombuffer(starts, dtype=np.int64)
+    ends = np.frombuffer(ends, dtype=np.int64)
+    first = np.frombuffer(first, dtype=np.int8).astype(bool)
+    s_idx = starts // bin_size
+    e_idx = np.minimum(-(-ends // bin_size), nbins)
+    # a bin shared by two blocks of one read counts once; blocks of a read are in
+    # order, so the previous block has the largest end bin so far
+    prev = np.empty_like(e_idx)
+    prev[0] = 0
+    prev[1:] = e_idx[:-1]
+    s_idx = np.where(first, s_idx, np.maximum(s_idx, prev))
+    keep = s_idx < e_idx
+    cov += np.bincount(s_idx[keep], minlength=nbins + 1)[: nbins + 1]
+    cov -= np.bincount(e_idx[keep], minlength=nbins + 1)[: nbins + 1]
+
+
+def _runs(cov):
+    """Difference array -> (first bin of each run of equal counts, counts)."""
+    counts = np.cumsum(cov[:-1])
+    change = np.flatnonzero(counts[1:] != counts[:-1]) + 1
+    bins = np.concatenate(([0], change))
+    return bins, counts[bins]
+
+
+def walk_contig(job):
+    """One pass over the reads of a contig; returns run-length coverage per track."""
+    contig, length = job
+    bin_size, table = _worker["bin_size"], _worker["table"]
+    nbins = -(-length // bin_size)
+    tracks = 1 if table is None else 3
+    covs = [np.zeros(nbins + 1, dtype=np.int64) for _ in range(tracks)]
+    buffers = [(array("q"), array("q"), array("b")) for _ in range(tracks)]
+
+    with pysam.AlignmentFile(_worker["bam"], "rb") as bam:
+        for read in bam.fetch(contig):
+            flag = read.flag
+            if flag & 0x4:
+                continue
+            blocks = read.get_blocks()
+            if not blocks:
+                continue
+            if table is None:
+                targets = (0,)
+            else:
+                track = table[2 * ((flag & 0x81) == 0x81) + ((flag & 0x10) >> 4)]
+                targets = (0,) if track is None else (0, 1 + track)
+            for t in targets:
+                starts, ends, first = buffers[t]
+                mark = 1
+                for s, e in blocks:
+                    starts.append(s)
+                    ends.append(e)
+                    first.append(mark)
+                    mark = 0
+                if len(first) >= BLOCK_BUFFER:
+                    _bin_blocks(covs[t], starts, ends, first, bin_size)
+                    buffers[t] = (array("q"), array("q"), array("b"))
+    for t in range(tracks):
+        if buffers[t][2]:
+            _bin_blocks(covs[t], *buffers[t], bin_size)
+    return [_runs(cov) for cov in covs]
+
+
+def scale_factor(normalize, mapped, bin_size):
+    if normalize == "None" or mapped == 0:
+        return 1.0
+    factor = 1.0 / (mapped / 1e6)
+    if normalize == "RPKM":
+        factor *= 1.0 / (bin_size / 1000)
+    return factor
+
+
+def write_bigwig(path, chroms, runs, scale, bin_size):
+    """chroms: [(name, length)] in BAM order; runs: {name: (bins, counts)}"""
+    bw = pyBigWig.open(path, "w")
+    bw.addHeader(chroms)
+    for chrom, length in chroms:
+        bins, counts = runs[chrom]
+        starts = bins * bin_size
+        ends = np.append(starts[1:], length)
+        # bamCoverage passes values through a "{:g}" bedGraph (6 significant digits)
+        uniq, inverse = np.unique(counts, return_inverse=True)
+        values = np.array([float(f"{float(u) * scale:g}") for u in uniq])[inverse]
+        bw.addEntries(
+            [chrom] * len(starts),
+            starts.tolist(),
+            ends=ends.tolist(),
+            values=values.tolist(),
+        )
+    bw.close()
+
+
+def parse_regions(regions_file):
+    """ref.fa.regions.host_viruses lines "<species> <chrom> [<chrom> ...]" -> {species: [chroms]}"""
+    species = {}
+    with open(regions_file) as f:
+        for line in f:
+            fields = line.split()
+            if fields:
+                species.setdefault(fields[0], []).extend(fields[1:])
+    return species
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Binned, normalized coverage bigwigs of every species in one pass over a sorted, indexed BAM."
+    )
+    parser.add_argument("--bam", required=True, help="Coordinate-sorted, indexed BAM")
+    parser.add_argument(
+        "--regions",
+        required=True,
+        help="Species regions file (ref.fa.regions.host_viruses)",
+    )
+    parser.add_argument(
+        "--prefix", required=True, help="Bigwigs are written to <prefix>.<species>.bw"
+    )
+    parser.add_argument(
+        "--bin_size", type=int, default=10, help="Bin size in bp (default: 10)"
+    )
+    parser.add_argument(
+        "--normalize",
+        default="CPM",
+        choices=NORMALIZATIONS,
+        help="Normalization, as bamCoverage --normalizeUsing (default: CPM)",
+    )
+    parser.add_argument(
+        "--strandedness",
+        help="sample_strandedness.tsv; also write <prefix>.<species>.fwd.bw/.rev.bw",
+    )
+    parser.add_argument("--sample", help="Sample name in --strandedness")
+    parser.add_argument("--peorse", choices=["PE", "SE"], help="Sequencing type")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Contigs processed in parallel (default: 1)",
+    )
+    args = parser.parse_args()
+
+    table = None
+    if args.strandedness:
+        if not (args.sample and args.peorse):
+            parser.error("--strandedness needs --sample and --peorse")
+        rule = strand_rule(args.strandedness, args.sample, args.peorse)
+        if rule is None:
+            print(
+                f"⚠️ WARNING: {args.sample} is unstranded, its strand tracks are empty",
+                file=sys.stderr,
+            )
+            # every read goes to the combined track only
+            table = [None] * 4
+        else:
+            table = strand_table(rule)
+
+    species = parse_regions(args.regions)
+    with pysam.AlignmentFile(args.bam, "rb") as bam:
+        lengths = dict(zip(bam.references, bam.lengths))
+        mapped = {s.contig: s.mapped for s in bam.get_index_statistics()}
+        order = list(bam.references)
+    wanted = {c for chroms in species.values() for c in chroms}
+    jobs = [(c, lengths[c]) for c in order if c in wanted]
+
+    initargs = (args.bam, args.bin_size, table)
+    if args.threads > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(
+            max_workers=args.threads, initializer=_init_worker, initargs=initargs
+        ) as pool:
+            results = dict(zip([c for c, _ in jobs], pool.map(walk_contig, jobs)))
+    else:
+        _init_worker(*initargs)
+        results = {c: walk_contig((c, n)) for c, n in jobs}
+
+    suffixes = [""] if table is None else ["", ".fwd", ".rev"]
+    for name, chroms in species.items():
+        chroms = [(c, lengths[c]) for c in order if c in set(chroms)]
+        scale = scale_factor(
+            args.normalize, sum(mapped.get(c, 0) for c, _ in chroms), args.bin_size
+        )
+        for t, suffix in enumerate(suffixes):
+            write_bigwig(
+                f"{args.prefix}.{name}{suffix}.bw",
+                chroms,
+                {c: results[c][t] for c, _ in chroms},
+                scale,
+                args.bin_size,
+            )
+        print(f"✅ {name}: {len(chroms)} chromosomes, scale {scale}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+"""
+Single-pass BAM QC: RSeQC read_distribution.py, infer_experiment.py and
+junction_annotation.py from one walk over a coordinate-sorted, indexed BAM.
+
+The three RSeQC tools each re-read the whole BAM and query bx-python interval trees
+once per aligned block. Here every contig is read once (contigs are spread over a
+process pool) and the per-read work is reduced to collecting block midpoints, spliced
+introns and strand keys; the interval lookups are done afterwards on whole arrays
+with np.searchsorted against the same region sets:
+
+    read_distribution  regions are built with RSeQC's own qcmodule.BED (CDS/UTR/intron,
+                       TSS/TES 1/5/10 kb, unioned and subtracted exactly as RSeQC 4.0),
+                       each block is assigned by its midpoint with RSeQC's precedence
+    infer_experiment   the first --sample_size usable reads in BAM order (MAPQ >= --mapq,
+                       overlapping a gene of --strand_bed), as infer_experiment.py samples
+    junction_annotation spliced reads with MAPQ >= --mapq, introns shorter than
+                       --min_intron filtered; junctions are written per species using the
+                       chromosome lists of --regions, like running it on the split BAMs
+
+Outputs use the RSeQC 4.0 text formats (the version in the rseqc container) so MultiQC
+parses them unchanged. RSeQC quirks
+that change numbers are kept (soft clips shift the following read_distribution
+blocks but not the junctions, "=" / "X" CIGAR operations do not advance). Junction files keep the original contig names, where
+RSeQC upper-cases them.
+"""
+
+import argparse
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pysam
+
+# (label, region) in read_distribution.py's output order
+DISTRIBUTION_GROUPS = [
+    ("CDS_Exons", "cds_exon"),
+    ("5'UTR_Exons", "utr_5"),
+    ("3'UTR_Exons", "utr_3"),
+    ("Introns", "intron"),
+    ("TSS_up_1kb", "up_1kb"),
+    ("TSS_up_5kb", "up_5kb"),
+    ("TSS_up_10kb", "up_10kb"),
+    ("TES_down_1kb", "down_1kb"),
+    ("TES_down_5kb", "down_5kb"),
+    ("TES_down_10kb", "down_10kb"),
+]
+UNASSIGNED = len(DISTRIBUTION_GROUPS)
+
+# flags skipped by all three RSeQC tools: unmapped, secondary, QC fail, duplicate
+SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+STRAND_BUFFER = 100000
+
+_worker = {}
+
+
+def _intervals(bed3):
+    """[[chrom, st, end], ...] -> {CHROM: (starts, ends)} sorted int64 arrays."""
+    by_chrom = {}
+    for chrom, start, end in bed3:
+        by_chrom.setdefault(str(chrom).upper(), []).append((int(start), int(end)))
+    return {
+        chrom: tuple(np.array(col, dtype=np.int64) for col in zip(*sorted(pairs)))
+        for chrom, pairs in by_chrom.items()
+    }
+
+
+def build_region_model(bed12):
+    """read_distribution.py's process_gene_model, returned as interval arrays and sizes."""
+    from qcmodule import BED
+
+    gene_model = BED.ParseBED(bed12)
+    cds_exon = BED.unionBed3(gene_model.getCDSExon())
+    utr_5 = BED.subtractBed3(BED.unionBed3(gene_model.getUTR(utr=5)), cds_exon)
+    utr_3 = BED.subtractBed3(BED.unionBed3(gene_model.getUTR(utr=3)), cds_exon)
+    intron = BED.unionBed3(gene_model.getIntron())
+    for other in (cds_exon, utr_5, utr_3):
+        intron = BED.subtractBed3(intron, other)
+    regions = {"cds_exon": cds_exon, "utr_5": utr_5, "utr_3": utr_3, "intron": intron}
+    for direction in ("up", "down"):
+        for size in (1, 5, 10):
+            flank = BED.unionBed3(
+                gene_model.getIntergenic(direction=direction, size=size * 1000)
+            )
+            for other in (cds_exon, utr_5, utr_3, intron):
+                flank = BED.subtractBed3(flank, other)
+            regions[f"{direction}_{size}kb"] = flank
+    bases = {
+        name: sum(int(end) - int(start) for _, start, end in bed3)
+        for name, bed3 in regions.items()
+    }
+    return {name: _intervals(bed3) for name, bed3 in regions.items()}, bases
+
+
+def load_gene_strands(bed):
+    """
+    infer_experiment.py's gene ranges: {chrom: {strand: (starts, running max of ends)}}.
+    A read [st, end) overlaps a gene of that strand iff, among genes starting before
+    end, the largest end is > st.
+    """
+    genes = {}
+    with open(bed) as f:
+        for line in f:
+            if line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.split()
+            if len(fields) < 6:
+                continue
+            genes.setdefault(fields[0], {}).setdefault(fields[5], []).append(
+                (int(fields[1]), int(fields[2]))
+            )
+    ranges = {}
+    for chrom, strands in genes.items():
+        for strand, pairs in strands.items():
+            starts, ends = (
+                np.array(col, dtype=np.int64) for col in zip(*sorted(pairs))
+            )
+            ranges.setdefault(chrom, {})[strand] = (starts, np.maximum.accumulate(ends))
+    return ranges
+
+
+def load_reference_introns(bed12):
+    """junction_annotation.py's annotated intron starts and ends per upper-cased chrom."""
+    starts, ends = {}, {}
+    with open(bed12) as f:
+        for line in f:
+            if line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.split()
+            if len(fields) < 12:
+                continue
+            chrom = fields[0].upper()
+            tx_start = int(fields[1])
+            exon_starts = [
+                tx_start + int(x) for x in fields[11].rstrip(",\n").split(",")
+            ]
+            sizes = [int(x) for x in fields[10].rstrip(",\n").split(",")]
+            exon_ends = [st + size for st, size in zip(exon_starts, sizes)]
+            starts.setdefault(chrom, set()).update(exon_ends[:-1])
+            ends.setdefault(chrom, set()).update(exon_starts[1:])
+    return starts, ends
+
+
+def _contains(intervals, points):
+    """Strict containment (start < p < end) in disjoint intervals, as bx find(p, p)."""
+    if intervals is None or len(points) == 0:
+        return np.zeros(len(points), dtype=bool)
+    starts, ends = intervals
+    i = np.searchsorted(starts, points, side="left") - 1
+    hit = i >= 0
+    hit[hit] = ends[i[hit]] > points[hit]
+    return hit
+
+
+def _overlaps(genes, starts, ends):
+    """Half-open overlap of [starts, ends) with any gene (see load_gene_strands)."""
+    if genes is None:
+        return np.zeros(len(starts), dtype=bool)
+    gene_starts, max_ends = genes
+    i = np.searchsorted(gene_starts, ends, side="left") - 1
+    hit = i >= 0
+    hit[hit] = max_ends[i[hit]] > starts[hit]
+    return hit
+
+
+def classify_midpoints(model, chrom, mids):
+    """Per-group tag counts for block midpoints, with read_distribution.py's precedence."""
+    hit = {name: _contains(model[name].get(chrom), mids) for name in model}
+    index = {name: k for k, (_, name) in enumerate(DISTRIBUTION_GROUPS)}
+    group = np.select(
+        [
+            hit["cds_exon"],
+            hit["utr_5"] & ~hit["utr_3"],
+            hit["utr_3"] & ~hit["utr_5"],
+            hit["utr_3"] & hit["utr_5"],
+            hit["intron"],
+            hit["up_10kb"] & hit["down_10kb"],
+            hit["up_1kb"],
+            hit["up_5kb"],
+            hit["up_10kb"],
+            hit["down_1kb"],
+            hit["down_5kb"],
+            hit["down_10kb"],
+        ],
+        [
+            index["cds_exon"],
+            index["utr_5"],
+            index["utr_3"],
+            UNASSIGNED,
+            index["intron"],
+            UNASSIGNED,
+            index["up_1kb"],
+            index["up_5kb"],
+            index["up_10kb"],
+            index["down_1kb"],
+            index["down_5kb"],
+            index["down_10kb"],
+        ],
+        default=UNASSIGNED,
+    )
+    counts = np.bincount(group, minlength=UNASSIGNED + 1)
+    # a tag in the 1 kb flank is also counted in the 5 and 10 kb ones, 5 kb in 10 kb
+    for direction in ("up", "down"):
+        one, five, ten = (index[f"{direction}_{k}kb"] for k in (1, 5, 10))
+        counts[five] += counts[one]
+        counts[ten] += counts[five]
+    return counts
+
+
+def _strand_keys(genes, starts, ends, codes):
+    """Keys (read code * 4 + gene strand bits) of the reads that overlap a gene."""
+    starts = np.frombuffer(starts, dtype=np.int64)
+    ends = np.frombuffer(ends, dtype=np.int64)
+    plus = _overlaps(genes.get("+"), starts, ends)
+    minus = _overlaps(genes.get("-"), starts, ends)
+    bits = plus.astype(np.int8) + 2 * minus.astype(np.int8)
+    usable = bits > 0
+    return np.frombuffer(codes, dtype=np.int8)[usable] * 4 + bits[usable]
+
+
+def _init_worker(bam, model, genes, sample_size, q_cut, min_intron):
+    _worker.update(
+        bam=bam,
+        model=model,
+        genes=genes,
+        sample_size=sample_size,
+        q_cut=q_cut,
+        min_intron=min_intron,
+    )
+
+
+def walk_contig(contig):
+    """One pass over the reads of contig; returns its share of all three reports."""
+    sample_size, q_cut, min_intron = (
+        _worker["sample_size"],
+        _worker["q_cut"],
+        _worker["min_intron"],
+    )
+    genes = _worker["genes"].get(contig, {})
+    mids = array("q")
+    reads = 0
+    junctions = {}
+    filtered = 0
+    strand_keys = []
+    n_keys = 0
+    starts, ends, codes = array("q"), array("q"), array("b")
+
+    with pysam.AlignmentFile(_worker["bam"], "rb") as bam:
+        for read in bam.fetch(contig):
+            flag = read.flag
+            if flag & SKIP_FLAGS:
+                continue
+            reads += 1
+            unique = read.mapping_quality >= q_cut
+            pos = read.reference_start
+            # read_distribution.py moves blocks past soft clips, junction_annotation.py does not
+            clip = 0
+            for op, size in read.cigartuples:
+                if op == 0:
+                    mids.append(pos + clip + size // 2)
+                    pos += size
+                elif op == 3:
+                    if unique:
+                        if size < min_intron:
+                            filtered += 1
+                        else:
+                            key = (pos, pos + size)
+                            junctions[key] = junctions.get(key, 0) + 1
+                    pos += size
+                elif op == 2:
+                    pos += size
+                elif op == 4:
+                    clip += size
+            if unique and genes and n_keys < sample_size:
+                # read 2 wins when both mate bits are set, as in infer_experiment.py
+                mate = 1 if flag & 0x80 else 0
+                code = (4 + 2 * mate if flag & 0x1 else 0) + (1 if flag & 0x10 else 0)
+                starts.append(read.reference_start)
+                ends.append(read.reference_start + read.query_alignment_length)
+                codes.append(code)
+                if len(codes) == STRAND_BUFFER:
+                    keys = _strand_keys(genes, starts, ends, codes)
+                    strand_keys.append(keys)
+                    n_keys += len(keys)
+                    starts, ends, codes = array("q"), array("q"), array("b")
+    if codes and n_keys < sample_size:
+        strand_keys.append(_strand_keys(genes, starts, ends, codes))
+    keys = np.concatenate(strand_keys) if strand_keys else np.zeros(0, dtype=np.int8)
+
+    mids = np.frombuffer(mids, dtype=np.int64)
+    counts = classify_midpoints(_worker["model"], contig.upper(), mids)
+    return {
+        "reads": reads,
+        "tags": len(mids),
+        "distribution": counts,
+        "strand_keys": keys[:sample_size],
+        "junctions": junctions,
+        "filtered": filtered,
+    }
+
+
+def format_read_distribution(results, bases):
+    reads = sum(r["reads"] for r in results)
+    tags = sum(r["tags"] for r in results)
+    counts = sum(r["distribution"] for r in results)
+    if isinstance(counts, int):
+        counts = np.zeros(UNASSIGNED + 1, dtype=np.int64)
+    lines = [
+        "%-30s%d" % ("Total Reads", reads),
+        "%-30s%d" % ("Total Tags", tags),
+        "%-30s%d" % ("Total Assigned Tags", tags - counts[UNASSIGNED]),
+        "=" * 69,
+        "%-20s%-20s%-20s%-20s" % ("Group", "Total_bases", "Tag_count", "Tags/Kb"),
+    ]
+    for k, (label, name) in enumerate(DISTRIBUTION_GROUPS):
+        lines.append(
+            "%-20s%-20d%-20d%-18.2f"
+            % (label, bases[name], counts[k], counts[k] * 1000.0 / (bases[name] + 1))
+        )
+    lines.append("=" * 69)
+    return "\n".join(lines) + "\n"
+
+
+def format_strandedness(results, sample_size):
+    keys = np.concatenate([r["strand_keys"] for r in results])[:sample_size]
+    tally = np.bincount(keys.astype(np.int64), minlength=32)
+    # key = ((paired * 4 + read2 * 2 + reverse) * 4) + gene strand bits (1 +, 2 -, 3 both)
+    single = tally[:8].sum()
+    paired = tally[16:].sum()
+
+    def n(code, gene_strand):
+        return tally[code * 4 + (1 if gene_strand == "+" else 2)]
+
+    if paired > 0 and single == 0:
+        spec1 = (n(4, "+") + n(5, "-") + n(6, "-") + n(7, "+")) / float(paired)
+        spec2 = (n(4, "-") + n(5, "+") + n(6, "+") + n(7, "-")) / float(paired)
+        rules = ('"1++,1--,2+-,2-+"', '"1+-,1-+,2++,2--"')
+        protocol = "PairEnd"
+    elif single > 0 and paired == 0:
+        spec1 = (n(0, "+") + n(1, "-")) / float(single)
+        spec2 = (n(0, "-") + n(1, "+")) / float(single)
+        rules = ('"++,--"', '"+-,-+"')
+        protocol = "SingleEnd"
+    else:
+        return "Unknown Data type\n"
+    other = 1 - spec1 - spec2
+    if other < 0:
+        other = 0.0
+    # RSeQC 4.0 (the rseqc container) starts with two blank lines, RSeQC 5.0.5 with one
+    return (
+        f"\n\nThis is {protocol} Data\n"
+        "Fraction of reads failed to determine: %.4f\n" % other
+        + "Fraction of reads explained by %s: %.4f\n" % (rules[0], spec1)
+        + "Fraction of reads explained by %s: %.4f\n" % (rules[1], spec2)
+    )
+
+
+def write_junctions(prefix, contigs, results, ref_introns):
+    """<prefix>.junction.xls/.bed and the MultiQC-parsable summary <prefix>.junction.bed.log"""
+    ref_starts, ref_ends = ref_introns
+    events = {"annotated": 0, "partial_novel": 0, "complete_novel": 0}
+    junctions = {"annotated": 0, "partial_novel": 0, "complete_novel": 0}
+    total_events = 0
+    with open(prefix + ".junction.xls", "w") as xls, open(
+        prefix + ".junction.bed", "w"
+    ) as bed:
+        print(
+            "chrom\tintron_st(0-based)\tintron_end(1-based)\tread_count\tannotation",
+            file=xls,
+        )
+        for contig, result in zip(contigs, results):
+            total_events += result["filtered"]
+            starts = ref_starts.get(contig.upper(), ())
+            ends = ref_ends.get(contig.upper(), ())
+            for (start, end), count in result["junctions"].items():
+                known_start, known_end = start in starts, end in ends
+                if known_start and known_end:
+                    name, color = "annotated", "205,0,0"
+                elif not known_start and not known_end:
+                    name, color = "complete_novel", "0,0,205"
+                else:
+                    name, color = "partial_novel", "0,205,0"
+                events[name] += count
+                junctions[name] += 1
+                total_events += count
+                print(f"{contig}\t{start}\t{end}\t{count}\t {name}", file=xls)
+                print(
+                    f"{contig}\t{start - 1}\t{end + 1}\t{name}\t{count}\t.\t{start - 1}\t{end + 1}"
+                    f"\t{color}\t2\t1,1\t0,{end - start + 1}",
+                    file=bed,
+                )
+    with open(prefix + ".junction.bed.log", "w") as log:
+        print(f"total = {total_events}", file=log)
+        print("\n" + "=" * 67, file=log)
+        print(f"Total splicing  Events:\t{total_events}", file=log)
+        print(f"Known Splicing Events:\t{events['annotated']}", file=log)
+        print(f"Partial Novel Splicing Events:\t{events['partial_novel']}", file=log)
+        print(f"Novel Splicing Events:\t{events['complete_novel']}", file=log)
+        print(
+            f"Filtered Splicing Events:\t{sum(r['filtered'] for r in results)}",
+            file=log,
+        )
+        print(f"\nTotal splicing  Junctions:\t{sum(junctions.values())}", file=log)
+        print(f"Known Splicing Junctions:\t{junctions['annotated']}", file=log)
+        print(
+            f"Partial Novel Splicing Junctions:\t{junctions['partial_novel']}", file=log
+        )
+        print(f"Novel Splicing Junctions:\t{junctions['complete_novel']}", file=log)
+        print("\n" + "=" * 67, file=log)
+
+
+def parse_regions(regions_file):
+    """ref.fa.regions.host_viruses lines "<species> <chrom> [<chrom> ...]" -> {species: [chroms]}"""
+    species = {}
+    with open(regions_file) as f:
+        for line in f:
+            fields = line.split()
+            if fields:
+                species.setdefault(fields[0], []).extend(fields[1:])
+    return species
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="RSeQC read_distribution, infer_experiment and junction_annotation in one pass over a sorted, indexed BAM."
+    )
+    parser.add_argument("--bam", required=True, help="Coordinate-sorted, indexed BAM")
+    parser.add_argument(
+        "--bed12", required=True, help="Gene model in BED12 (ref.genes.bed12)"
+    )
+    parser.add_argument(
+        "--strand_bed",
+        help="Gene model used for strandedness (default: --bed12); infer_strandedness uses ref.genes.bed",
+    )
+    parser.add_argument(
+        "--read_distribution", required=True, help="Output, read_distribution.py format"
+    )
+    parser.add_argument(
+        "--strandedness", required=True, help="Output, infer_experiment.py format"
+    )
+    parser.add_argument(
+        "--regions",
+        help="Species regions file; junctions are written per species to <junction_prefix>.<species>.junction.*",
+    )
+    parser.add_argument("--junction_prefix", help="Output prefix of the junction files")
+    parser.add_argument(
+        "--sample_size",
+        type=int,
+        default=200000,
+        help="Reads sampled for strandedness (default: 200000)",
+    )
+    parser.add_argument(
+        "--mapq",
+        type=int,
+        default=30,
+        help="Minimum MAPQ for strandedness and junctions (default: 30)",
+    )
+    parser.add_argument(
+        "--min_intron",
+        type=int,
+        default=50,
+        help="Minimum intron length for junctions (default: 50)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Contigs processed in parallel (default: 1)",
+    )
+    args = parser.parse_args()
+
+    if bool(args.regions) != bool(args.junction_prefix):
+        parser.error("--regions and --junction_prefix go together")
+
+    model, bases = build_region_model(args.bed12)
+    genes = load_gene_strands(args.strand_bed or args.bed12)
+
+    with pysam.AlignmentFile(args.bam, "rb") as bam:
+        contigs = [s.contig for s in bam.get_index_statistics() if s.total > 0]
+
+    initargs = (args.bam, model, genes, args.sample_size, args.mapq, args.min_intron)
+    if args.threads > 1 and len(contigs) > 1:
+        with ProcessPoolExecutor(
+            max_workers=args.threads, initializer=_init_worker, initargs=initargs
+        ) as pool:
+            results = list(pool.map(walk_contig, contigs))
+    else:
+        _init_worker(*initargs)
+        results = [walk_contig(contig) for contig in contigs]
+
+    with open(args.read_distribution, "w") as f:
+        f.write(format_read_distribution(results, bases))
+    with open(args.strandedness, "w") as f:
+        f.write(format_strandedness(results, args.sample_size))
+
+    if args.regions:
+        ref_introns = load_reference_introns(args.bed12)
+        by_contig = dict(zip(contigs, results))
+        for species, chroms in parse_regions(args.regions).items():
+            selected = [c for c in contigs if c in set(chroms)]
+            write_junctions(
+                f"{args.junction_prefix}.{species}",
+                selected,
+                [by_contig[c] for c in selected],
+                ref_introns,
+            )
+    print(
+        f"✅ {sum(r['reads'] for r in results)} reads on {len(contigs)} contigs processed",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
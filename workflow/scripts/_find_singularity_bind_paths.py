@@ -1,23 +1,44 @@
 #!/usr/bin/env python3
 # filepath: /project/dremel_lab/workflows/pipelines/CHAPLIN/dev_cud2td/find_singularity_bind_paths.py
+"""
+Print the comma-separated 4-deep directory prefixes (e.g. /project/lab/user/data)
+of all paths mentioned in the given files that exist, for singularity --bind.
+
+Files are read line by line and the paths found are collapsed into a prefix trie
+of at most `depth` levels, so thousands of FASTQ paths below the same directory
+become one trie branch. The trie directories are checked on the filesystem level
+by level and concurrently, and a branch whose directory does not exist is not
+descended into. As before, a prefix is only bound when one of the paths below it
+exists: the paths of each remaining leaf are checked until the first one that
+does, which is usually the first. Every path is checked at most once per run.
+"""
 
 import os
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+# Regex to match Linux paths (e.g., /path/to/something)
+PATH_PATTERN = re.compile(r"(/(?:[a-zA-Z0-9_\-\.]+/)*[a-zA-Z0-9_\-\.]+)")
+STAT_THREADS = 16
+
 
 def find_linux_paths(file_content):
     """
     Extract Linux paths from the given file content.
     """
-    # Regex to match Linux paths (e.g., /path/to/something)
-    path_pattern = re.compile(r'(/(?:[a-zA-Z0-9_\-\.]+/)*[a-zA-Z0-9_\-\.]+)')
-    return path_pattern.findall(file_content)
+    return PATH_PATTERN.findall(file_content)
 
-def filter_existing_paths(paths):
+
+def iter_file_paths(file_path):
     """
-    Filter out paths that do not exist on the filesystem.
+    Stream the Linux paths of a file, one line at a time.
     """
-    return [path for path in paths if os.path.exists(path)]
+    with open(file_path, "r", errors="replace") as file:
+        for line in file:
+            yield from find_linux_paths(line)
+
 
 def get_n_deep_prefix(path, n=4):
     """
@@ -28,36 +49,87 @@ def get_n_deep_prefix(path, n=4):
         return "/" + "/".join(parts[:n])
     return None
 
+
+def build_prefix_trie(paths, depth=4):
+    """
+    Nested dict of the first 'depth' components of every path at least 'depth'
+    levels deep; the leaves are the sets of full paths below each prefix.
+    """
+    trie = {}
+    for path in paths:
+        parts = path.strip("/").split("/")
+        if len(parts) < depth:
+            continue
+        node = trie
+        for part in parts[: depth - 1]:
+            node = node.setdefault(part, {})
+        node.setdefault(parts[depth - 1], set()).add(path)
+    return trie
+
+
+@lru_cache(maxsize=None)
+def path_exists(path):
+    return os.path.exists(path)
+
+
+def existing_prefixes(trie, depth=4, threads=STAT_THREADS):
+    """
+    Walk the trie breadth first and return the 'depth'-level prefixes below which
+    at least one of the paths exists; the nodes of each level are checked
+    concurrently.
+    """
+    level = [("/" + name, children) for name, children in trie.items()]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for current in range(1, depth + 1):
+            exists = list(pool.map(path_exists, [path for path, _ in level]))
+            level = [node for node, ok in zip(level, exists) if ok]
+            if current == depth:
+                break
+            level = [
+                (f"{path}/{name}", grandchildren)
+                for path, children in level
+                for name, grandchildren in children.items()
+            ]
+
+        # one full path per leaf and round, until a path of the leaf exists
+        pending = {prefix: iter(sorted(paths)) for prefix, paths in level}
+        found = []
+        while pending:
+            batch = [(prefix, next(paths, None)) for prefix, paths in pending.items()]
+            batch = [(prefix, path) for prefix, path in batch if path is not None]
+            pending = {prefix: pending[prefix] for prefix, _ in batch}
+            exists = pool.map(path_exists, [path for _, path in batch])
+            for (prefix, _), ok in zip(batch, exists):
+                if ok:
+                    found.append(prefix)
+                    del pending[prefix]
+    return sorted(found)
+
+
 def main():
     if len(sys.argv) < 2:
         print("Usage: python3 find_singularity_bind_paths.py <file1> <file2> ...")
         sys.exit(1)
 
-    input_files = sys.argv[1:]
-    all_paths = set()
-
-    for file_path in input_files:
+    input_files = []
+    for file_path in sys.argv[1:]:
         if not os.path.isfile(file_path):
             print(f"Warning: {file_path} is not a valid file. Skipping.")
             continue
+        input_files.append(file_path)
 
-        with open(file_path, 'r') as file:
-            content = file.read()
-            paths = find_linux_paths(content)
-            all_paths.update(paths)
-
-    # Filter paths that exist
-    valid_paths = filter_existing_paths(all_paths)
-
-    # Keep only paths at least 4 directories deep
-    four_deep = filter(None, (get_n_deep_prefix(path, n=4) for path in valid_paths))
+    # Collapse the paths of all files into their 4-deep prefixes
+    trie = build_prefix_trie(
+        (path for file_path in input_files for path in iter_file_paths(file_path)),
+        depth=4,
+    )
 
-    # Get unique common 4-deep prefixes
-    unique_base_paths = sorted(set(four_deep))
+    # Get unique existing 4-deep prefixes
+    unique_base_paths = existing_prefixes(trie, depth=4)
 
     # Print them as comma-separated list
     print(",".join(unique_base_paths))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
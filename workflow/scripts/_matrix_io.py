@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Typed Parquet companions for the count/TPM/RPKM/TIN matrices under results/counts/.
+
+Every matrix is still written as the TSV users and DiffEx read. Next to it,
+write_matrix stores <name>.parquet with typed columns:
+
+    counts            uint32 (float32 if a column has missing or fractional values)
+    TPM/RPKM/FPKM/TIN float32
+    chrom-like/type   dictionary encoded (species, gene_chr, chrom, gene_strand, gene_type)
+    whole numbers     nullable Int64 (gene_start/gene_end and other coordinates, even
+                      with "NA" rows, which pandas would parse as float64)
+    other metadata    as pandas would parse the TSV ("NA" -> missing)
+
+Parquet's dictionary/run-length encoding plus zstd keeps zero-heavy transcript
+matrices small. read_matrix returns the companion when it is at least as new as the
+TSV, and falls back to parsing the TSV otherwise. pyarrow is optional: without it
+only the TSV is written and read.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+CATEGORICAL_COLUMNS = {"species", "gene_chr", "chrom", "gene_strand", "gene_type"}
+
+
+def companion_path(tsv_path):
+    """results/counts/counts_matrix.tsv -> results/counts/counts_matrix.parquet"""
+    root, ext = os.path.splitext(tsv_path)
+    return (root if ext in (".tsv", ".txt", ".csv") else tsv_path) + ".parquet"
+
+
+def _typed_values(col, kind):
+    values = col.to_numpy()
+    if kind == "counts":
+        if (
+            not np.isnan(values.astype(np.float64)).any()
+            and (values >= 0).all()
+            and (values <= np.iinfo(np.uint32).max).all()
+            and (np.mod(values, 1) == 0).all()
+        ):
+            return values.astype(np.uint32)
+    return values.astype(np.float32)
+
+
+def _typed_metadata(col, name):
+    if col.dtype == object or pd.api.types.is_string_dtype(col.dtype):
+        col = col.astype(object).replace("NA", np.nan)
+        if name not in CATEGORICAL_COLUMNS:
+            try:
+                col = pd.to_numeric(col)
+            except (ValueError, TypeError):
+                col = col.astype(object)
+    if name in CATEGORICAL_COLUMNS:
+        col = col.astype("category")
+    elif col.dtype.kind == "f":
+        values = col.dropna().to_numpy()
+        if (np.mod(values, 1) == 0).all() and (np.abs(values) < 2**63).all():
+            col = col.astype("Int64")
+    return col
+
+
+def to_typed_frame(df, value_columns, kind, index=False):
+    """Return the binary representation of df (see module docstring)."""
+    if index:
+        df = df.reset_index()
+    value_columns = set(value_columns)
+    typed = {}
+    for name in df.columns:
+        if name in value_columns:
+            typed[name] = _typed_values(df[name], kind)
+        else:
+            typed[name] = _typed_metadata(df[name], name)
+    return pd.DataFrame(typed, columns=df.columns)
+
+
+def write_matrix(df, tsv_path, value_columns, kind, index=False, binary=True):
+    """
+    Write df to tsv_path and, when pyarrow is available and binary is set, the typed
+    Parquet companion. kind is "counts" for integer counts, anything else for
+    float32 values. A stale companion is removed if it cannot be refreshed.
+    """
+    df.to_csv(tsv_path, sep="\t", index=index)
+
+    parquet = companion_path(tsv_path)
+    if binary and HAVE_PYARROW:
+        typed = to_typed_frame(df, value_columns, kind, index=index)
+        typed.to_parquet(parquet, engine="pyarrow", compression="zstd", index=False)
+        return
+    if binary:
+        print(
+            f"⚠️ WARNING: pyarrow is not installed; skipping {parquet}",
+            file=sys.stderr,
+        )
+    discard_companion(tsv_path)
+
+
+def discard_companion(tsv_path):
+    """Remove the companion of a TSV written without one, so it cannot go stale."""
+    parquet = companion_path(tsv_path)
+    if os.path.exists(parquet):
+        os.remove(parquet)
+
+
+def read_matrix(tsv_path, binary=True, sep="\t"):
+    """
+    Read a matrix written by write_matrix, preferring its Parquet companion. Columns
+    come back as pd.read_csv(tsv_path) would return them, with values in their
+    stored dtype (uint32 counts, float32 normalized values).
+    """
+    parquet = companion_path(tsv_path)
+    if (
+        binary
+        and HAVE_PYARROW
+        and os.path.exists(parquet)
+        and (
+            not os.path.exists(tsv_path)
+            or os.path.getmtime(parquet) >= os.path.getmtime(tsv_path)
+        )
+    ):
+        df = pd.read_parquet(parquet, engine="pyarrow")
+        for name in df.columns:
+            if isinstance(df[name].dtype, pd.CategoricalDtype):
+                df[name] = df[name].astype(object)
+            elif isinstance(df[name].dtype, pd.Int64Dtype):
+                df[name] = df[name].astype("float64" if df[name].hasnans else "int64")
+        return df
+    return pd.read_csv(tsv_path, sep=sep)
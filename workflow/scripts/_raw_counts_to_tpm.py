@@ -1,45 +1,221 @@
+import numpy as np
 import pandas as pd
 import argparse
 
-def counts_to_rpkm_tpm(df, length_col, sample_cols):
-    # Copy full dataframe to preserve non-sample columns
-    df_rpkm = df.copy()
-    df_tpm = df.copy()
+from _annotation_index import GENE_LENGTH_COLUMNS
+from _matrix_io import discard_companion, read_matrix, write_matrix
 
-    # Only process sample columns listed in sample_cols
-    for col in sample_cols:
-        rpk = df[col] / df[length_col]
-        total_mapped_millions = df[col].sum() / 1e6
-        df_rpkm[col] = rpk / total_mapped_millions
-        df_tpm[col] = (rpk / rpk.sum()) * 1e6
+LENGTH_UNITS = {"kb": 1.0, "bp": 1000.0}
+
+
+def library_sizes(counts, lengths):
+    """
+    Per-sample column sums needed for normalization: mapped counts and reads per
+    kilobase. Sums are accumulated in float64 whatever the storage type. NaN lengths
+    (features without annotation) are skipped as pandas' sum() did.
+    """
+    rpk = np.divide(counts, lengths[:, None], dtype=np.float64)
+    return counts.sum(axis=0, dtype=np.float64), np.nansum(rpk, axis=0)
+
+
+def normalize(counts, lengths, mapped, rpk_sum, dtype=np.float32):
+    """
+    RPKM and TPM for a (feature x sample) block given the per-sample sums from
+    library_sizes; both results are written into preallocated arrays of dtype.
+    """
+    rpkm = np.empty(counts.shape, dtype=dtype, order="F")
+    tpm = np.empty(counts.shape, dtype=dtype, order="F")
+    rpk = np.divide(counts, lengths[:, None], dtype=np.float64)
+    np.divide(rpk, mapped / 1e6, out=rpkm, casting="same_kind")
+    np.divide(rpk, rpk_sum, out=rpk)
+    np.multiply(rpk, 1e6, out=tpm, casting="same_kind")
+    return rpkm, tpm
+
+
+def counts_to_rpkm_tpm(df, length_col, sample_cols, length_unit="kb", dtype=np.float32):
+    """
+    Whole-matrix RPKM/TPM: sample columns are normalized as one 2-D array, every other
+    column is carried over as is (shared, not copied).
+    """
+    # Fortran order keeps each sample contiguous for the column reductions
+    counts = np.asfortranarray(df[sample_cols].to_numpy(dtype=np.float64))
+    lengths = df[length_col].to_numpy(dtype=np.float64) / LENGTH_UNITS[length_unit]
+    mapped, rpk_sum = library_sizes(counts, lengths)
+    rpkm, tpm = normalize(counts, lengths, mapped, rpk_sum, dtype)
+    return _with_values(df, sample_cols, rpkm), _with_values(df, sample_cols, tpm)
+
+
+def _with_values(df, sample_cols, matrix):
+    position = {c: k for k, c in enumerate(sample_cols)}
+    data = {c: (matrix[:, position[c]] if c in position else df[c]) for c in df.columns}
+    return pd.DataFrame(data, columns=df.columns, index=df.index)
+
+
+def _merge_dtype(a, b):
+    # the dtype pandas infers for a column read in one piece from the dtypes of its chunks
+    if a is None or a == b:
+        return b
+    if a.kind in "iuf" and b.kind in "iuf":
+        return np.result_type(a, b)
+    return np.dtype(object)
+
+
+def counts_to_rpkm_tpm_chunked(
+    input_path,
+    rpkm_output,
+    tpm_output,
+    length_col,
+    sample_cols,
+    chunksize,
+    sep="\t",
+    length_unit="kb",
+    dtype=np.float32,
+):
+    """
+    Streaming RPKM/TPM for matrices that do not fit in memory: a first pass over row
+    chunks accumulates the per-sample sums and the column types a whole-matrix read
+    would infer, a second pass reads the chunks with those types (so metadata columns
+    are written exactly as counts_to_rpkm_tpm writes them), normalizes and appends each
+    chunk to the outputs. Only one chunk is held at a time.
+    """
+    mapped = np.zeros(len(sample_cols))
+    rpk_sum = np.zeros(len(sample_cols))
+    dtypes = {}
+    for chunk in pd.read_csv(input_path, sep=sep, chunksize=chunksize):
+        for c, t in chunk.dtypes.items():
+            dtypes[c] = _merge_dtype(dtypes.get(c), t)
+        counts = chunk[sample_cols].to_numpy(dtype=np.float64)
+        lengths = (
+            chunk[length_col].to_numpy(dtype=np.float64) / LENGTH_UNITS[length_unit]
+        )
+        m, r = library_sizes(counts, lengths)
+        mapped += m
+        rpk_sum += r
+
+    first = True
+    for chunk in pd.read_csv(input_path, sep=sep, chunksize=chunksize, dtype=dtypes):
+        counts = chunk[sample_cols].to_numpy(dtype=np.float64)
+        lengths = (
+            chunk[length_col].to_numpy(dtype=np.float64) / LENGTH_UNITS[length_unit]
+        )
+        rpkm, tpm = normalize(counts, lengths, mapped, rpk_sum, dtype)
+        mode = "w" if first else "a"
+        _with_values(chunk, sample_cols, rpkm).to_csv(
+            rpkm_output, sep="\t", index=False, header=first, mode=mode
+        )
+        _with_values(chunk, sample_cols, tpm).to_csv(
+            tpm_output, sep="\t", index=False, header=first, mode=mode
+        )
+        first = False
 
-    # Non-sample columns (metadata) remain unchanged because of df.copy()
-    return df_rpkm, df_tpm
 
 def main():
-    parser = argparse.ArgumentParser(description='Convert raw counts to RPKM and TPM values using sample list, preserving metadata columns.')
-    parser.add_argument('-i', '--input', required=True, help='Input TSV/CSV file with counts and gene lengths (in kb).')
-    parser.add_argument('-s', '--samples', required=True, help='TSV file with a column named sampleName listing sample columns to process.')
-    parser.add_argument('-o1', '--rpkm_output', required=True, help='Output TSV file for RPKM values.')
-    parser.add_argument('-o2', '--tpm_output', required=True, help='Output TSV file for TPM values.')
-    parser.add_argument('--sep', default='\t', help='Column separator (default: tab).')
-    parser.add_argument('--length_col', default='gene_length_kb', help='Column name for gene length in kb.')
+    parser = argparse.ArgumentParser(
+        description="Convert raw counts to RPKM and TPM values using sample list, preserving metadata columns."
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        required=True,
+        help="Input TSV/CSV file with counts and gene lengths (in kb).",
+    )
+    parser.add_argument(
+        "-s",
+        "--samples",
+        required=True,
+        help="TSV file with a column named sampleName listing sample columns to process.",
+    )
+    parser.add_argument(
+        "-o1", "--rpkm_output", required=True, help="Output TSV file for RPKM values."
+    )
+    parser.add_argument(
+        "-o2", "--tpm_output", required=True, help="Output TSV file for TPM values."
+    )
+    parser.add_argument("--sep", default="\t", help="Column separator (default: tab).")
+    parser.add_argument(
+        "--length_col",
+        default="gene_length_kb",
+        help="Column name for gene length in kb.",
+    )
+    parser.add_argument(
+        "--gene_length",
+        choices=list(GENE_LENGTH_COLUMNS),
+        default=None,
+        help="Gene length definition to normalize by: longest (gene_length_kb), union (gene_union_length_kb) or mean (gene_mean_length_kb); overrides --length_col. The column must be in the input, see --gene_lengths of _aggregate_counts_by_strandedness.py.",
+    )
+    parser.add_argument(
+        "--length_unit",
+        choices=sorted(LENGTH_UNITS),
+        default="kb",
+        help="Unit of --length_col: kb (gene_length_kb, default) or bp (e.g. mRNA_size in the transcript-level matrices).",
+    )
+    parser.add_argument(
+        "--dtype",
+        choices=["float32", "float64"],
+        default="float32",
+        help="Precision of the RPKM/TPM values (default: float32; per-sample sums are always float64).",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=0,
+        help="Normalize in two streaming passes over this many rows at a time instead of loading the whole matrix (default: 0, off). Reads the TSV and writes no .parquet companions. Sums are added chunk by chunk, so float64 output can differ from the whole-matrix result in the last digit.",
+    )
+    parser.add_argument(
+        "--parquet",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Read the input from its .parquet companion when present and write companions for the outputs (default: True).",
+    )
 
     args = parser.parse_args()
+    if args.gene_length:
+        args.length_col = GENE_LENGTH_COLUMNS[args.gene_length]
+        args.length_unit = "kb"
 
     # Load data and sample list
-    df = pd.read_csv(args.input, sep=args.sep)
     sample_df = pd.read_csv(args.samples, sep=args.sep)
+    sample_cols = sample_df["sampleName"].tolist()
+
+    if args.chunksize > 0:
+        header = pd.read_csv(args.input, sep=args.sep, nrows=0).columns
+    else:
+        df = read_matrix(args.input, binary=args.parquet, sep=args.sep)
+        header = df.columns
 
-    sample_cols = sample_df['sampleName'].tolist()
-    missing = [c for c in sample_cols if c not in df.columns]
+    missing = [c for c in sample_cols if c not in header]
     if missing:
         raise ValueError(f"Samples not found in input file: {missing}")
+    if args.length_col not in header:
+        raise ValueError(f"Length column not found in input file: {args.length_col}")
+
+    if args.chunksize > 0:
+        counts_to_rpkm_tpm_chunked(
+            args.input,
+            args.rpkm_output,
+            args.tpm_output,
+            args.length_col,
+            sample_cols,
+            args.chunksize,
+            args.sep,
+            args.length_unit,
+            args.dtype,
+        )
+        discard_companion(args.rpkm_output)
+        discard_companion(args.tpm_output)
+        return
+
+    df_rpkm, df_tpm = counts_to_rpkm_tpm(
+        df, args.length_col, sample_cols, args.length_unit, args.dtype
+    )
 
-    df_rpkm, df_tpm = counts_to_rpkm_tpm(df, args.length_col, sample_cols)
+    write_matrix(
+        df_rpkm, args.rpkm_output, sample_cols, kind="float", binary=args.parquet
+    )
+    write_matrix(
+        df_tpm, args.tpm_output, sample_cols, kind="float", binary=args.parquet
+    )
 
-    df_rpkm.to_csv(args.rpkm_output, sep='\t', index=False)
-    df_tpm.to_csv(args.tpm_output, sep='\t', index=False)
 
-if __name__ == '__main__':
+if __name__ == "__main__":
     main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Resource history for SLURM right-sizing.
+
+Every rule writes a Snakemake benchmark file (logs/benchmarks/<rule>/...tsv); with
+`benchmark-extended: true` in the profile it also holds the rule name, threads,
+requested resources and the size of every input file. This script
+
+    collect   appends benchmark records that are not in the history store yet
+              (one TSV row per job run: rule, wildcards, seconds, max_rss_mb,
+              cpu_time, threads, input_mb, ...), run from the Snakefile on
+              success and on error
+    profile   writes a copy of the cluster profile whose set-resources/set-threads
+              are sized from the history, and prints the profile directory to run
+              with (the original profile when sizing is off or there is no history)
+
+For every rule with at least --min_runs recorded runs, memory (max_rss) and runtime
+are modelled as a + b * input_mb: b is the least-squares slope over the history
+(0 when input sizes are unknown or all equal) and a is raised until every recorded
+run fits under the line. The profile entry is a Snakemake resource expression,
+evaluated per job with its input size and attempt:
+
+    min(cap, max(floor, int((a + b * input.size_mb) * margin * escalation ** (attempt - 1))))
+
+so a retried job (restart-times) asks for `escalation` times more each attempt.
+Threads are set to the CPU the rule actually used (cpu_time / wall time, upper
+quantile, times margin), never more than the static profile gives it. Rules
+without enough history keep their static profile values.
+"""
+
+import argparse
+import ast
+import csv
+import glob
+import math
+import os
+import shutil
+import sys
+
+import numpy as np
+import yaml
+
+HISTORY_COLUMNS = [
+    "rule",
+    "wildcards",
+    "benchmark",
+    "recorded",
+    "seconds",
+    "max_rss_mb",
+    "cpu_time",
+    "threads",
+    "input_mb",
+    "mem_mb",
+    "runtime",
+]
+
+
+def _float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return math.nan
+    return value
+
+
+def _literal(value):
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return {}
+
+
+def read_benchmark(path, benchmarks_dir):
+    """Rows of one Snakemake benchmark TSV (several with benchmark repeats)."""
+    rule = os.path.relpath(path, benchmarks_dir).split(os.sep)[0]
+    recorded = f"{os.path.getmtime(path):.0f}"
+    rows = []
+    with open(path) as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            resources = _literal(row.get("resources", ""))
+            inputs = _literal(row.get("input_size_mb", ""))
+            rows.append(
+                {
+                    "rule": row.get("rule_name") or rule,
+                    "wildcards": row.get("wildcards", "NA"),
+                    "benchmark": os.path.relpath(path, benchmarks_dir),
+                    "recorded": recorded,
+                    "seconds": row.get("s", "NA"),
+                    "max_rss_mb": row.get("max_rss", "NA"),
+                    "cpu_time": row.get("cpu_time", "NA"),
+                    "threads": row.get("threads", "NA"),
+                    "input_mb": (
+                        f"{sum(inputs.values()):.3f}"
+                        if isinstance(inputs, dict) and inputs
+                        else "NA"
+                    ),
+                    "mem_mb": resources.get("mem_mb", "NA"),
+                    "runtime": resources.get("runtime", "NA"),
+                }
+            )
+    return rows
+
+
+def read_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return list(csv.DictReader(f, delimiter="\t"))
+
+
+def collect(benchmarks_dir, history):
+    """Append new benchmark records to the history store; returns the number added."""
+    seen = {(r["benchmark"], r["recorded"]) for r in read_history(history)}
+    new = []
+    for path in sorted(
+        glob.glob(os.path.join(benchmarks_dir, "**", "*.tsv"), recursive=True)
+    ):
+        rows = read_benchmark(path, benchmarks_dir)
+        if rows and (rows[0]["benchmark"], rows[0]["recorded"]) not in seen:
+            new.extend(rows)
+    if new:
+        os.makedirs(os.path.dirname(os.path.abspath(history)), exist_ok=True)
+        write_header = not os.path.exists(history)
+        with open(history, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=HISTORY_COLUMNS, delimiter="\t")
+            if write_header:
+                writer.writeheader()
+            writer.writerows(new)
+    return len(new)
+
+
+def fit(x, y):
+    """Upper envelope a + b * x of the history (b >= 0, a >= 0)."""
+    known = ~np.isnan(x)
+    b = 0.0
+    if known.all() and len(x) >= 2 and np.ptp(x) > 0:
+        b = max(float(np.polyfit(x, y, 1)[0]), 0.0)
+    a = max(float(np.max(y - b * np.where(known, x, 0.0))), 0.0)
+    return a, b
+
+
+def expression(a, b, margin, escalation, floor, cap):
+    return (
+        f"min({cap}, max({floor}, int(({a:.1f} + {b:.6f} * input.size_mb)"
+        f" * {margin} * {escalation} ** (attempt - 1))))"
+    )
+
+
+def size_rules(history, static, min_runs, margin, escalation, quantile=0.9):
+    """
+    {rule: {"mem_mb": expr, "runtime": expr, "threads": int}} for rules with at least
+    min_runs usable history rows; static is the profile as a dict (caps).
+    """
+    defaults = static.get("default-resources", {})
+    set_resources = static.get("set-resources", {}) or {}
+    set_threads = static.get("set-threads", {}) or {}
+    max_mem = max(
+        [defaults.get("mem_mb", 0)]
+        + [r.get("mem_mb", 0) for r in set_resources.values()]
+    )
+    max_runtime = max(
+        [defaults.get("runtime", 0)]
+        + [r.get("runtime", 0) for r in set_resources.values()]
+    )
+
+    by_rule = {}
+    for row in history:
+        by_rule.setdefault(row["rule"], []).append(row)
+
+    sized = {}
+    for rule, rows in sorted(by_rule.items()):
+        seconds = np.array([_float(r["seconds"]) for r in rows])
+        rss = np.array([_float(r["max_rss_mb"]) for r in rows])
+        usable = ~np.isnan(seconds) & ~np.isnan(rss)
+        if usable.sum() < min_runs:
+            continue
+        x = np.array([_float(r["input_mb"]) for r in rows])[usable]
+        seconds, rss = seconds[usable], rss[usable]
+        cpu = np.array([_float(r["cpu_time"]) for r in rows])[usable]
+
+        static_threads = set_threads.get(
+            rule,
+            set_resources.get(rule, {}).get("threads", defaults.get("threads", 1)),
+        )
+        load = cpu / np.maximum(seconds, 1.0)
+        load = load[~np.isnan(load)]
+        threads = static_threads
+        if load.size:
+            used = math.ceil(np.quantile(load, quantile) * margin)
+            threads = int(min(static_threads, max(1, used)))
+
+        mem = fit(x, rss)
+        runtime = fit(x, seconds / 60.0)
+        sized[rule] = {
+            "mem_mb": expression(*mem, margin, escalation, 1024, max_mem),
+            "runtime": expression(*runtime, margin, escalation, 10, max_runtime),
+            "threads": threads,
+            "runs": int(usable.sum()),
+        }
+    return sized
+
+
+def write_profile(profile_dir, output_dir, sized):
+    """Copy profile_dir to output_dir with set-resources/set-threads of sized rules replaced."""
+    with open(os.path.join(profile_dir, "config.yaml")) as f:
+        profile = yaml.safe_load(f)
+    if os.path.abspath(output_dir) != os.path.abspath(profile_dir):
+        shutil.copytree(profile_dir, output_dir, dirs_exist_ok=True)
+    profile["benchmark-extended"] = True
+    set_resources = profile.setdefault("set-resources", {}) or {}
+    set_threads = profile.setdefault("set-threads", {}) or {}
+    for rule, values in sized.items():
+        entry = set_resources.setdefault(rule, {}) or {}
+        entry["mem_mb"] = values["mem_mb"]
+        entry["runtime"] = values["runtime"]
+        entry.pop("threads", None)
+        set_resources[rule] = entry
+        set_threads[rule] = values["threads"]
+    profile["set-resources"] = set_resources
+    profile["set-threads"] = set_threads
+    with open(os.path.join(output_dir, "config.yaml"), "w") as f:
+        f.write(
+            f"# generated by _resource_history.py from {profile_dir}; edit that profile instead\n"
+        )
+        yaml.safe_dump(profile, f, sort_keys=False, width=1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Collect Snakemake benchmark records into a history store and size the cluster profile from it."
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    col = sub.add_parser("collect", help="Append new benchmark records to the history")
+    col.add_argument("--benchmarks", required=True, help="Benchmark directory")
+    col.add_argument("--history", required=True, help="History store (TSV)")
+
+    prof = sub.add_parser(
+        "profile",
+        help="Write a history-sized copy of the profile and print the profile directory to use",
+    )
+    prof.add_argument("--config", required=True, help="Workflow config.yaml")
+    prof.add_argument("--profile", required=True, help="Cluster profile directory")
+    prof.add_argument(
+        "--output",
+        default=None,
+        help="Sized profile directory (default: <profile>.sized)",
+    )
+    prof.add_argument(
+        "--history",
+        default=None,
+        help="History store (default: resource_history from config.yaml)",
+    )
+
+    args = parser.parse_args()
+    if args.command == "collect":
+        added = collect(args.benchmarks, args.history)
+        print(f"✅ {added} benchmark records added to {args.history}", file=sys.stderr)
+        return
+
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    profile_dir = args.profile.rstrip("/")
+    if str(config.get("resource_sizing", "static")).lower() != "history":
+        print(profile_dir)
+        return
+    history = read_history(args.history or config["resource_history"])
+    with open(os.path.join(profile_dir, "config.yaml")) as f:
+        static = yaml.safe_load(f)
+    sized = size_rules(
+        history,
+        static,
+        int(config.get("resource_history_min_runs", 3)),
+        float(config.get("resource_margin", 1.25)),
+        float(config.get("resource_retry_escalation", 1.5)),
+    )
+    if not sized:
+        print(
+            "⚠️ WARNING: no rule has enough resource history yet, using the static profile",
+            file=sys.stderr,
+        )
+        print(profile_dir)
+        return
+    output = args.output or profile_dir + ".sized"
+    write_profile(profile_dir, output, sized)
+    for rule, values in sized.items():
+        print(
+            f"✅ {rule}: sized from {values['runs']} runs, threads {values['threads']}",
+            file=sys.stderr,
+        )
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
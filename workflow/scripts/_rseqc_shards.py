@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Scatter/gather for RSeQC tin.py and geneBody_coverage.py.
+
+Both tools walk the gene model one transcript at a time in a single process, so
+their runtime follows the size of the BAM times the number of transcripts. Here
+ref.genes.bed12 is cut into contiguous, gene-count balanced shards, the RSeQC tool
+is run on each shard (in parallel, see rules rseqc_tin/rseqc_geneBody_coverage)
+and the shard outputs are merged back into the files the unsharded run writes:
+
+    tin       TIN is computed per transcript, so the shard tin.xls tables are
+              concatenated in shard (= BED) order; summary.txt is recomputed with
+              numpy from the same values tin.py averages. tin.py writes 0.0 for the
+              transcripts that fail its minimum read filter and leaves them out of the
+              summary, so each shard runs tin.py through run_tin, which records per
+              row whether the transcript passed the filter
+    genebody  coverage is summed per percentile over transcripts, so the shard rows
+              are added up; transcripts are deduplicated by geneID beforehand as
+              geneBody_coverage.py does (the last BED line of a geneID wins)
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import types
+
+import numpy as np
+
+
+def read_bed12(bed12):
+    with open(bed12) as f:
+        return [line for line in f if not line.startswith(("#", "track", "browser"))]
+
+
+def unique_gene_ids(lines):
+    """Keep the last line of each geneBody_coverage.py geneID (chrom_start_end_name_strand)."""
+    last = {}
+    for k, line in enumerate(lines):
+        fields = line.split()
+        if len(fields) < 12:
+            continue
+        last["_".join(fields[i] for i in (0, 1, 2, 3, 5))] = k
+    return [lines[k] for k in sorted(last.values())]
+
+
+def split_bed12(bed12, outdir, shards, unique_ids=False):
+    """Write up to `shards` contiguous BED12 chunks of (almost) equal gene count."""
+    lines = read_bed12(bed12)
+    if unique_ids:
+        lines = unique_gene_ids(lines)
+    os.makedirs(outdir, exist_ok=True)
+    bounds = np.linspace(0, len(lines), max(1, shards) + 1).round().astype(int)
+    paths = []
+    for k, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        if end <= start:
+            continue
+        path = os.path.join(outdir, f"shard_{k:04d}.bed12")
+        with open(path, "w") as f:
+            f.writelines(lines[start:end])
+        paths.append(path)
+    return paths
+
+
+def run_tin(tin_args, flags_output):
+    """
+    Run tin.py with tin_args and write one line per tin.xls row to flags_output: 1 if
+    the transcript passed the minimum read filter (and so is part of summary.txt), 0 if
+    not. tin.py checks the filter once per transcript, in row order.
+    """
+    script = shutil.which("tin.py")
+    if script is None:
+        raise FileNotFoundError("tin.py not found in PATH")
+    tin = types.ModuleType("tin")
+    tin.__file__ = script
+    with open(script) as f:
+        exec(compile(f.read(), script, "exec"), tin.__dict__)
+
+    check_min_reads = tin.check_min_reads
+    flags = []
+
+    def recording_check(*args, **kwargs):
+        passed = check_min_reads(*args, **kwargs)
+        flags.append("1" if passed is True else "0")
+        return passed
+
+    tin.check_min_reads = recording_check
+    sys.argv = [script] + tin_args
+    try:
+        tin.main()
+    finally:
+        with open(flags_output, "w") as out:
+            out.writelines(flag + "\n" for flag in flags)
+
+
+def merge_tin(tables, xls_output, summary_output, bam_name):
+    """
+    Concatenate shard tin.xls tables (in order) and recompute summary.txt from the
+    transcripts that passed the read filter, as recorded by run_tin next to each table
+    (tin.flags in the shard directory).
+    """
+    tins = []
+    with open(xls_output, "w") as out:
+        out.write("\t".join(["geneID", "chrom", "tx_start", "tx_end", "TIN"]) + "\n")
+        for table in tables:
+            with open(table) as f, open(_flags_path(table)) as flags:
+                next(f, None)
+                for line in f:
+                    out.write(line)
+                    if next(flags).strip() == "1":
+                        tins.append(float(line.rstrip("\n").split("\t")[-1]))
+    with open(summary_output, "w") as out:
+        out.write(
+            "\t".join(["Bam_file", "TIN(mean)", "TIN(median)", "TIN(stdev)"]) + "\n"
+        )
+        if tins:
+            stats = [str(i) for i in (np.mean(tins), np.median(tins), np.std(tins))]
+        else:
+            # no transcript passed in any shard: write what tin.py wrote for the shards
+            with open(_summary_path(tables[0])) as f:
+                stats = f.read().splitlines()[1].split("\t")[1:]
+        out.write("\t".join([bam_name] + stats) + "\n")
+
+
+def _flags_path(table):
+    # every shard runs in its own directory
+    return os.path.join(os.path.dirname(table), "tin.flags")
+
+
+def _summary_path(table):
+    return table[: -len(".tin.xls")] + ".summary.txt"
+
+
+def _number(token):
+    # geneBody_coverage.py sums int read counts and 0.0 placeholders; keep that type
+    return float(token) if "." in token or "e" in token else int(token)
+
+
+def merge_genebody(tables, output):
+    """Add up the per-percentile coverage rows of the shard geneBodyCoverage.txt files."""
+    header = "Percentile\t" + "\t".join(str(i) for i in range(1, 101))
+    rows = {}
+    for table in tables:
+        with open(table) as f:
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0] == "Percentile":
+                    continue
+                total = rows.setdefault(fields[0], {})
+                for k, token in enumerate(fields[1:]):
+                    total[k] = total.get(k, 0) + _number(token)
+    with open(output, "w") as out:
+        print(header, file=out)
+        for name, total in rows.items():
+            print(
+                name + "\t" + "\t".join(str(total[k]) for k in sorted(total)), file=out
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Split ref.genes.bed12 into shards and merge sharded RSeQC tin.py / geneBody_coverage.py outputs."
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    split = sub.add_parser("split", help="Write gene-count balanced BED12 shards")
+    split.add_argument("--bed12", required=True)
+    split.add_argument("--outdir", required=True)
+    split.add_argument("--shards", type=int, required=True)
+    split.add_argument(
+        "--unique_ids",
+        action="store_true",
+        help="Deduplicate geneIDs first (geneBody_coverage.py semantics)",
+    )
+
+    run = sub.add_parser(
+        "run-tin",
+        help="Run tin.py (all further arguments are passed on), recording which transcripts passed its read filter",
+    )
+    run.add_argument(
+        "--flags",
+        required=True,
+        help="Output: one 1/0 line per tin.xls row (passed the read filter or not)",
+    )
+
+    tin = sub.add_parser(
+        "merge-tin", help="Merge shard *.tin.xls into tin.xls and summary.txt"
+    )
+    tin.add_argument("--xls", required=True, help="Output tin.xls")
+    tin.add_argument("--summary", required=True, help="Output summary.txt")
+    tin.add_argument(
+        "--bam",
+        required=True,
+        help="BAM the shards were computed on (named in summary.txt)",
+    )
+    tin.add_argument("tables", nargs="+", help="Shard *.tin.xls files, in shard order")
+
+    genebody = sub.add_parser("merge-genebody", help="Sum shard *.geneBodyCoverage.txt")
+    genebody.add_argument("--output", required=True)
+    genebody.add_argument(
+        "tables", nargs="+", help="Shard *.geneBodyCoverage.txt files"
+    )
+
+    args, tin_args = parser.parse_known_args()
+    if tin_args and args.command != "run-tin":
+        parser.error(f"unrecognized arguments: {' '.join(tin_args)}")
+    if args.command == "split":
+        paths = split_bed12(args.bed12, args.outdir, args.shards, args.unique_ids)
+        print(f"✅ {len(paths)} shards written to {args.outdir}", file=sys.stderr)
+    elif args.command == "run-tin":
+        run_tin(tin_args, args.flags)
+    elif args.command == "merge-tin":
+        merge_tin(args.tables, args.xls, args.summary, os.path.basename(args.bam))
+    else:
+        merge_genebody(args.tables, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Per-sample column shards for incremental cohort aggregation.
+
+The cohort aggregation scripts parse one text file per sample (STAR ReadsPerGene.out.tab,
+rseqc_fpkm_tpm.tsv). A ShardCache keeps the parsed columns of each file as an .npz under
+results/counts/.shards/<kind>/, named after the file's fingerprint (real path, size and
+mtime). When samples are appended to the manifest only the new or changed files are
+parsed; every other sample is loaded from its shard and the matrix is re-stitched, so
+the cost of a re-run follows the number of new samples rather than the cohort size.
+
+Shards that were not used by a run (samples dropped from the manifest, files that
+changed) are removed by ShardCache.prune().
+"""
+
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+SHARD_VERSION = 1
+
+
+def fingerprint(path):
+    """Identify a file by real path, size and mtime (cheap, no content read)."""
+    real = os.path.realpath(path)
+    st = os.stat(real)
+    key = f"{SHARD_VERSION}\0{real}\0{st.st_size}\0{st.st_mtime_ns}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class ShardCache:
+    """Load/store dicts of NumPy arrays keyed by the fingerprint of a source file."""
+
+    def __init__(self, cache_dir, kind):
+        self.path = os.path.join(cache_dir, kind)
+        self.hits = 0
+        self.misses = 0
+        self._used = set()
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def _shard(self, source):
+        name = fingerprint(source) + ".npz"
+        with self._lock:
+            self._used.add(name)
+        return os.path.join(self.path, name)
+
+    def load(self, source):
+        """Return the cached arrays for source, or None if it has no current shard."""
+        shard = self._shard(source)
+        try:
+            with np.load(shard, allow_pickle=False) as data:
+                arrays = {key: data[key] for key in data.files}
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return arrays
+
+    def store(self, source, arrays):
+        """Write the shard for source atomically; failures only cost the cache."""
+        shard = self._shard(source)
+        try:
+            fd, tmp = tempfile.mkstemp(prefix=".shard.", dir=self.path)
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, shard)
+        except OSError as e:
+            print(
+                f"⚠️ WARNING: could not write shard for {source}: {e}", file=sys.stderr
+            )
+
+    def prune(self):
+        """Remove shards that were not loaded or stored since this cache was opened."""
+        for name in os.listdir(self.path):
+            if name.endswith(".npz") and name not in self._used:
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+    def report(self, label):
+        print(
+            f"{label}: {self.hits} samples from shards, {self.misses} parsed",
+            file=sys.stderr,
+        )
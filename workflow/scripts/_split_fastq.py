@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Scatter step of the chunked cutadapt (cutadapt_chunks > 1).
+
+R1 (and R2 for paired-end data) are cut into contiguous chunks of whole FASTQ
+records, one gzip file per chunk. Chunk boundaries are placed by the compressed
+bytes read from R1, so every chunk carries about the same share of the input;
+R2 gets exactly the same number of records per chunk, which keeps the mates in
+sync. The trimmed chunks are concatenated again in chunk order as gzip members
+(rule cutadapt_gather), so the gathered file holds the reads in input order.
+
+Every record is assumed to be four lines, as cutadapt expects.
+
+Usage:
+    _split_fastq.py --r1 S.R1.fastq.gz --r2 S.R2.fastq.gz \\
+        --out_r1 c0.R1.fastq.gz c1.R1.fastq.gz --out_r2 c0.R2.fastq.gz c1.R2.fastq.gz
+"""
+
+import argparse
+import gzip
+import os
+import sys
+
+BLOCK_SIZE = 1024 * 1024
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class FastqBlocks:
+    """Read a (gzipped) FASTQ in blocks of complete records."""
+
+    def __init__(self, path):
+        self.raw = open(path, "rb")
+        self.size = os.fstat(self.raw.fileno()).st_size
+        gzipped = self.raw.peek(2)[:2] == GZIP_MAGIC
+        self.stream = gzip.GzipFile(fileobj=self.raw) if gzipped else self.raw
+        self.buffer = b""
+        self.eof = False
+
+    def position(self):
+        """Bytes of the (compressed) file read so far."""
+        return self.raw.tell()
+
+    def _fill(self):
+        data = self.stream.read(BLOCK_SIZE)
+        if not data:
+            self.eof = True
+        self.buffer += data
+
+    def block(self):
+        """
+        The next block of complete records and their count; (b"", 0) at the end of
+        the file.
+        """
+        while True:
+            self._fill()
+            lines = self.buffer.count(b"\n")
+            if self.eof and self.buffer and not self.buffer.endswith(b"\n"):
+                self.buffer += b"\n"
+                lines += 1
+            records = lines // 4
+            if records or self.eof:
+                break
+        # the last complete record ends at the (records * 4)-th newline, found from the back
+        end = len(self.buffer)
+        for _ in range(lines - records * 4 + 1):
+            end = self.buffer.rfind(b"\n", 0, end)
+        data, self.buffer = self.buffer[: end + 1], self.buffer[end + 1 :]
+        if self.eof and self.buffer.strip():
+            raise ValueError(f"{self.raw.name} ends with an incomplete FASTQ record.")
+        return data, records
+
+    def records(self, n):
+        """Exactly the next n records."""
+        while self.buffer.count(b"\n") < 4 * n and not self.eof:
+            self._fill()
+        if self.eof and self.buffer and not self.buffer.endswith(b"\n"):
+            self.buffer += b"\n"
+        end = -1
+        for _ in range(4 * n):
+            end = self.buffer.find(b"\n", end + 1)
+            if end < 0:
+                raise ValueError(
+                    f"{self.raw.name} has fewer records than its mate file; R1 and R2 are out of sync."
+                )
+        data, self.buffer = self.buffer[: end + 1], self.buffer[end + 1 :]
+        return data
+
+    def exhausted(self):
+        if not self.eof and not self.buffer:
+            self._fill()
+        return self.eof and not self.buffer.strip()
+
+    def close(self):
+        self.stream.close()
+        self.raw.close()
+
+
+def split_fastq(r1, out_r1, r2=None, out_r2=None, compresslevel=1):
+    """Split r1 (and r2) into len(out_r1) chunks; returns the records per chunk."""
+    chunks = len(out_r1)
+    if r2 and len(out_r2 or []) != chunks:
+        raise ValueError("--out_r1 and --out_r2 need the same number of chunk files.")
+    reads1 = FastqBlocks(r1)
+    reads2 = FastqBlocks(r2) if r2 else None
+    counts = []
+    for k in range(chunks):
+        target = reads1.size * (k + 1) / chunks
+        n = 0
+        f1 = gzip.open(out_r1[k], "wb", compresslevel=compresslevel)
+        f2 = gzip.open(out_r2[k], "wb", compresslevel=compresslevel) if reads2 else None
+        while k == chunks - 1 or reads1.position() < target:
+            data, records = reads1.block()
+            if not records:
+                break
+            f1.write(data)
+            if f2:
+                f2.write(reads2.records(records))
+            n += records
+        f1.close()
+        if f2:
+            f2.close()
+        counts.append(n)
+    if reads2 and not reads2.exhausted():
+        raise ValueError(f"{r2} has more records than {r1}; R1 and R2 are out of sync.")
+    reads1.close()
+    if reads2:
+        reads2.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Split R1/R2 FASTQ files into byte-balanced chunks of whole records, mates kept in sync."
+    )
+    parser.add_argument("--r1", required=True, help="R1 FASTQ (gzipped or plain)")
+    parser.add_argument("--r2", default=None, help="R2 FASTQ for paired-end data")
+    parser.add_argument(
+        "--out_r1", nargs="+", required=True, help="R1 chunk files (.fastq.gz)"
+    )
+    parser.add_argument(
+        "--out_r2", nargs="+", default=None, help="R2 chunk files (.fastq.gz)"
+    )
+    parser.add_argument(
+        "--compresslevel",
+        type=int,
+        default=1,
+        help="gzip level of the chunk files (default: 1)",
+    )
+    args = parser.parse_args()
+
+    counts = split_fastq(
+        args.r1, args.out_r1, args.r2, args.out_r2, compresslevel=args.compresslevel
+    )
+    print(
+        f"✅ {sum(counts)} records split into {len(counts)} chunks: "
+        + ", ".join(map(str, counts)),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Transcript-level fragment counts, FPM, FPKM and TPM from a sorted, indexed BAM.
+
+A native replacement for RSeQC FPKM_count.py (run with --only-exonic -u -q <mapq>)
+followed by _rseqc_fpkm_add_tpm.py, writing the same rseqc_fpkm_tpm.tsv. FPKM_count.py
+reads the BAM twice (once for the exonic fragment total, once per BED line through
+an interval tree); here every contig is read once (contigs are spread over a process
+pool) and the per-read work is reduced to collecting flags and coordinates. Both
+counts are then done on whole arrays against the cached BED12 index of
+_annotation_index.py, with FPKM_count.py's rules:
+
+    alignments   QC-fail, duplicate and secondary alignments and MAPQ < --mapq skipped
+    total        exonic fragments (the FPM/FPKM denominator): single-end reads whose
+                 [pos, pos + read length) overlaps an exon; for pairs, read 1 with both
+                 mates' [pos, pos + read length) overlapping exons (only the mapped mate
+                 when the other one is unmapped)
+    transcript   reads overlapping the transcript span that, single-end, overlap one of
+                 its exons or, paired (read 1 only), start or have their mate start in
+                 one of its exons; counted on the strand given by --strandedness
+
+Exon overlaps are looked up in a table of elementary segments (stretches between
+consecutive exon boundaries) listing the transcripts covering each segment.
+"""
+
+import argparse
+import csv
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pysam
+
+from _annotation_index import load_bed12_index
+
+# QC fail, duplicate, secondary
+SKIP_FLAGS = 0x200 | 0x400 | 0x100
+
+_worker = {}
+
+
+def strand_rule(strandedness, sample, peorse):
+    """RSeQC strand rule of sample from sample_strandedness.tsv, as _get_strand.py."""
+    with open(strandedness) as f:
+        rows = [r for r in csv.DictReader(f, delimiter="\t") if r["sample"] == sample]
+    if not rows:
+        sys.exit(f"❌ Sample '{sample}' not found in {strandedness}.")
+    used_strand = rows[0]["used_strand"].strip().lower()
+    if used_strand == "unstranded":
+        return None
+    if used_strand == "reverse":
+        return "1++,1--,2+-,2-+" if peorse == "PE" else "++,--"
+    if used_strand == "forward":
+        return "1+-,1-+,2++,2--" if peorse == "PE" else "+-,-+"
+    sys.exit(f"❌ Unknown used_strand '{used_strand}' for sample '{sample}'.")
+
+
+def rule_strands(rule):
+    """
+    RSeQC rule -> (paired, transcript strand of a forward read, of a reverse read).
+    FPKM_count.py looks up "1+"/"1-" for paired reads and "+"/"-" otherwise, so a
+    paired-end rule counts no unpaired reads and a single-end rule no paired ones.
+    """
+    keys = dict((key[:-1], key[-1]) for key in rule.split(","))
+    paired = len(rule.split(",")) == 4
+    prefix = "1" if paired else ""
+    return paired, keys.get(prefix + "+", ""), keys.get(prefix + "-", "")
+
+
+def merged_exons(starts, ends):
+    """Sorted exons -> disjoint intervals; touching exons are kept apart."""
+    if len(starts) == 0:
+        return starts, ends
+    reach = np.maximum.accumulate(ends)
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] >= reach[:-1]
+    return starts[new], np.maximum.reduceat(ends, np.flatnonzero(new))
+
+
+def _any_overlap(u_starts, u_ends, a, b):
+    """[a, b) overlaps a disjoint sorted interval (start < b and end > a)."""
+    if len(u_starts) == 0:
+        return np.zeros(len(a), dtype=bool)
+    idx = np.searchsorted(u_ends, a, side="right")
+    hit = idx < len(u_starts)
+    hit[hit] = u_starts[idx[hit]] < b[hit]
+    return hit
+
+
+class SegmentIndex:
+    """Transcripts covering each stretch between consecutive exon boundaries of a contig."""
+
+    def __init__(self, tx, starts, ends):
+        self.bounds = np.unique(np.concatenate([starts, ends]))
+        first = np.searchsorted(self.bounds, starts)
+        n = np.searchsorted(self.bounds, ends) - first
+        seg = np.repeat(first, n) + (
+            np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        )
+        width = tx.max() + 1 if len(tx) else 1
+        pairs = np.unique(seg * width + np.repeat(tx, n))
+        self.seg_tx = pairs % width
+        counts = np.bincount(pairs // width, minlength=max(len(self.bounds) - 1, 0))
+        self.offset = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offset[1:])
+
+    def _expand(self, reads, first, last):
+        """(read, transcript) pairs for reads covering segments first..last - 1."""
+        n = np.maximum(last - first, 0)
+        seg = np.repeat(first, n) + (
+            np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        )
+        reads = np.repeat(reads, n)
+        m = self.offset[seg + 1] - self.offset[seg]
+        pos = np.repeat(self.offset[seg], m) + (
+            np.arange(m.sum()) - np.repeat(np.cumsum(m) - m, m)
+        )
+        return np.repeat(reads, m), self.seg_tx[pos]
+
+    def points(self, reads, x):
+        """Transcripts with an exon containing x (start <= x < end)."""
+        k = np.searchsorted(self.bounds, x, side="right") - 1
+        ok = (k >= 0) & (k < len(self.bounds) - 1)
+        return self._expand(reads[ok], k[ok], k[ok] + 1)
+
+    def intervals(self, reads, a, b):
+        """Transcripts with an exon overlapping [a, b) (start < b and end > a)."""
+        first = np.maximum(np.searchsorted(self.bounds, a, side="right") - 1, 0)
+        last = np.minimum(
+            np.searchsorted(self.bounds, b, side="left"), len(self.bounds) - 1
+        )
+        return self._expand(reads, first, last)
+
+
+def _init_worker(bam, index, mapq, strands):
+    _worker.update(bam=bam, index=index, mapq=mapq, strands=strands)
+
+
+def count_contig(job):
+    """One pass over the reads of a contig -> (exonic fragments, {transcript: count})."""
+    contig, tx_rows, union_rows = job
+    index, strands = _worker["index"], _worker["strands"]
+    flags, pos, endpos, qlen, pnext = (array("q") for _ in range(5))
+    with pysam.AlignmentFile(_worker["bam"], "rb") as bam:
+        for read in bam.fetch(contig):
+            flag = read.flag
+            if flag & SKIP_FLAGS or read.mapping_quality < _worker["mapq"]:
+                continue
+            start = read.reference_start
+            end = read.reference_end
+            flags.append(flag)
+            pos.append(start)
+            # htslib region overlap: unmapped (placed) reads span one base
+            endpos.append(end if end is not None and end > start else start + 1)
+            qlen.append(read.query_length)
+            pnext.append(read.next_reference_start)
+    flags, pos, endpos, qlen, pnext = (
+        np.frombuffer(a, dtype=np.int64) if a else np.zeros(0, np.int64)
+        for a in (flags, pos, endpos, qlen, pnext)
+    )
+    paired = (flags & 0x1) > 0
+    read1 = paired & ((flags & 0x80) == 0)
+    unmapped = (flags & 0x4) > 0
+    mate_unmapped = (flags & 0x8) > 0
+    reverse = (flags & 0x10) > 0
+
+    # exonic fragments, against the exons of every BED line on this contig (any case)
+    ex_tx = index.column("bed12_exons", "transcript")
+    sel = np.isin(ex_tx, union_rows)
+    ex_start = index.column("bed12_exons", "start")[sel]
+    ex_end = index.column("bed12_exons", "end")[sel]
+    order = np.argsort(ex_start, kind="stable")
+    u_start, u_end = merged_exons(ex_start[order], ex_end[order])
+    read_hit = _any_overlap(u_start, u_end, pos, pos + qlen)
+    mate_hit = _any_overlap(u_start, u_end, pnext, pnext + qlen)
+    exonic = np.where(
+        ~paired,
+        read_hit,
+        read1
+        & ~(unmapped & mate_unmapped)
+        & np.where(
+            unmapped,
+            mate_hit,
+            np.where(mate_unmapped, read_hit, read_hit & mate_hit),
+        ),
+    )
+
+    # per transcript
+    counts = {}
+    if len(tx_rows):
+        sel = np.isin(ex_tx, tx_rows)
+        segments = SegmentIndex(
+            ex_tx[sel],
+            index.column("bed12_exons", "start")[sel],
+            index.column("bed12_exons", "end")[sel],
+        )
+        tx_start = index.column("bed12", "start")
+        tx_end = index.column("bed12", "end")
+        single = np.flatnonzero(~paired)
+        r1, t1 = segments.intervals(single, pos[single], pos[single] + qlen[single])
+        pe = np.flatnonzero(read1 & ~(unmapped & mate_unmapped))
+        r2, t2 = segments.points(pe, pos[pe])
+        r3, t3 = segments.points(pe, pnext[pe])
+        r = np.concatenate([r1, r2, r3])
+        t = np.concatenate([t1, t2, t3])
+        # the read must also be returned by fetch(chrom, tx_start, tx_end)
+        fetched = (pos[r] < tx_end[t]) & (endpos[r] > tx_start[t])
+        r, t = r[fetched], t[fetched]
+        width = len(tx_start)
+        pairs = np.unique(r * width + t)
+        r, t = pairs // width, pairs % width
+        if strands is not None:
+            rule_paired, forward, backward = strands
+            read_strand = np.where(reverse[r], backward, forward)
+            tx_strand = np.char.decode(index.column("bed12", "strand")[t], "utf-8")
+            keep = (paired[r] == rule_paired) & (read_strand == tx_strand)
+            r, t = r[keep], t[keep]
+        hits = np.bincount(t, minlength=width)
+        counts = {int(i): int(hits[i]) for i in tx_rows}
+    return int(exonic.sum()), counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Transcript fragment counts, FPM, FPKM and TPM (FPKM_count.py + TPM) in one pass over a sorted, indexed BAM."
+    )
+    parser.add_argument("--bam", required=True, help="Coordinate-sorted, indexed BAM")
+    parser.add_argument(
+        "--bed12", required=True, help="Gene model in BED12 (ref.genes.bed12)"
+    )
+    parser.add_argument("--output", required=True, help="Output rseqc_fpkm_tpm.tsv")
+    parser.add_argument(
+        "--annotation_cache",
+        default=None,
+        help="Annotation index cache directory (default: <bed12 dir>/annotation_index)",
+    )
+    parser.add_argument(
+        "--strandedness",
+        help="sample_strandedness.tsv (default: count reads on both strands)",
+    )
+    parser.add_argument("--sample", help="Sample name in --strandedness")
+    parser.add_argument("--peorse", choices=["PE", "SE"], help="Sequencing type")
+    parser.add_argument(
+        "--mapq",
+        type=int,
+        default=30,
+        help="Minimum mapping quality (default: 30)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Contigs processed in parallel (default: 1)",
+    )
+    args = parser.parse_args()
+
+    rule = None
+    if args.strandedness:
+        if not (args.sample and args.peorse):
+            parser.error("--strandedness needs --sample and --peorse")
+        rule = strand_rule(args.strandedness, args.sample, args.peorse)
+    strands = rule_strands(rule) if rule else None
+
+    index = load_bed12_index(args.bed12, args.annotation_cache)
+    chroms = np.char.decode(index.column("bed12", "chrom"), "utf-8")
+    with pysam.AlignmentFile(args.bam, "rb") as bam:
+        references = list(bam.references)
+    jobs = []
+    for contig in references:
+        tx_rows = np.flatnonzero(chroms == contig)
+        union_rows = np.flatnonzero(np.char.upper(chroms) == contig.upper())
+        if len(union_rows):
+            jobs.append((contig, tx_rows, union_rows))
+
+    initargs = (args.bam, index, args.mapq, strands)
+    if args.threads > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(
+            max_workers=args.threads, initializer=_init_worker, initargs=initargs
+        ) as pool:
+            results = list(pool.map(count_contig, jobs))
+    else:
+        _init_worker(*initargs)
+        results = [count_contig(job) for job in jobs]
+
+    denominator = float(sum(exonic for exonic, _ in results))
+    if denominator <= 0:
+        sys.exit("❌ Total exonic fragments is 0. Cannot compute FPKM.")
+    frag_count = {}
+    for _, counts in results:
+        frag_count.update(counts)
+
+    # BED lines on contigs missing from the BAM are skipped, and so are lines without
+    # a +/- strand when counting strand-specifically, as FPKM_count.py does
+    strand = np.char.decode(index.column("bed12", "strand"), "utf-8")
+    rows = [
+        i
+        for i in range(len(chroms))
+        if i in frag_count and (rule is None or strand[i] in ("+", "-"))
+    ]
+    count = np.array([frag_count[i] for i in rows], dtype=np.float64)
+    size = index.column("bed12", "length")[rows].astype(np.float64)
+    fpm = count * 1000000 / denominator
+    fpkm = count * 1000000000 / (denominator * size)
+    total_fpkm = fpkm.sum()
+    if total_fpkm == 0:
+        sys.exit("❌ Total FPKM sum is zero. Cannot compute TPM.")
+    tpm = fpkm / total_fpkm * 1e6
+
+    names = np.char.decode(index.column("bed12", "name"), "utf-8")
+    tx_start = index.column("bed12", "start")
+    tx_end = index.column("bed12", "end")
+    with open(args.output, "w") as out:
+        out.write(
+            "\t".join(
+                [
+                    "chrom",
+                    "st",
+                    "end",
+                    "accession",
+                    "mRNA_size",
+                    "gene_strand",
+                    "Frag_count",
+                    "FPM",
+                    "FPKM",
+                    "TPM",
+                ]
+            )
+            + "\n"
+        )
+        for k, i in enumerate(rows):
+            out.write(
+                f"{chroms[i]}\t{tx_start[i]}\t{tx_end[i]}\t{names[i]}\t{size[k]:.6f}\t{strand[i]}\t"
+                f"{count[k]:.6f}\t{fpm[k]:.6f}\t{fpkm[k]:.6f}\t{tpm[k]:.6f}\n"
+            )
+    print(f"✅ Wrote {args.output} ({len(rows)} transcripts)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()